@@ -0,0 +1,51 @@
+#!/usr/bin/python
+#
+# bench_vax_decode - micro-benchmark for the SDAT (VAX float) decoding 
+#                    in fMRS_sliding_window
+#
+# compares the vectorized _vax_to_ieee_single_float against the original
+# per-float loop (kept below as reference) on random SDAT sized data and
+# checks that both give bit-exact identical results
+#
+# usage: bench_vax_decode.py [samples] [rows1,rows2,...]
+#
+
+import sys
+import os
+import time
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fMRS_sliding_window import _vax_to_ieee_single_float
+
+def _vax_to_ieee_single_float_loop(data): # original version from the python VeSPA project
+    data = bytearray(data) # indexing gives integers in python 2 and 3
+    f = []; nfloat = int(len(data) / 4)
+    for i in range(nfloat):
+        byte2 = data[0 + i*4]; byte1 = data[1 + i*4]
+        byte4 = data[2 + i*4]; byte3 = data[3 + i*4]
+        sign  =  (byte1 & 0x80) >> 7
+        expon = ((byte1 & 0x7f) << 1 )  + ((byte2 & 0x80 ) >> 7 )
+        fract = ((byte2 & 0x7f) << 16 ) +  (byte3 << 8 ) + byte4
+        if sign == 0: sign_mult = 1.0
+        else: sign_mult = -1.0;
+        if 0 < expon:
+            val = sign_mult * (0.5 + (fract/16777216.0)) * pow(2.0, expon - 128.0)   
+            f.append(val)
+        elif expon == 0 and sign == 0: f.append(0)
+        else: f.append(0)
+    return f 
+
+samples = 2048; rows_list = [32, 128, 360]
+if len(sys.argv)>1: samples = int(sys.argv[1])
+if len(sys.argv)>2: rows_list = [int(rows) for rows in sys.argv[2].split(',')]
+random = numpy.random.RandomState(0)
+print ('samples  rows    floats     loop [s]   numpy [s]   speedup  bit-exact')
+for rows in rows_list:
+    data = random.randint(0, 256, rows*samples*2*4).astype(numpy.uint8).tobytes()
+    start = time.time(); reference = _vax_to_ieee_single_float_loop(data); t_loop = time.time()-start
+    start = time.time(); result = _vax_to_ieee_single_float(data); t_numpy = time.time()-start
+    exact = numpy.array_equal(numpy.asarray(reference, dtype=numpy.float64).view(numpy.uint64), 
+                              result.view(numpy.uint64))
+    print ('%7d %5d %9d %12.3f %11.4f %9.0fx  %s' % (samples, rows, rows*samples*2, 
+           t_loop, t_numpy, t_loop/max(t_numpy, 1e-9), exact))
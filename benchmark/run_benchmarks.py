@@ -0,0 +1,216 @@
+#!/usr/bin/python
+#
+# run_benchmarks - throughput benchmarks of fMRS_sliding_window and fMRS_statistics
+#                  on synthetic data, no scanner data or TARQUIN needed
+#
+# scenarios (each runs in its own process to get its peak memory):
+#   serial     : fMRS_sliding_window commandline, one fit after the other
+#                with the stand-in benchmark/tarquin (FAKE_TARQUIN_DELAY per fit)
+#   native     : fMRS_sliding_window commandline with --backend=native, all
+#                fits in process
+#   reader     : SPAR/SDAT (and DICOM if pydicom is installed) reading,
+#                decoding, sliding window averaging and HSVD water removal
+#   accumulate : reading back and storing TARQUIN results and writing the output
+#   statistics : fMRS_statistics correlation, surrogates, GLM and window sweep 1-50
+#   group      : fMRS_statistics group mode, correlation and GLM of --subjects
+# reported are wall time, time per stage and peak RSS (of the scenario process
+# and of its child processes)
+#
+# usage: run_benchmarks.py [options]
+#          --scenarios=<list>  : comma separated, default all
+#          --rows=<n>          : dynamics (default 360)
+#          --samples=<n>       : points per FID (default 2048)
+#          --window=<n>        : sliding window (default 5)
+#          --serial_rows=<n>   : dynamics for the serial scenario (default 40)
+#          --delay=<seconds>   : latency of the stand-in TARQUIN (default 0)
+#          --subjects=<n>      : subjects for the group scenario (default 100)
+#          --jobs=<n>          : threads for the group scenario and hsvd (default 4)
+#          --json=<file>       : also write the results as JSON, e.g. to compare runs
+#
+
+import sys
+import os
+import time
+import json
+import shutil
+import tempfile
+import subprocess
+from getopt import getopt
+import numpy
+
+benchmarkdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchmarkdir, '..'))
+import synthetic
+
+scenarios = ['serial', 'native', 'reader', 'accumulate', 'statistics', 'group']
+
+def peak_rss (who): # peak resident memory in MB, None where unavailable (windows)
+    try: import resource
+    except ImportError: return None
+    rss = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin': return rss/1048576. # bytes
+    return rss/1024. # kB
+class Stages (object): # wall time per stage
+    def __init__ (self): self.times = []; self.start = time.time()
+    def __call__ (self, name, function, *args):
+        start = time.time(); result = function(*args)
+        self.times.append((name, time.time()-start))
+        return result
+def serial (workdir, options, stages):
+    basename = os.path.join(workdir, 'serial')
+    stages ('generate', synthetic.write_SPAR_SDAT, basename, options['serial_rows'], options['samples'])
+    command = [sys.executable, os.path.join(benchmarkdir, '..', 'fMRS_sliding_window.py'),
+               '--spec='+basename+'.SPAR', '--window='+str(options['window']), '--outdir='+workdir,
+               '--tarquin='+os.path.join(benchmarkdir, 'tarquin')]
+    environment = os.environ.copy(); environment['FAKE_TARQUIN_DELAY'] = str(options['delay'])
+    with open(os.devnull, 'w') as null:
+        stages ('fit', lambda: subprocess.check_call(command, stdout=null, stderr=null, env=environment))
+    return {'fits': options['serial_rows']}
+def native (workdir, options, stages):
+    basename = os.path.join(workdir, 'native')
+    stages ('generate', synthetic.write_SPAR_SDAT, basename, options['rows'], options['samples'])
+    command = [sys.executable, os.path.join(benchmarkdir, '..', 'fMRS_sliding_window.py'),
+               '--spec='+basename+'.SPAR', '--window='+str(options['window']), '--outdir='+workdir,
+               '--backend=native']
+    with open(os.devnull, 'w') as null:
+        stages ('fit', lambda: subprocess.check_call(command, stdout=null, stderr=null))
+    return {'fits': options['rows']}
+def reader (workdir, options, stages):
+    import fMRS_sliding_window
+    rows = options['rows']; samples = options['samples']; window = options['window']
+    basename = os.path.join(workdir, 'reader')
+    stages ('generate', synthetic.write_SPAR_SDAT, basename, rows, samples)
+    sdat = stages ('open', fMRS_sliding_window.PhilipsSDAT, basename+'.SPAR', basename+'.SDAT')
+    stages ('decode', lambda: sdat[:])
+    stages ('average', lambda: [None for average in fMRS_sliding_window.window_averages (sdat, window)])
+    stages ('hsvd', fMRS_sliding_window.remove_water, sdat[:], synthetic.bandwidth, synthetic.frequency*1e-6, options['jobs'])
+    result = {'MB': rows*samples*8/1048576.}
+    if fMRS_sliding_window.import_dicom () != None:
+        stages ('generate_dicom', synthetic.write_DICOM, os.path.join(workdir, 'XX_0001'), rows, samples)
+        fMRS_sliding_window.configure (preaverage=True)
+        try: stages ('read_dicom', fMRS_sliding_window.read_dataset, os.path.join(workdir, 'XX_0001'))
+        except fMRS_sliding_window.InputError as e: result['dicom'] = 'failed: '+str(e)
+    else: result['dicom'] = 'skipped, pydicom not installed'
+    return result
+def accumulate (workdir, options, stages):
+    import fMRS_sliding_window
+    rows = options['rows']; window = options['window']
+    fMRS_sliding_window.configure (windows=[window], basedir=workdir)
+    basename = os.path.join(workdir, 'accumulate')
+    synthetic.write_SPAR_SDAT (basename, 4, options['samples'])
+    with open(os.path.join(workdir, 'avlist.csv'), 'w') as f: f.write('1\n')
+    subprocess.check_call([sys.executable, os.path.join(benchmarkdir, 'tarquin'), '--input', basename+'.SPAR',
+                           '--av_list', os.path.join(workdir, 'avlist.csv'),
+                           '--output_csv', os.path.join(workdir, 'fit_0.csv')], stdout=open(os.devnull, 'w'))
+    def copies ():
+        for n in range(1, rows): shutil.copyfile(os.path.join(workdir, 'fit_0.csv'), os.path.join(workdir, 'fit_'+str(n)+'.csv'))
+    stages ('generate', copies)
+    dataset = {'filename': basename+'.SPAR', 'name': 'accumulate', 'status': 'ok', 'rows': rows,
+               'journal': open(os.devnull, 'w'), 'checkpoint': os.path.join(workdir, 'none'), 
+               'scratch': os.path.join(workdir, 'none')}
+    fMRS_sliding_window.init_fits (dataset)
+    def collect_all ():
+        for n in range(rows-1):
+            fMRS_sliding_window.collect ({'dataset': dataset, 'members': (n+1,), 'targets': [(window, n)],
+                                          'csvfile': os.path.join(workdir, 'fit_'+str(n)+'.csv')})
+        dataset['pending'] += 1 # the last fit failed (--on_fail=nan), written as NaN
+        fMRS_sliding_window.failed_fit ({'dataset': dataset, 'members': (rows,), 'targets': [(window, rows-1)],
+                                         'error': 'benchmark'})
+    stages ('collect', collect_all)
+    stages ('write', fMRS_sliding_window.finish, dataset)
+    return {'fits': rows, 'failed': len(dataset['failures'])}
+def statistics (workdir, options, stages):
+    import fMRS_statistics
+    rows = max(options['rows'], 360) # the default paradigm has 360 dynamics
+    random = numpy.random.RandomState(0)
+    names = ['Row', 'Col', 'Slice']+['M'+str(i) for i in range(30)]
+    values = random.normal(10., 1., (rows, len(names)))
+    values[:,:3] = 1.
+    values[:360,3] += 2.*fMRS_statistics.smooth (fMRS_statistics.default_paradigm (), options['window'])
+    filename = os.path.join(workdir, 'statistics.csv')
+    def write ():
+        numpy.savetxt(filename, values, delimiter=',', header='results\n'+','.join(names), comments='')
+    stages ('generate', write)
+    stages ('import', fMRS_statistics.import_scipy)
+    metabolites, header = stages ('read', fMRS_statistics.read_results, filename)
+    paradigm = numpy.zeros(rows); paradigm[:360] = fMRS_statistics.default_paradigm ()
+    outputs = stages ('correlation', fMRS_statistics.statistics, metabolites, paradigm, options['window'])
+    stages ('surrogates', fMRS_statistics.statistics, metabolites, paradigm, options['window'],
+            60, 1000, 'phase', 0, 1)
+    stages ('glm', fMRS_statistics.statistics, metabolites, paradigm, options['window'],
+            60, 0, 'phase', 0, None, 1, True, 2.)
+    stages ('sweep', fMRS_statistics.sweep, metabolites, paradigm, list(range(1, 51)))
+    stages ('write', fMRS_statistics.write_results, outputs, os.path.join(workdir, 'statistics'), header)
+    return {'metabolites': len(names)-3}
+def group (workdir, options, stages):
+    import fMRS_statistics
+    random = numpy.random.RandomState(0)
+    names = ['Row', 'Col', 'Slice']+['M'+str(i) for i in range(30)]
+    paradigm = fMRS_statistics.default_paradigm ()
+    def write ():
+        for subject in range(options['subjects']):
+            values = random.normal(10., 1., (360, len(names)))
+            values[:,:3] = 1.; values[:,3] += 0.5*fMRS_statistics.smooth (paradigm, options['window'])
+            with open(os.path.join(workdir, 'subject'+str(subject)+'.csv'), 'w') as f:
+                f.write('fMRS_sliding_window v0.1 Results:\n'+','.join(names)+'\n')
+                numpy.savetxt(f, values, delimiter=',')
+    stages ('generate', write)
+    stages ('import', fMRS_statistics.import_scipy)
+    data, header = stages ('read', fMRS_statistics.read_group, fMRS_statistics.find_results (workdir), options['jobs'])
+    stages ('correlation', fMRS_statistics.group_statistics, data, paradigm, options['window'], 60, options['jobs'])
+    outputs = stages ('glm', lambda: fMRS_statistics.group_statistics (data, paradigm, options['window'], 60,
+                      options['jobs'], GLM=True, hrf='none'))
+    stages ('write', fMRS_statistics.write_group, outputs, os.path.join(workdir, 'group'), header, [])
+    return {'subjects': options['subjects'], 'metabolites': len(names)-3}
+def run_scenario (name, options): # in this process, returns the result dict
+    workdir = tempfile.mkdtemp(prefix='fMRS_benchmark_')
+    stdout = sys.stdout; sys.stdout = open(os.devnull, 'w') # the library prints progress
+    stderr = sys.stderr; sys.stderr = open(os.devnull, 'w') # and logs to stderr
+    try:
+        stages = Stages ()
+        result = globals()[name] (workdir, options, stages)
+        wall = time.time()-stages.start
+    finally:
+        sys.stdout.close(); sys.stdout = stdout
+        sys.stderr.close(); sys.stderr = stderr
+        shutil.rmtree(workdir, ignore_errors=True)
+    try: import resource; children = peak_rss (resource.RUSAGE_CHILDREN); own = peak_rss (resource.RUSAGE_SELF)
+    except ImportError: children = None; own = None
+    result.update({'scenario': name, 'wall': wall, 'stages': stages.times,
+                   'peak_rss_MB': own, 'children_peak_rss_MB': children})
+    return result
+
+options = {'rows': 360, 'samples': 2048, 'window': 5, 'serial_rows': 40, 'delay': 0., 'subjects': 100, 'jobs': 4}
+opts, args = getopt(sys.argv[1:], 'h', ['scenarios=', 'scenario=', 'rows=', 'samples=', 'window=',
+                                        'serial_rows=', 'delay=', 'subjects=', 'jobs=', 'json='])
+argDict = dict(opts)
+if '-h' in argDict or len(args)>0:
+    print ('usage: run_benchmarks.py [--scenarios=serial,native,reader,accumulate,statistics,group] [--rows=<n>]')
+    print ('       [--samples=<n>] [--window=<n>] [--serial_rows=<n>] [--delay=<s>] [--subjects=<n>]')
+    print ('       [--jobs=<n>] [--json=<file>]')
+    sys.exit(2)
+for name in ['rows', 'samples', 'window', 'serial_rows', 'subjects', 'jobs']:
+    if '--'+name in argDict: options[name] = int(argDict['--'+name])
+if '--delay' in argDict: options['delay'] = float(argDict['--delay'])
+if '--scenario' in argDict: # internal, run one scenario and report as JSON
+    print (json.dumps(run_scenario (argDict['--scenario'], options)))
+    sys.exit(0)
+if '--scenarios' in argDict: scenarios = argDict['--scenarios'].split(',')
+results = []
+print ('rows=%d samples=%d window=%d serial_rows=%d delay=%gs' % (options['rows'], options['samples'],
+       options['window'], options['serial_rows'], options['delay']))
+print ('%-11s %9s %10s %10s   %s' % ('scenario', 'wall [s]', 'RSS [MB]', 'child [MB]', 'stages [s]'))
+for name in scenarios:
+    command = [sys.executable, os.path.abspath(__file__), '--scenario='+name]
+    command += ['--'+option+'='+str(options[option]) for option in options]
+    result = json.loads(subprocess.check_output(command).decode().strip().split('\n')[-1])
+    results.append(result)
+    print ('%-11s %9.3f %10s %10s   %s' % (name, result['wall'],
+           '%.1f' % result['peak_rss_MB'] if result['peak_rss_MB'] != None else '-',
+           '%.1f' % result['children_peak_rss_MB'] if result['children_peak_rss_MB'] != None else '-',
+           ' '.join(['%s=%.3f' % (stage, seconds) for stage, seconds in result['stages']])))
+    for key in sorted(result):
+        if key not in ['scenario', 'wall', 'stages', 'peak_rss_MB', 'children_peak_rss_MB']:
+            print ('%-11s %s: %s' % ('', key, result[key]))
+if '--json' in argDict:
+    with open(argDict['--json'], 'w') as f: json.dump({'options': options, 'results': results}, f, indent=1)
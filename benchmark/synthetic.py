@@ -0,0 +1,115 @@
+#!/usr/bin/python
+#
+# synthetic - generator of synthetic Philips spectroscopy data for benchmarks
+#
+# writes a dynamic series of single voxel spectra (a few brain metabolites
+# with noise, Glu follows a block paradigm) either as SPAR/SDAT pair or
+# as Philips DICOM spectroscopy file (written by hand, pydicom is not needed)
+#
+# usage: synthetic.py [options] <basename>
+#          --rows=<n>     : number of dynamics (default 360)
+#          --samples=<n>  : points per FID (default 2048)
+#          --dicom        : write <basename> as DICOM instead of SPAR/SDAT
+#          --seed=<n>     : random seed for the noise (default 0)
+#
+
+import sys
+import os
+import struct
+from getopt import getopt
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fMRS_sliding_window import _ieee_to_vax_single_float
+
+frequency = 127.76e6   # Hz, 3T
+bandwidth = 2000.      # Hz
+echo_time = 35.        # ms
+# ppm, amplitude, T2 [s]
+metabolites = {'NAA': (2.01, 10., 0.25), 'Glu': (2.35, 4., 0.15), 'Cr': (3.03, 8., 0.15),
+               'Cho': (3.20, 3., 0.20), 'Ins': (3.56, 5., 0.15), 'water': (4.70, 40., 0.08)}
+
+def fids (rows, samples, seed=0, water=False):
+    # complex FIDs (rows, samples), Glu is 5% higher in the dynamics of the
+    # blocks 60-120, 180-240, ... With water=True the unsuppressed water reference
+    random = numpy.random.RandomState(seed)
+    t = numpy.arange(samples)/bandwidth
+    on = (numpy.arange(rows)//60)%2 == 1
+    data = numpy.zeros((rows, samples), dtype=complex)
+    for name in metabolites:
+        ppm, amplitude, T2 = metabolites[name]
+        if water: amplitude = {'water': 2000.}.get(name, 0.)
+        fid = amplitude*numpy.exp(2j*numpy.pi*(ppm-4.7)*frequency*1e-6*t - t/T2)
+        scale = numpy.ones(rows)
+        if name == 'Glu': scale[on] = 1.05
+        data += scale[:,numpy.newaxis]*fid
+    data += random.normal(0., 0.5, data.shape) + 1j*random.normal(0., 0.5, data.shape)
+    return data
+def write_SPAR_SDAT (basename, rows, samples, seed=0):
+    data = fids (rows, samples, seed)
+    with open(basename+'.SDAT', 'wb') as f:
+        f.write(_ieee_to_vax_single_float(numpy.stack((data.real, data.imag), axis=-1).ravel()))
+    with open(basename+'.SPAR', 'w') as f:
+        f.write('!------------------------------------------------------------------\n')
+        f.write('! synthetic data for benchmarks\n')
+        f.write('!------------------------------------------------------------------\n')
+        f.write('examination_name : benchmark\n')
+        f.write('scan_id : synthetic\n')
+        f.write('synthesizer_frequency : '+str(int(frequency))+'\n')
+        f.write('sample_frequency : '+str(int(bandwidth))+'\n')
+        f.write('echo_time : '+str(echo_time)+'\n')
+        f.write('repetition_time : 2000\n')
+        f.write('averages : 1\n')
+        f.write('samples : '+str(samples)+'\n')
+        f.write('rows : '+str(rows)+'\n')
+        f.write('mix_number : 1\n')
+        f.write('spec_num_col : '+str(samples)+'\n')
+        f.write('spec_num_row : '+str(rows)+'\n')
+        f.write('dim1_pnts : '+str(samples)+'\n')
+        f.write('dim2_pnts : '+str(rows)+'\n')
+    return basename+'.SPAR'
+def _element (group, element, VR, value): # explicit VR little endian
+    if isinstance(value, str):
+        value = value.encode('ascii')
+        if len(value)%2: value += b'\0' if VR == 'UI' else b' '
+    if VR in ['OB', 'OF', 'OW', 'SQ', 'UN', 'UT']:
+        return struct.pack('<HH2s2xI', group, element, VR.encode('ascii'), len(value))+value
+    return struct.pack('<HH2sH', group, element, VR.encode('ascii'), len(value))+value
+def write_DICOM (filename, rows, samples, seed=0):
+    # Philips style MR spectroscopy DICOM, actual and water reference spectrum
+    # as float32 (real, imaginary) in SpectroscopyData
+    data = numpy.stack((fids (rows, samples, seed), fids (rows, samples, seed+1, water=True)))
+    spectro = numpy.stack((data.real, data.imag), axis=-1).astype('<f4').tobytes()
+    SOP_class = '1.2.840.10008.5.1.4.1.1.4.2' # MR Spectroscopy Storage
+    SOP_instance = '1.2.826.0.1.3680043.2.1125.'+str(seed)+'.'+str(rows)+'.'+str(samples)
+    meta = (_element (0x0002, 0x0001, 'OB', b'\0\1') + _element (0x0002, 0x0002, 'UI', SOP_class) +
+            _element (0x0002, 0x0003, 'UI', SOP_instance) +
+            _element (0x0002, 0x0010, 'UI', '1.2.840.10008.1.2.1') + # explicit VR little endian
+            _element (0x0002, 0x0012, 'UI', '1.2.826.0.1.3680043.2.1125.1'))
+    dataset = (_element (0x0008, 0x0008, 'CS', 'ORIGINAL\\PRIMARY\\SPECTROSCOPY\\NONE') +
+               _element (0x0008, 0x0016, 'UI', SOP_class) + _element (0x0008, 0x0018, 'UI', SOP_instance) +
+               _element (0x0008, 0x0060, 'CS', 'MR') + _element (0x0008, 0x0070, 'LO', 'Philips Medical Systems') +
+               _element (0x0018, 0x9052, 'FD', struct.pack('<d', bandwidth)) +
+               _element (0x0018, 0x9098, 'FD', struct.pack('<d', frequency*1e-6)) +
+               _element (0x0018, 0x9127, 'UL', struct.pack('<I', samples)) +
+               _element (0x2001, 0x0010, 'LO', 'Philips Imaging DD 001') +
+               _element (0x2001, 0x1081, 'IS', str(rows)) +
+               _element (0x5600, 0x0020, 'OF', spectro))
+    with open(filename, 'wb') as f:
+        f.write(b'\0'*128+b'DICM')
+        f.write(_element (0x0002, 0x0000, 'UL', struct.pack('<I', len(meta))) + meta)
+        f.write(dataset)
+    return filename
+
+if __name__ == '__main__':
+    rows = 360; samples = 2048; seed = 0; DICOM = False
+    opts, args = getopt(sys.argv[1:], 'h', ['rows=', 'samples=', 'dicom', 'seed='])
+    argDict = dict(opts)
+    if '--rows' in argDict: rows = int(argDict['--rows'])
+    if '--samples' in argDict: samples = int(argDict['--samples'])
+    if '--seed' in argDict: seed = int(argDict['--seed'])
+    if '--dicom' in argDict: DICOM = True
+    if len(args) != 1 or '-h' in argDict: 
+        print ('usage: synthetic.py [--rows=<n>] [--samples=<n>] [--dicom] [--seed=<n>] <basename>'); sys.exit(2)
+    if DICOM: print (write_DICOM (args[0], rows, samples, seed))
+    else: print (write_SPAR_SDAT (args[0], rows, samples, seed))
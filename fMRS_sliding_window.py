@@ -54,52 +54,53 @@ import shutil
 import subprocess
 import time
 import datetime
+import hashlib
+import json
+import socket
+import threading
 from getopt import getopt
 from getopt import GetoptError
-from distutils.version import LooseVersion
 
 import csv
+import tempfile
 import numpy
 
+# tkinter, pydicom and pywin32 are only imported when needed (init_tk, choose_file, 
+# import_dicom, console_close_button), importing this module has no side effects, 
+# main() is the commandline program
 
-TK_installed=True
-try: from tkFileDialog import askopenfilename # Python 2
-except: 
-  try: from tkinter.filedialog import askopenfilename; # Python3
-  except: TK_installed=False
-try: import Tkinter as tk; # Python2
-except: 
-  try: import tkinter as tk; # Python3
-  except: TK_installed=False
-try: import win32gui, win32console
-except: pass #silent  
-
-FNULL = open(os.devnull, 'w')
-old_target, sys.stderr = sys.stderr, FNULL # replace sys.stdout 
-pydicom_installed=True
-try: import dicom
-except: pydicom_installed=False
-sys.stderr = old_target # re-enable
-
-pywin32_installed=True
-try: import win32console, win32gui, win32con
-except: pywin32_installed=True
-
+try: input = raw_input # python 2, input() would evaluate the answer there
+except NameError: pass
 
 if sys.platform=="win32": slash='\\'
 else: slash='/'
 
 def exit (code):
     # cleanup 
-    try: shutil.rmtree(tempdir)
-    except: pass # silent
-    if pywin32_installed:
-        try: # reenable console windows close button (useful if called command line or batch file)
-            hwnd = win32console.GetConsoleWindow()
-            hMenu = win32gui.GetSystemMenu(hwnd, 1)
-            win32gui.DeleteMenu(hMenu, win32con.SC_CLOSE, win32con.MF_BYCOMMAND)
-        except: pass #silent
+    stop_all ()
+    if queue_registration != '': close_queue ()
+    if tempdir != '':
+        try: shutil.rmtree(tempdir)
+        except: pass # silent
+    console_close_button (True) # useful if called command line or batch file
     sys.exit(code)
+def console_close_button (enable): # windows console, requires pywin32
+    if sys.platform!="win32": return
+    try: 
+        import win32console, win32gui, win32con
+        hwnd = win32console.GetConsoleWindow()
+        if enable: hMenu = win32gui.GetSystemMenu(hwnd, 1)
+        else:      hMenu = win32gui.GetSystemMenu(hwnd, 0)
+        win32gui.DeleteMenu(hMenu, win32con.SC_CLOSE, win32con.MF_BYCOMMAND)
+    except: pass #silent
+def import_dicom (): # the pydicom module, None if not installed
+    old_target, sys.stderr = sys.stderr, open(os.devnull, 'w') # silence import warnings
+    try: import pydicom as dicom
+    except:
+        try: import dicom # pydicom before version 1.0
+        except: dicom = None
+    sys.stderr.close(); sys.stderr = old_target # re-enable
+    return dicom
 def signal_handler(signal, frame):
     lprint ('User abort')
     exit(1)
@@ -117,42 +118,606 @@ def expdecay(x,A,T2): # T2 of long component fixed to CSF_T2
     return A*numpy.exp(-x/T2)
 def isDICOM (file):
     try: f = open(file, "rb")
-    except: lprint ('ERROR: opening file'+file); exit(1)
+    except: return False # reading will report the problem
     try:
         test = f.read(128) # through the first 128 bytes away
         test = f.read(4) # this should be "DICM"
         f.close()
     except: return False # on error probably not a DICOM file
-    if test == "DICM": return True 
+    if test == b"DICM": return True 
     else: return False    
-def _get_from_SPAR (input, varstring):
-    if varstring[len(varstring)-1] != ' ': varstring += ' ' # requires final space
-    value = [text.split(':')[1] for text in input if text.split(':')[0]==varstring]
-    if len(value)>0: value = value[0]
-    else: lprint ('ERROR: unable to read parameter "'+varstring+'" in SPAR'); sysexit(1)
-    return value        
+def parse_SPAR (lines): # SPAR "name : value" lines to a dict with int/float/string values
+    header = {}
+    for line in lines:
+        if line.startswith('!') or not ':' in line: continue # comment
+        name, value = line.split(':', 1); value = value.strip()
+        try: value = int(value)
+        except:
+            try: value = float(value)
+            except: pass # string
+        header[name.strip()] = value
+    return header
 def delete (file):
     try: os.remove(file)
     except: pass #silent
+def temp_name (file): # next to file, unique for every process on every node sharing the directory
+    return file+'.'+socket.gethostname()+'-'+str(os.getpid())+'.tmp'
+def replace_file (temp, file): # atomic, readers (other runs, workers, scrapers) never see a partial file
+    if sys.platform=="win32": delete (file) # rename does not overwrite on windows
+    os.rename(temp, file)
+def write_file (file, text): # atomic, see replace_file
+    temp = temp_name (file)
+    with open(temp, 'w') as f: f.write(text)
+    replace_file (temp, file)
+def reset_profile (): # start of the instrumentation, see stage_start/stage_end
+    global profile
+    profile = {'start': time.time(), 'times': os.times(), 'stages': {}, 'tarquin': [], 'datasets': [],
+               'timeouts': 0, 'retries': 0, 'failures': 0, 'queued': 0}
+def stage_start (): # returns the start (wall, CPU) for stage_end
+    times = os.times()
+    return (time.time(), times[0]+times[1])
+def stage_end (name, timer): # adds wall and CPU time since stage_start to the stage name
+    times = os.times()
+    entry = profile['stages'].setdefault(name, {'calls': 0, 'wall': 0., 'cpu': 0.})
+    entry['calls'] += 1
+    entry['wall'] += time.time()-timer[0]
+    entry['cpu'] += times[0]+times[1]-timer[1]
+def peak_memory (): # peak resident memory in bytes of this process and of its children
+    try: import resource # not on windows
+    except ImportError: return None, None
+    if sys.platform == 'darwin': scale = 1 # bytes
+    else: scale = 1024 # kB
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale, 
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*scale)
+def profile_report (): # the instrumentation as dict (JSON)
+    times = os.times(); memory, children_memory = peak_memory ()
+    report = {'program': Program_name, 'version': Program_version, 'timestamp': timestamp,
+              'wall': time.time()-profile['start'], 
+              'cpu': times[0]+times[1]-profile['times'][0]-profile['times'][1],
+              'children_cpu': times[2]+times[3]-profile['times'][2]-profile['times'][3],
+              'peak_memory': memory, 'children_peak_memory': children_memory,
+              'stages': profile['stages'], 'datasets': profile['datasets']}
+    durations = numpy.asarray(profile['tarquin'])
+    if len(durations)>0:
+        report['tarquin'] = {'calls': len(durations), 'total': numpy.sum(durations), 
+                             'mean': numpy.mean(durations), 'max': numpy.amax(durations), 
+                             'durations': [round(duration, 4) for duration in durations]}
+        for quantile in [50, 90, 99]: 
+            report['tarquin']['p'+str(quantile)] = numpy.percentile(durations, quantile)
+        for name in ['timeouts', 'retries', 'failures']: report['tarquin'][name] = profile[name]
+    return report
+def latency_summary (): # TARQUIN run time statistics for the log
+    durations = numpy.asarray(profile['tarquin'])
+    if len(durations)==0: return ''
+    text = 'TARQUIN run time median '+str(round(numpy.median(durations),2))+'s'
+    text += ', 90% '+str(round(numpy.percentile(durations, 90),2))+'s'
+    text += ', 99% '+str(round(numpy.percentile(durations, 99),2))+'s'
+    text += ', max '+str(round(numpy.amax(durations),2))+'s ('+str(len(durations))+' runs'
+    for name in ['timeouts', 'retries', 'failures']:
+        if profile[name]>0: text += ', '+str(profile[name])+' '+name
+    return text+')'
+def write_profile (jsonfile, promfile): # JSON and/or Prometheus text format
+    report = profile_report ()
+    if jsonfile != '':
+        write_file (jsonfile, json.dumps(report, indent=1, sort_keys=True, default=float))
+    if promfile == '': return
+    labels = 'program="'+Program_name+'"'
+    lines = ['# HELP fmrs_run_seconds Wall time of the run', '# TYPE fmrs_run_seconds gauge',
+             'fmrs_run_seconds{'+labels+'} '+repr(report['wall']),
+             '# HELP fmrs_cpu_seconds CPU time of the run', '# TYPE fmrs_cpu_seconds gauge',
+             'fmrs_cpu_seconds{'+labels+',process="self"} '+repr(report['cpu']),
+             'fmrs_cpu_seconds{'+labels+',process="children"} '+repr(report['children_cpu'])]
+    if report['peak_memory'] != None:
+        lines += ['# HELP fmrs_peak_memory_bytes Peak resident memory', '# TYPE fmrs_peak_memory_bytes gauge',
+                  'fmrs_peak_memory_bytes{'+labels+',process="self"} '+str(report['peak_memory']),
+                  'fmrs_peak_memory_bytes{'+labels+',process="children"} '+str(report['children_peak_memory'])]
+    lines += ['# HELP fmrs_stage_seconds Wall time per stage', '# TYPE fmrs_stage_seconds gauge']
+    lines += ['fmrs_stage_seconds{'+labels+',stage="'+name+'"} '+repr(report['stages'][name]['wall']) for name in sorted(report['stages'])]
+    lines += ['# HELP fmrs_stage_cpu_seconds CPU time per stage', '# TYPE fmrs_stage_cpu_seconds gauge']
+    lines += ['fmrs_stage_cpu_seconds{'+labels+',stage="'+name+'"} '+repr(report['stages'][name]['cpu']) for name in sorted(report['stages'])]
+    if len(report['datasets'])>0:
+        lines += ['# HELP fmrs_scan_seconds Wall time per input', '# TYPE fmrs_scan_seconds gauge']
+        lines += ['fmrs_scan_seconds{'+labels+',input="'+dataset['name'].replace('\\','\\\\').replace('"','\\"')+'"} '+
+                  repr(dataset['wall']) for dataset in report['datasets']]
+    if 'tarquin' in report:
+        lines += ['# HELP fmrs_tarquin_seconds Duration of the TARQUIN calls', '# TYPE fmrs_tarquin_seconds summary']
+        lines += ['fmrs_tarquin_seconds{'+labels+',quantile="'+str(quantile/100.)+'"} '+repr(float(report['tarquin']['p'+str(quantile)])) 
+                  for quantile in [50, 90, 99]]
+        lines += ['fmrs_tarquin_seconds_sum{'+labels+'} '+repr(float(report['tarquin']['total'])),
+                  'fmrs_tarquin_seconds_count{'+labels+'} '+str(report['tarquin']['calls'])]
+        for name in ['timeouts', 'retries', 'failures']:
+            lines += ['# HELP fmrs_tarquin_'+name+' TARQUIN '+name+' in the run', '# TYPE fmrs_tarquin_'+name+' gauge',
+                      'fmrs_tarquin_'+name+'{'+labels+'} '+str(report['tarquin'][name])]
+    write_file (promfile, '\n'.join(lines)+'\n') # the file might be scraped any time
 def run (command, parameters):
     string = '"'+command+'" '+parameters
     if debug: logwrite (string)
+    timer = stage_start ()
     process = subprocess.Popen(string, env=my_env,
                   shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     (stdout, stderr) = process.communicate()  
+    stage_end ('run', timer)
     if debug: logwrite (stdout)
     if debug: logwrite (stderr)    
     if process.returncode != 0: 
-        lprint ('ERROR:  returned from "'+os.path.basename(command)+
-                '", for details inspect logfile in debug mode')
-        exit(1)
+        raise RunError ('returned from "'+os.path.basename(command)+'", for details inspect logfile in debug mode')
     return stdout    
-def _vax_to_ieee_single_float(data): # borrowed from the python VeSPA project
-    #Converts a float in Vax format to IEEE format.
+def start (command, parameters, logfile):
+    # non-blocking version of run(), stdout & stderr go to logfile 
+    # (a full pipe would block a process nobody is reading from)
+    if debug: logwrite ('"'+command+'" '+' '.join(parameters))
+    log = open(logfile, 'w')
+    try: process = subprocess.Popen([command]+parameters, env=my_env, stdout=log, stderr=log)
+    except: log.close(); raise RunError ('unable to start "'+os.path.basename(command)+'"')
+    log.close()
+    processes.append(process)
+    return process
+def stop_all ():
+    # terminate all processes still running, no orphans should survive an abort
+    while len(processes)>0:
+        process = processes.pop()
+        try: process.kill(); process.wait()
+        except: pass #silent
+def run_parallel (command, joblist, n_jobs, finished, failed=None, timeout=0, retries=0):
+    # runs all jobs with up to n_jobs concurrent processes, each job is a dict 
+    # with 'parameters' and 'logfile', finished(job) is called on completion.
+    # joblist may be a generator, it is only asked for a new job when a slot is free, 
+    # and may yield None if no job is ready yet.
+    # Processes running longer than timeout seconds (0: no limit) are killed, failed
+    # jobs are started again up to retries times. Jobs that still fail are passed to 
+    # failed(job) with the reason in job['error'], without failed() RunError is raised
+    pending = iter(joblist); running = []; retry = []; exhausted = False
+    while not exhausted or len(running)>0 or len(retry)>0:
+        while (not exhausted or len(retry)>0) and len(running)<n_jobs:
+            if len(retry)>0: job = retry.pop(0)
+            else:
+                try: job = next(pending)
+                except StopIteration: exhausted = True; break
+                if job is None: break # nothing to do right now
+                job['attempts'] = 0
+                if 'message' in job: lprint (job['message'])
+            job['process'] = start(command, job['parameters'], job['logfile'])
+            job['started'] = time.time(); job['attempts'] += 1
+            running.append(job)
+        time.sleep(0.01)
+        now = time.time()
+        for job in [job for job in running if timeout>0 and now-job['started']>timeout]:
+            if job['process'].poll() is None: # not finished in the meantime
+                try: job['process'].kill(); job['process'].wait()
+                except: pass #silent
+                job['timeout'] = True; profile['timeouts'] += 1
+        for job in [job for job in running if job['process'].poll() is not None]:
+            running.remove(job); processes.remove(job['process'])
+            profile['tarquin'].append(now-job['started']) # includes the polling interval
+            if debug: logwrite (open(job['logfile'], 'r').read())
+            if job['process'].returncode != 0: 
+                if job.pop('timeout', False): job['error'] = 'timeout after '+str(timeout)+'s'
+                else: job['error'] = 'exit code '+str(job['process'].returncode)
+                if job['attempts'] <= retries: 
+                    lprint ('Warning: '+describe (job)+' failed ('+job['error']+'), retrying')
+                    profile['retries'] += 1; retry.append(job); continue
+                message = (describe (job)+' failed ('+job['error']+'), returned from "'+
+                           os.path.basename(command)+'", for details inspect logfile in debug mode')
+                profile['failures'] += 1
+                if failed == None: raise RunError (message) # the caller terminates the remaining jobs
+                lprint ('ERROR:  '+message); failed(job)
+            else: finished(job)
+def run_native (joblist, failed=None, batch_size=256):
+    # the native backend instead of run_parallel with TARQUIN: the jobs of joblist (with 
+    # the averaged spectrum in 'fid', see schedule_fits) are fitted with fit_native in 
+    # batches of up to batch_size spectra of the same dataset. Jobs that can not be fitted
+    # are passed to failed(job), without failed() RunError is raised
+    batches = {}
+    for job in joblist:
+        if 'message' in job: lprint (job['message'])
+        dataset = job['dataset']
+        batches.setdefault(id(dataset), []).append(job)
+        if len(batches[id(dataset)]) >= batch_size: fit_batch (batches.pop(id(dataset)), failed)
+    for key in list(batches): fit_batch (batches.pop(key), failed)
+def fit_batch (jobs, failed): # see run_native
+    timer = stage_start ()
+    try: fits = fit_native ([job['fid'] for job in jobs], parse_SPAR (jobs[0]['dataset']['SPAR_lines']), not register)
+    except (KeyError, ValueError, numpy.linalg.LinAlgError) as e: 
+        error = 'native fit: '+e.__class__.__name__+' '+str(e); fits = None
+    stage_end ('fit', timer)
+    for i, job in enumerate(jobs):
+        del job['fid']
+        if fits != None: store (job, fits[i]); continue
+        job['error'] = error
+        profile['failures'] += 1
+        if failed == None: raise RunError (describe (job)+' failed ('+error+')')
+        lprint ('ERROR:  '+describe (job)+' failed ('+error+')'); failed(job)
+# file based work queue (--queue, --worker), a directory on a shared filesystem with
+#   jobs/         <id>.job, JSON with the TARQUIN parameters (paths relative to the queue)
+#   claimed/      <id>.<worker>.job, a job being fitted. Workers claim jobs by renaming
+#                 them from jobs/ (atomic, only one gets it). The modification time is the
+#                 lease that the worker renews while TARQUIN runs, jobs with an expired
+#                 lease (e.g. the worker died) are put back to jobs/ by the coordinator
+#   results/      <id>.csv (the TARQUIN --output_csv) or <id>.failed (the error)
+#   coordinators/ one file per run waiting for results, renewed like the leases
+#   workers/      one file per worker with its number of concurrent fits (--jobs), renewed
+#                 like the leases
+# the coordinator is a normal run with --queue, the inputs of the fits are written to 
+# its temp dir in the queue, it assembles the results when all fits are delivered. It keeps
+# queue_ahead jobs per concurrent fit of the live workers in the queue, the inputs are read
+# (and the results written) as the workers get through them
+queue_ahead = 2
+def open_queue (): # creates the queue directories
+    for name in ['jobs', 'claimed', 'results', 'coordinators', 'workers']:
+        try: os.makedirs(os.path.join(queue_dir, name))
+        except OSError:
+            if not os.path.isdir(os.path.join(queue_dir, name)): 
+                raise RunError ('Problem creating queue dir: '+queue_dir)
+def queue_submit (job): # coordinator, puts a job of schedule_fits in the queue
+    job['queue_id'] = os.path.basename(queue_registration)+'_'+'%06d' % profile['queued']
+    parameters = list(job['parameters']); paths = []
+    for i in range(len(parameters)): # the queue might be mounted elsewhere on other nodes
+        if parameters[i].startswith(queue_dir+slash): 
+            parameters[i] = os.path.relpath(parameters[i], queue_dir); paths.append(i)
+    i = parameters.index('--output_csv')+1
+    parameters[i] = os.path.join('results', job['queue_id']+'.csv'); paths.append(i)
+    description = {'id': job['queue_id'], 'parameters': parameters, 'paths': paths, 'lease': lease,
+                   'members': job['members'], 'targets': job['targets'], 'name': job['dataset']['name']}
+    write_file (os.path.join(queue_dir, 'jobs', job['queue_id']+'.job'), json.dumps(description))
+    queue_jobs[job['queue_id']] = job; profile['queued'] += 1
+def registrations (kind): 
+    # {name: [host, pid, lease, ...]} of the coordinators or workers (kind) that renewed 
+    # their registration within their lease
+    now = time.time(); live = {}
+    for name in os.listdir(os.path.join(queue_dir, kind)):
+        file = os.path.join(queue_dir, kind, name)
+        try: 
+            with open(file, 'r') as f: fields = f.read().split()
+            if now-os.path.getmtime(file) < float(fields[2]): live[name] = fields
+        except (OSError, IOError, ValueError, IndexError): pass # just removed or being written
+    return live
+def renew_registration (file, state): # in a thread until state['stopped'], every lease/4
+    renewed = time.time()
+    while not state['stopped']:
+        if time.time()-renewed > lease/4.:
+            try: os.utime(file, None)
+            except OSError: pass # closed in the meantime
+            renewed = time.time()
+        time.sleep(0.1)
+def expire_leases (): # coordinator, puts its jobs with an expired lease back to jobs/
+    now = time.time()
+    for name in os.listdir(os.path.join(queue_dir, 'claimed')):
+        job_id = name.split('.')[0]
+        if not job_id in queue_jobs: continue # not ours
+        file = os.path.join(queue_dir, 'claimed', name)
+        try: 
+            if now-os.path.getmtime(file) < lease: continue
+            os.rename(file, os.path.join(queue_dir, 'jobs', job_id+'.job'))
+        except OSError: continue # finished in the meantime
+        lprint ('Warning: '+describe (queue_jobs[job_id])+' lease of worker '+name[len(job_id)+1:-4]+
+                ' expired, queued again')
+        profile['retries'] += 1
+def close_queue (): # coordinator, removes its registration and whatever is left of its jobs
+    global queue_registration
+    prefix = os.path.basename(queue_registration)+'_'
+    delete (queue_registration); queue_registration = ''
+    for name in ['jobs', 'results']:
+        for file in os.listdir(os.path.join(queue_dir, name)):
+            if file.startswith(prefix): delete (os.path.join(queue_dir, name, file))
+def run_queue (joblist, finished, failed=None):
+    # the --queue version of run_parallel: the jobs of joblist are put in the queue and
+    # finished(job)/failed(job) are called as workers (--worker, on any node) deliver them
+    global queue_registration
+    open_queue ()
+    queue_registration = os.path.join(queue_dir, 'coordinators', Program_name+'_'+timestamp+ID)
+    write_file (queue_registration, socket.gethostname()+' '+str(os.getpid())+' '+str(lease)+'\n')
+    # renewed in a thread, reading an input or simulating its basis may take longer than the lease
+    state = {'stopped': False}
+    thread = threading.Thread(target=renew_registration, args=(queue_registration, state))
+    thread.daemon = True; thread.start()
+    pending = iter(joblist); exhausted = False; checked = 0.; waiting = False
+    try:
+        while not exhausted or len(queue_jobs)>0:
+            if time.time()-checked > min(1., lease/4.): # workers come and go
+                expire_leases (); checked = time.time()
+                slots = sum([int(fields[3]) for fields in registrations ('workers').values() if len(fields)>3])
+                slots = queue_ahead*max(slots, n_jobs)
+            while not exhausted and len(queue_jobs) < slots: 
+                try: job = next(pending)
+                except StopIteration: exhausted = True; break
+                if job != None: queue_submit (job)
+            results = set(os.listdir(os.path.join(queue_dir, 'results')))
+            delivered = [job_id for job_id in sorted(queue_jobs) if job_id+'.csv' in results or job_id+'.failed' in results]
+            if len(delivered)==0: 
+                if not waiting and len(queue_jobs)>0:
+                    lprint ('Fits queued in '+queue_dir+', waiting for workers'); waiting = True
+                time.sleep(0.1); continue
+            for job_id in delivered:
+                job = queue_jobs.pop(job_id); file = os.path.join(queue_dir, 'results', job_id)
+                if job_id+'.csv' in results: 
+                    job['csvfile'] = file+'.csv'; finished(job); delete (file+'.csv')
+                    if debug: logwrite ('Finished '+describe (job))
+                    continue
+                try: job['error'] = open(file+'.failed', 'r').read().strip()
+                except IOError: job['error'] = 'unknown'
+                delete (file+'.failed')
+                profile['failures'] += 1
+                if failed == None: raise RunError (describe (job)+' failed ('+job['error']+') in a worker')
+                lprint ('ERROR:  '+describe (job)+' failed ('+job['error']+') in a worker'); failed(job)
+    finally: state['stopped'] = True
+    close_queue ()
+def claim_job (worker): # worker, the next job of the queue or None
+    for name in sorted(os.listdir(os.path.join(queue_dir, 'jobs'))):
+        if not name.endswith('.job'): continue # temp file
+        file = os.path.join(queue_dir, 'claimed', name[:-4]+'.'+worker+'.job')
+        try: os.rename(os.path.join(queue_dir, 'jobs', name), file)
+        except OSError: continue # another worker was faster
+        try: os.utime(file, None); description = json.load(open(file, 'r')) # the lease starts now
+        except (OSError, IOError, ValueError): delete (file); continue
+        parameters = description['parameters']
+        for i in description['paths']: parameters[i] = os.path.join(queue_dir, parameters[i])
+        output = parameters[parameters.index('--output_csv')+1]
+        job = {'queue_id': description['id'], 'claimed': file, 'lease': description['lease'], 
+               'members': description['members'], 'targets': description['targets'], 
+               'csvfile': output, 'logfile': tempdir+description['id']+'.log',
+               'message': description['name']+': fitting '+describe ({'members': description['members'], 
+                                                                      'targets': description['targets']})}
+        parameters[parameters.index('--output_csv')+1] = output[:-4]+'.'+worker+'.tmp' # see finished
+        job['parameters'] = parameters
+        return job
+    return None
+def run_worker ():
+    # --worker: claims the jobs of the queue and fits them with run_parallel (--jobs at a
+    # time), until no coordinator is waiting any more. Returns the number of fits done
+    global tempdir
+    open_queue ()
+    worker = socket.gethostname()+'-'+str(os.getpid())
+    try: tempdir = tempfile.mkdtemp(prefix='.'+Program_name+'_worker'+timestamp, dir=basedir)+slash
+    except: raise RunError ('Problem creating temp dir in '+basedir)
+    running = {}; state = {'seen': False, 'idle': 0., 'stopped': False, 'fits': 0}
+    registration = os.path.join(queue_dir, 'workers', worker) # the coordinators queue jobs for its --jobs
+    write_file (registration, socket.gethostname()+' '+str(os.getpid())+' '+str(lease)+' '+str(n_jobs)+'\n')
+    def renew_leases (): 
+        # in a thread, TARQUIN might run much longer than the polling interval. Every job 
+        # is renewed 4 times per lease of the coordinator that queued it
+        renewed = time.time()
+        while not state['stopped']:
+            if time.time()-renewed > lease/4.:
+                try: os.utime(registration, None)
+                except OSError: pass # silent
+                renewed = time.time()
+            for job in list(running.values()):
+                if time.time()-job['renewed'] < job['lease']/4.: continue
+                try: os.utime(job['claimed'], None)
+                except OSError: pass # expired and taken back, the result is delivered anyway
+                job['renewed'] = time.time()
+            time.sleep(0.1)
+    def joblist ():
+        while True:
+            if time.time()-state['idle'] < 0.2: yield None; continue # don't flood the filesystem
+            job = claim_job (worker)
+            if job != None: job['renewed'] = time.time(); running[job['queue_id']] = job; yield job; continue
+            state['idle'] = time.time()
+            if len(registrations ('coordinators'))>0: state['seen'] = True
+            elif state['seen']: return # all coordinators are done
+            yield None
+    def release (job): 
+        del running[job['queue_id']]; delete (job['claimed'])
+    def abandoned (job): # the coordinator is gone (e.g. aborted), nobody collects the result
+        return not os.path.isfile(os.path.join(queue_dir, 'coordinators', job['queue_id'].rsplit('_', 1)[0]))
+    def finished (job):
+        temp = job['parameters'][job['parameters'].index('--output_csv')+1]
+        if abandoned (job): delete (temp); release (job); return
+        try: 
+            replace_file (temp, job['csvfile']); state['fits'] += 1
+        except OSError: 
+            job['error'] = 'no TARQUIN output'; failed (job); return
+        release (job)
+    def failed (job):
+        if not abandoned (job): write_file (job['csvfile'][:-4]+'.failed', job['error']+'\n')
+        release (job)
+    thread = threading.Thread(target=renew_leases); thread.daemon = True; thread.start()
+    lprint ('Worker '+worker+' waiting for jobs in '+queue_dir)
+    try: run_parallel (tarquin_command (), joblist (), n_jobs, finished, failed, timeout, retries)
+    finally: state['stopped'] = True; delete (registration)
+    try: shutil.rmtree(tempdir)
+    except: pass # silent
+    tempdir = ''
+    return state['fits']
+def describe (job): # the fit of a job for messages, e.g. "subject1: dynamics 3-7 (window 5 spectrum 5)"
+    if not 'members' in job: return 'fit'
+    text = 'dynamics '+str(min(job['members']))+'-'+str(max(job['members']))
+    text += ' ('+', '.join(['window '+str(window)+' spectrum '+str(n_spectra+1) for window, n_spectra in job['targets']])+')'
+    if batch != '': text = job['dataset']['name']+': '+text
+    return text
+def tarquin_arguments (inputfile, avlistfile, csvfile, basisfile=None):
+    # avlistfile=None for inputs that already contain the averaged spectrum,
+    # basisfile=None lets TARQUIN simulate the basis, see basis_file
+    arguments =['--input', inputfile]
+    arguments+=['--format', 'philips']
+    if avlistfile != None: arguments+=['--av_list', avlistfile]
+    arguments+=['--output_csv', csvfile]
+    arguments+=['--ref', '4.66', '--max_metab_shift', '0.015']
+    if register: arguments+=['--auto_phase', 'false', '--dyn_freq_corr', 'false'] # see register_fids
+    else: arguments+=['--auto_phase', 'true', '--dyn_freq_corr', 'true']
+    arguments+=['--start_pnt', '20', '--ref_signals', '1h_naa', '--dref_signals', '1h_naa']
+    arguments+=['--pul_seq', 'press']
+    if basisfile != None: arguments+=['--basis_lcm', basisfile]
+    else: arguments+=['--int_basis', '1h_brain']
+    return arguments
+def tarquin_command (): # the TARQUIN executable
+    if tarquin != '': return tarquin
+    return resourcedir+'tarquin' # the one that comes with the program
+def tarquin_hash (): # content hash of the TARQUIN executable, once per run, other version, other fits
+    command = tarquin_command ()
+    if not ('tarquin', command) in basis_files:
+        try: basis_files[('tarquin', command)] = file_hash ([command])
+        except (IOError, OSError): raise RunError ('unable to read "'+command+'"')
+    return basis_files[('tarquin', command)]
+def basis_key (dataset): # the basis of basis_file, from TARQUIN, sequence parameters and options
+    if not 'basis_key' in dataset:
+        header = parse_SPAR (dataset['SPAR_lines'])
+        parameters = [str(header.get(name, '')) for name in ['synthesizer_frequency', 'sample_frequency', 'samples', 'echo_time']]
+        key = ' '.join([tarquin_hash ()]+parameters+tarquin_arguments('', None, ''))
+        dataset['basis_key'] = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return dataset['basis_key']
+def fit_basis (dataset): 
+    # fit_options with the basis the fits of dataset use instead of '<basis>', for the 
+    # cache keys: the simulated one (see basis_file) or, when that failed, TARQUIN's internal
+    if not '<basis>' in fit_options: return fit_options
+    if 'basis' in dataset and dataset['basis'] == None: 
+        return fit_options.replace('--basis_lcm <basis>', '--int_basis 1h_brain')
+    return fit_options.replace('<basis>', basis_key (dataset))
+def basis_file (dataset):
+    # the 1h_brain basis for the sequence parameters of dataset (field, sampling, TE),
+    # simulated by TARQUIN (--output_basis_lcm) once per run, or once for all runs in the
+    # cache dir, and given to all fits (--basis_lcm). None if the simulation fails, 
+    # TARQUIN then simulates the basis in every fit
+    key = basis_key (dataset); command = tarquin_command ()
+    if key in basis_files: return basis_files[key]
+    name = 'basis_'+key+'.basis'; file = tempdir+name # a copy of the run, see cache_lookup
+    cached = cache_dir != '' and cache_lookup (name, file) != None
+    if not cached:
+        lprint ('Simulating basis for '+dataset['name'])
+        timer = stage_start ()
+        temp = temp_name (file) # only complete basis sets, see replace_file
+        if averaged_in_python (): # any dynamic, only the basis is used, as fitted (e.g. truncated)
+            inputfile = write_SPAR_SDAT (dataset['scratch']+'basis_input', numpy.asarray(dataset['fids'][0], dtype=complex), 
+                                         dataset['SPAR_lines']); avlist = None
+        else:
+            inputfile = dataset['filename']; avlist = dataset['scratch']+'basis_avlist.csv' 
+            with open(avlist, 'w') as f: f.write('1\n')
+        arguments = tarquin_arguments(inputfile, avlist, dataset['scratch']+'basis_fit.csv')
+        process = start (command, arguments+['--output_basis_lcm', temp], dataset['scratch']+'basis.log')
+        started = time.time()
+        while process.poll() is None: 
+            if timeout>0 and time.time()-started>timeout: process.kill(); process.wait()
+            time.sleep(0.01)
+        processes.remove(process)
+        stage_end ('basis', timer)
+        if debug: logwrite (open(dataset['scratch']+'basis.log', 'r').read())
+        if process.returncode != 0 or not os.path.isfile(temp):
+            delete (temp)
+            lprint ('Warning: basis simulation failed, TARQUIN simulates it in every fit')
+            file = None
+        else: 
+            replace_file (temp, file)
+            if cache_dir != '': cache_store (name, file)
+    basis_files[key] = file
+    return file
+# simplified 1h_brain basis of the native backend: (name, [(ppm, protons), ...], linewidth 
+# in ppm), J-coupling is not modelled, multiplets are collapsed to their centres.
+# Names and order as in the TARQUIN --output_csv, followed by the combinations
+brain_basis = [('Ala', [(1.47, 3.), (3.78, 1.)], 0.), ('Asp', [(2.65, 1.), (2.80, 1.), (3.89, 1.)], 0.),
+    ('Cr', [(3.03, 3.), (3.91, 2.)], 0.), ('GABA', [(1.89, 2.), (2.28, 2.), (3.01, 2.)], 0.),
+    ('Glc', [(3.43, 2.), (3.52, 1.), (3.80, 2.)], 0.), ('Gln', [(2.12, 2.), (2.44, 2.), (3.75, 1.)], 0.),
+    ('Glth', [(2.15, 2.), (2.55, 2.), (2.95, 2.), (3.77, 2.)], 0.), ('Glu', [(2.08, 2.), (2.35, 2.), (3.75, 1.)], 0.),
+    ('GPC', [(3.21, 9.), (3.61, 2.), (3.67, 2.)], 0.), ('Ins', [(3.27, 1.), (3.52, 2.), (3.61, 2.), (4.05, 1.)], 0.),
+    ('Lac', [(1.31, 3.), (4.10, 1.)], 0.), ('Lip09', [(0.89, 3.)], 0.14), ('Lip13a', [(1.28, 2.)], 0.15),
+    ('Lip13b', [(1.28, 2.)], 0.089), ('Lip20', [(2.04, 1.33), (2.25, 0.67)], 0.15), ('MM09', [(0.91, 3.)], 0.14),
+    ('MM12', [(1.21, 2.)], 0.15), ('MM14', [(1.43, 2.)], 0.17), ('MM17', [(1.67, 2.)], 0.15),
+    ('MM20', [(2.08, 1.33), (2.25, 0.33), (1.95, 0.33), (3.0, 0.4)], 0.15),
+    ('NAA', [(2.01, 3.), (2.49, 1.), (2.67, 1.)], 0.), ('NAAG', [(2.04, 3.), (2.18, 2.), (2.52, 2.)], 0.),
+    ('PCh', [(3.21, 9.), (3.65, 2.)], 0.), ('PCr', [(3.03, 3.), (3.93, 2.)], 0.), ('Scyllo', [(3.34, 6.)], 0.),
+    ('Tau', [(3.25, 2.), (3.42, 2.)], 0.)]
+brain_combinations = [('TNAA', ['NAA', 'NAAG']), ('TCho', ['GPC', 'PCh']), ('TCr', ['Cr', 'PCr']),
+    ('Glx', ['Glu', 'Gln']), ('TLM09', ['Lip09', 'MM09']), ('TLM13', ['Lip13a', 'Lip13b', 'MM12', 'MM14']),
+    ('TLM20', ['Lip20', 'MM20'])]
+# fit model of the native backend, the same as the TARQUIN options in tarquin_arguments
+native_ref = 4.66            # ppm of the receiver frequency (--ref)
+native_ref_signal = 2.01     # NAA (--ref_signals 1h_naa), searched within native_ref_range
+native_ref_range = 0.1       # ppm
+native_start = 20            # first point fitted (--start_pnt)
+native_ppm_range = (0.2, 4.0) # fitted part of the spectrum
+native_linewidths = [2., 4., 6., 8., 11., 15.] # Hz, the one with the smallest residual is used
+def native_basis (samples, bandwidth, frequency, linewidth):
+    # spectra (basis, points) of the brain_basis FIDs from native_start on, frequency in MHz,
+    # computed once per run for each set of parameters
+    key = (samples, bandwidth, frequency, linewidth)
+    if key in native_bases: return native_bases[key]
+    t = numpy.arange(native_start, samples)/bandwidth
+    basis = numpy.zeros((len(brain_basis), samples-native_start), dtype=complex)
+    for i, (name, signals, width) in enumerate(brain_basis):
+        decay = numpy.exp(-numpy.pi*(linewidth+width*frequency)*t)
+        for ppm, protons in signals: basis[i] += protons*numpy.exp(2j*numpy.pi*(ppm-native_ref)*frequency*t)
+        basis[i] *= decay
+    native_bases[key] = numpy.fft.fft(basis, axis=1)
+    return native_bases[key]
+def _nonnegative_lstsq (A, Y):
+    # least squares A x = Y for all columns of Y, components with negative amplitude are 
+    # left out until none is negative (close to NNLS for well separated signals). Spectra 
+    # with the same components share one pseudoinverse
+    x = numpy.zeros((A.shape[1], Y.shape[1])); active = numpy.ones(x.shape, dtype=bool)
+    pending = list(range(Y.shape[1]))
+    while len(pending)>0:
+        patterns = {}
+        for j in pending: patterns.setdefault(active[:,j].tobytes(), []).append(j)
+        pending = []
+        for key in patterns:
+            columns = numpy.asarray(patterns[key]); mask = active[:,columns[0]]
+            solution = numpy.dot(numpy.linalg.pinv(A[:,mask]), Y[:,columns])
+            x[:,columns] = 0.; x[numpy.ix_(mask, columns)] = solution
+            negative = x[:,columns] < 0
+            active[:,columns] &= ~negative
+            pending += [j for j, again in zip(columns, negative.any(axis=0)) if again and active[:,j].any()]
+    return numpy.maximum(x, 0.)
+def fit_native (fids, parameters, auto_phase=True):
+    # fits (spectra, samples) FIDs with the brain_basis, all spectra at once. parameters 
+    # are the SPAR values (see parse_SPAR). auto_phase=False for phased data (register_fids).
+    # Per metabolite shifts (--max_metab_shift) are not modelled. Returns a (header, row, crlb_header, crlb_row) tuple like 
+    # parse_tarquin_csv for every spectrum
+    fids = numpy.atleast_2d(numpy.asarray(fids, dtype=complex))
+    samples = fids.shape[1]
+    bandwidth = float(parameters['sample_frequency'])
+    frequency = float(parameters['synthesizer_frequency'])*1e-6 # MHz
+    t = numpy.arange(samples)/bandwidth
+    # frequency reference, position of the NAA peak in the zero filled and broadened spectrum
+    spectra = numpy.abs(numpy.fft.fft(fids*numpy.exp(-numpy.pi*3.*t), 4*samples, axis=1))
+    hz = numpy.fft.fftfreq(4*samples, 1./bandwidth)
+    search = numpy.nonzero(numpy.abs(native_ref+hz/frequency-native_ref_signal) < native_ref_range)[0]
+    peak = search[numpy.argmax(spectra[:,search], axis=1)]
+    rows = numpy.arange(fids.shape[0])
+    left = spectra[rows, peak-1]; centre = spectra[rows, peak]; right = spectra[rows, (peak+1)%(4*samples)]
+    curvature = left-2*centre+right; curvature[curvature == 0] = -1. # parabolic interpolation
+    shift = hz[peak] + 0.5*(left-right)/curvature*(hz[1]-hz[0]) - (native_ref_signal-native_ref)*frequency
+    fids = fids*numpy.exp(-2j*numpy.pi*shift[:,numpy.newaxis]*t)
+    # the fitted part of the spectrum of the FIDs from native_start on
+    ppm = native_ref+numpy.fft.fftfreq(samples-native_start, 1./bandwidth)/frequency
+    selected = (ppm > native_ppm_range[0]) & (ppm < native_ppm_range[1])
+    Y = numpy.fft.fft(fids[:,native_start:], axis=1)[:,selected]
+    best = numpy.zeros(fids.shape[0]); best[:] = numpy.inf
+    amplitudes = numpy.zeros((len(brain_basis), fids.shape[0])); crlbs = numpy.zeros(amplitudes.shape)
+    combination_crlbs = numpy.zeros((len(brain_combinations), fids.shape[0]))
+    names = [name for name, signals, width in brain_basis]
+    for linewidth in native_linewidths:
+        basis = native_basis (samples, bandwidth, frequency, linewidth)[:,selected]
+        # zero order phase from the unconstrained complex fit (--auto_phase)
+        complex_amplitudes = numpy.dot(Y, numpy.linalg.pinv(basis))
+        phase = 0.5*numpy.angle(numpy.sum(complex_amplitudes**2, axis=1))
+        rotated = complex_amplitudes*numpy.exp(-1j*phase)[:,numpy.newaxis]
+        phase[numpy.sum(rotated.real, axis=1) < 0] += numpy.pi
+        if not auto_phase: phase[:] = 0.
+        phased = Y*numpy.exp(-1j*phase)[:,numpy.newaxis]
+        A = numpy.vstack((basis.real.T, basis.imag.T)); B = numpy.vstack((phased.real.T, phased.imag.T))
+        x = _nonnegative_lstsq (A, B)
+        residual = numpy.sum((numpy.dot(A, x)-B)**2, axis=0)
+        better = residual < best
+        if not better.any(): continue
+        best[better] = residual[better]; amplitudes[:,better] = x[:,better]
+        # Cramer-Rao lower bounds (standard deviations) from the residual variance
+        covariance = numpy.linalg.pinv(numpy.dot(A.T, A))
+        variance = residual[better]/max(A.shape[0]-A.shape[1], 1)
+        crlbs[:,better] = numpy.sqrt(numpy.outer(numpy.diag(covariance), variance))
+        for i, (name, members) in enumerate(brain_combinations):
+            indices = [names.index(member) for member in members]
+            combination_crlbs[i,better] = numpy.sqrt(numpy.sum(covariance[numpy.ix_(indices, indices)])*variance)
+    combinations = numpy.array([numpy.sum(amplitudes[[names.index(member) for member in members]], axis=0) 
+                                for name, members in brain_combinations])
+    amplitudes = numpy.vstack((amplitudes, combinations)); crlbs = numpy.vstack((crlbs, combination_crlbs))
+    header = 'Row,Col,Slice,'+','.join(names+[name for name, members in brain_combinations])+'\n'
+    return [(header, '1,1,1,'+','.join(['%.6e' % value for value in amplitudes[:,n]])+'\n',
+             header, '1,1,1,'+','.join(['%.6e' % value for value in crlbs[:,n]])+'\n') for n in range(fids.shape[0])]
+def _vax_to_ieee_single_float(data): # vectorized version of the one from the python VeSPA project
+    #Converts floats in Vax format to IEEE format.
     #data should be a single string of chars that have been read in from 
     #a binary file. These will be processed 4 at a time into float values.
     #Thus the total number of byte/chars in the string should be divisible
-    #by 4.
+    #by 4. Returns a numpy float64 array.
     #Based on VAX data organization in a byte file, we need to do a bunch of 
     #bitwise operations to separate out the numbers that correspond to the
     #sign, the exponent and the fraction portions of this floating point
@@ -160,24 +725,641 @@ def _vax_to_ieee_single_float(data): # borrowed from the python VeSPA project
     #role :      S        EEEEEEEE      FFFFFFF      FFFFFFFF      FFFFFFFF
     #bits :      1        2      9      10                               32
     #bytes :     byte2           byte1               byte4         byte3    
-    f = []; nfloat = int(len(data) / 4)
-    for i in range(nfloat):
-        byte2 = data[0 + i*4]; byte1 = data[1 + i*4]
-        byte4 = data[2 + i*4]; byte3 = data[3 + i*4]
-        # hex 0x80 = binary mask 10000000
-        # hex 0x7f = binary mask 01111111
-        sign  =  (ord(byte1) & 0x80) >> 7
-        expon = ((ord(byte1) & 0x7f) << 1 )  + ((ord(byte2) & 0x80 ) >> 7 )
-        fract = ((ord(byte2) & 0x7f) << 16 ) +  (ord(byte3) << 8 ) + ord(byte4)
-        if sign == 0: sign_mult = 1.0
-        else: sign_mult = -1.0;
-        if 0 < expon:
-            # note 16777216.0 == 2^24  
-            val = sign_mult * (0.5 + (fract/16777216.0)) * pow(2.0, expon - 128.0)   
-            f.append(val)
-        elif expon == 0 and sign == 0: f.append(0)
-        else: f.append(0) # may want to raise an exception here ...
+    #swapping the two 16bit halves of the little endian uint32 gives exactly this bit order,
+    #which is the IEEE single bit order with an exponent offset by 2 (bias 128 and 0.1F vs 1.F)
+    words = numpy.frombuffer(data, dtype='<u4', count=int(len(data) / 4))
+    words = (words << numpy.uint32(16)) | (words >> numpy.uint32(16))
+    expon = (words >> numpy.uint32(23)) & numpy.uint32(0xff)
+    small = expon <= 2 # zero, reserved operand or below the IEEE single normal range
+    words[small] = 0
+    f = (words - numpy.uint32(2 << 23)).view(numpy.float32).astype(numpy.float64)
+    f[small] = 0
+    small = numpy.nonzero(small & (expon > 0))[0]
+    if len(small)>0: # rare, done the slow way in double precision 
+        words = (numpy.frombuffer(data, dtype='<u4', count=int(len(data) / 4))[small])
+        words = (words << numpy.uint32(16)) | (words >> numpy.uint32(16))
+        fract = words & numpy.uint32(0x7fffff)
+        # note 16777216.0 == 2^24  
+        f[small] = numpy.ldexp(0.5 + (fract/16777216.0), expon[small].astype(numpy.int32) - 128)
+        f[small[(words >> numpy.uint32(31)) == 1]] *= -1.0
     return f 
+def _ieee_to_vax_single_float(data):
+    #Converts an array of floats to a string of VAX format floats, 
+    #the inverse of _vax_to_ieee_single_float (see there for the bit layout)
+    values = numpy.asarray(data, dtype=numpy.float32).astype(numpy.float64)
+    mantissa, exponent = numpy.frexp(numpy.abs(values)) # mantissa is within [0.5,1)
+    expon = exponent+128
+    fract = numpy.round((mantissa-0.5)*16777216.0).astype(numpy.uint32)
+    sign  = (values<0).astype(numpy.uint32)
+    word  = (sign<<31) | (numpy.clip(expon,0,255).astype(numpy.uint32)<<23) | fract
+    word[(values==0) | (expon<=0)] = 0 # underflow
+    return (((word & 0xffff) << 16) | (word >> 16)).astype('<u4').tobytes()
+class PhilipsSDAT (object):
+    # SPAR/SDAT pair, the SPAR is parsed once into the dict "header", the SDAT 
+    # is memory mapped as "data" with shape (rows, samples, 2) of raw VAX floats.
+    # Indexing decodes only the dynamics asked for into complex FIDs, 
+    # e.g. sdat[10] has shape (samples,) and sdat[10:15] (5, samples)
+    def __init__ (self, SPARfile, SDATfile):
+        try: self.SPAR_lines = open(SPARfile, "r").readlines()
+        except: raise InputError ('reading SPAR file')
+        self.header = parse_SPAR (self.SPAR_lines)
+        for name in ['samples', 'rows', 'mix_number']:
+            if not isinstance(self.header.get(name), int): 
+                raise InputError ('unable to read parameter "'+name+'" in SPAR')
+        self.samples = self.header['samples']; self.rows = self.header['rows']
+        try: size = os.path.getsize(SDATfile)
+        except: raise InputError ('reading SDAT file')
+        if size != self.rows*self.samples*2*4: 
+            raise InputError ('SDAT file size does not match SPAR parameters')
+        self.data = numpy.memmap(SDATfile, dtype='<u4', mode='r', shape=(self.rows, self.samples, 2))
+    def __len__ (self): return self.rows
+    def __getitem__ (self, index):
+        words = numpy.ascontiguousarray(self.data[index])
+        data = _vax_to_ieee_single_float(words.ravel().view(numpy.uint8)).reshape(words.shape)
+        return data[...,0] + 1j*data[...,1]
+def write_SPAR_SDAT (basename, fid, SPAR_lines): # single spectrum in Philips format
+    with open(basename+'.SDAT', 'wb') as f:
+        f.write(_ieee_to_vax_single_float(numpy.column_stack((fid.real, fid.imag)).ravel()))
+    with open(basename+'.SPAR', 'w') as f:
+        f.writelines(changed_SPAR (SPAR_lines, ['rows', 'dim2_pnts', 'spec_num_row'], 1))
+    return basename+'.SDAT'
+def changed_SPAR (SPAR_lines, names, value): # SPAR lines with the parameters in names set to value
+    return [line.split(':')[0]+': '+str(value)+'\n' if line.split(':')[0].strip() in names else line 
+            for line in SPAR_lines]
+def parse_windows (string): # e.g. "5", "1,3,5,9" or "1-15", returns sorted list
+    windows = []
+    for part in string.split(','):
+        if '-' in part.strip()[1:]: 
+            first, last = part.split('-',1)
+            windows += range(int(first), int(last)+1)
+        else: windows.append(int(part))
+    return sorted(set(windows))
+def window_members (n_spectra, rows, window): 
+    # dynamics (counting from 1) that are averaged for spectrum n_spectra (counting from 0)
+    first = n_spectra+1-int(window/2)
+    return [number for number in range(first, first+window) if number>0 and number<=rows]
+register_range = 0.2 # ppm, largest frequency shift of a dynamic searched by register_fids
+def register_fids (fids, bandwidth, frequency, iterations=2):
+    # frequency and zero order phase alignment of all dynamics (rows, samples) to their
+    # mean in one go, instead of TARQUIN's --dyn_freq_corr and --auto_phase in every
+    # window. Frequency from the cross correlation of the magnitude spectra, phase from
+    # their complex inner product, both over 1.8-4.2 ppm. The mean is then phased for the
+    # least negative absorption over native_ppm_range. frequency in MHz. Returns the 
+    # corrected FIDs, the shifts (Hz) and phases (rad) applied
+    fids = numpy.array(fids, dtype=complex); rows, samples = fids.shape
+    t = numpy.arange(samples)/bandwidth; apodization = numpy.exp(-numpy.pi*3.*t) # 3Hz
+    apodization[0] = 0.5 # no baseline offset from the first point
+    n = 4*samples # zero filled
+    hz = numpy.fft.fftfreq(n, 1./bandwidth); ppm = native_ref+hz/frequency
+    selected = (ppm > 1.8) & (ppm < 4.2)
+    lags = numpy.fft.fftfreq(n, 1./n) # cross correlation lag in points
+    search = numpy.abs(lags) <= register_range*frequency/(hz[1]-hz[0])
+    shifts = numpy.zeros(rows); phases = numpy.zeros(rows); index = numpy.arange(rows)
+    for iteration in range(iterations): # the second pass with the mean of the aligned data
+        spectra = numpy.fft.fft(fids*apodization, n, axis=1)
+        reference = numpy.mean(spectra, axis=0)
+        magnitude = numpy.where(selected, numpy.abs(spectra), 0.)
+        correlation = numpy.fft.ifft(numpy.fft.fft(magnitude, axis=1)*
+                      numpy.conj(numpy.fft.fft(numpy.where(selected, numpy.abs(reference), 0.))), axis=1).real
+        correlation[:,~search] = -numpy.inf
+        peak = numpy.argmax(correlation, axis=1)
+        left = correlation[index, peak-1]; centre = correlation[index, peak]; right = correlation[index, (peak+1)%n]
+        curvature = left-2*centre+right
+        offset = numpy.zeros(rows) # parabolic interpolation, not at the edge of the search
+        inside = numpy.isfinite(curvature) & (curvature < 0)
+        offset[inside] = numpy.clip(0.5*(left-right)[inside]/curvature[inside], -0.5, 0.5)
+        shift = (lags[peak]+offset)*(hz[1]-hz[0])
+        fids *= numpy.exp(-2j*numpy.pi*shift[:,numpy.newaxis]*t)
+        spectra = numpy.fft.fft(fids*apodization, n, axis=1)[:,selected]
+        phase = numpy.angle(numpy.dot(spectra, numpy.conj(reference[selected])))
+        fids *= numpy.exp(-1j*phase)[:,numpy.newaxis]
+        shifts += shift; phases += phase
+    selected = (ppm > native_ppm_range[0]) & (ppm < native_ppm_range[1])
+    mean = numpy.fft.fft(numpy.mean(fids, axis=0)*apodization, n)[selected]
+    candidates = numpy.radians(numpy.arange(-180., 180., 0.5))
+    real = (mean[numpy.newaxis,:]*numpy.exp(-1j*candidates)[:,numpy.newaxis]).real
+    phase = candidates[numpy.argmin(numpy.sum(numpy.minimum(real, 0.)**2, axis=1))]
+    fids *= numpy.exp(-1j*phase)
+    return fids, shifts, phases+phase
+# residual water removal (--hsvd), HSVD of the FID points from native_start on, 
+# the components within hsvd_water_range are subtracted from every dynamic
+hsvd_points = 256             # points modelled, the Hankel matrix is (hsvd_points/2, hsvd_points/2+1)
+hsvd_components = 20          # model order
+hsvd_water_range = (4.2, 5.2) # ppm
+hsvd_max_linewidth = 100.     # Hz, broader components are not removed (they grow back to point 0)
+def remove_water (fids, bandwidth, frequency, n_jobs=1, chunk=32):
+    # HSVD water removal of all dynamics (rows, samples) at once, frequency in MHz. The 
+    # SVDs of chunk dynamics are one batched call, the chunks run on n_jobs threads
+    # (LAPACK does not hold the GIL). Frequencies and dampings from the shift invariance 
+    # of the signal subspace, amplitudes (at native_start) by least squares. Returns the 
+    # FIDs without the water components and the summed water amplitude per dynamic
+    fids = numpy.array(fids, dtype=complex); rows, samples = fids.shape
+    N = min(hsvd_points, samples-native_start); L = N//2; K = min(hsvd_components, L-1)
+    hankel = numpy.arange(L)[:,numpy.newaxis] + numpy.arange(N-L+1)
+    t = numpy.arange(samples)[:,numpy.newaxis]-native_start # in points
+    narrow = numpy.exp(-numpy.pi*hsvd_max_linewidth/bandwidth) # smallest |pole| removed
+    water = numpy.zeros(rows); chunks = [slice(i, min(i+chunk, rows)) for i in range(0, rows, chunk)]
+    def hsvd (dynamics):
+        x = fids[dynamics, native_start:native_start+N]; index = numpy.arange(x.shape[0])[:,numpy.newaxis]
+        U = numpy.linalg.svd(x[:,hankel], full_matrices=False)[0][:,:,:K] # signal subspace
+        z = numpy.linalg.eigvals(numpy.matmul(numpy.linalg.pinv(U[:,:-1]), U[:,1:])) # poles
+        z[z == 0] = 1e-12 # log
+        ppm = native_ref+numpy.angle(z)*bandwidth/(2*numpy.pi)/frequency
+        removed = ((ppm > hsvd_water_range[0]) & (ppm < hsvd_water_range[1]) & 
+                   (numpy.abs(z) <= 1.) & (numpy.abs(z) >= narrow))
+        amplitudes = numpy.matmul(numpy.linalg.pinv(numpy.exp(numpy.log(z)[:,numpy.newaxis,:]*t[native_start:native_start+N])),
+                                  x[:,:,numpy.newaxis])[:,:,0]
+        # the water model over all points, from the removed components only (sorted first)
+        order = numpy.argsort(~removed, axis=1, kind='mergesort')[:,:max(1, numpy.amax(numpy.sum(removed, axis=1)))]
+        amplitudes = numpy.where(removed[index, order], amplitudes[index, order], 0.)
+        model = numpy.exp(numpy.log(z[index, order])[:,numpy.newaxis,:]*t) # (dynamics, samples, removed)
+        fids[dynamics] -= numpy.matmul(model, amplitudes[:,:,numpy.newaxis])[:,:,0]
+        water[dynamics] = numpy.abs(numpy.sum(amplitudes, axis=1))
+    errors = []
+    def worker ():
+        while True:
+            try: dynamics = chunks.pop(0) # atomic
+            except IndexError: return
+            try: hsvd (dynamics)
+            except numpy.linalg.LinAlgError as e: errors.append(e); return
+    threads = [threading.Thread(target=worker) for i in range(max(1, min(n_jobs, len(chunks))))]
+    for thread in threads: thread.daemon = True; thread.start()
+    for thread in threads: thread.join()
+    if len(errors)>0: raise errors[0]
+    return fids, water
+def preprocessing (): # the options of the python preprocessing, part of fit_options
+    options = ''
+    if hsvd: options += ' hsvd '+' '.join([str(value) for value in [native_start, hsvd_points, hsvd_components, hsvd_water_range]])
+    if apodize>0: options += ' apodize '+str(apodize)
+    if truncate>0: options += ' truncate '+str(truncate)
+    return options
+def averaged_in_python (): # the windows are averaged here, not by TARQUIN (av_list)
+    return preaverage or register or backend == 'native' or preprocessing () != ''
+def window_averages (fids, window):
+    # generator of all sliding window averages in O(rows) using a running sum over the
+    # complex FIDs, the n-th average is over window_members(n, rows, window).
+    # fids can be a (rows, samples) array or a PhilipsSDAT, every dynamic is
+    # decoded once and only the dynamics of the current window are kept in memory
+    rows = len(fids); total = 0.; first = 0; last = 0; window_fids = {}
+    for n_spectra in range(rows):
+        while last < min(rows, n_spectra-int(window/2)+window): # dynamics entering
+            window_fids[last] = numpy.asarray(fids[last], dtype=complex)
+            total = total + window_fids[last]; last += 1
+        while first < max(0, n_spectra-int(window/2)):          # dynamics leaving
+            total = total - window_fids.pop(first); first += 1
+        yield total / (last-first)
+def file_hash (files): # content hash over all input files
+    sha = hashlib.sha1()
+    for file in files:
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1048576), b''): sha.update(chunk)
+    return sha.hexdigest()
+def cache_key (input_hash, members, fit_options, program=''): 
+    # a fit is defined by the input data, the dynamics averaged, the TARQUIN options 
+    # and the TARQUIN executable (program, see tarquin_hash)
+    string = input_hash+' '+','.join([str(number) for number in sorted(members)])+' '+fit_options
+    if program != '': string += ' '+program
+    return hashlib.sha1(string.encode('utf-8')).hexdigest()
+def cache_lookup (name, copy=None): 
+    # the lines of the cache entry name, or with copy a copy of it (returns copy), None if
+    # not cached. Read at once, another run sharing the cache might evict it any time
+    file = os.path.join(cache_dir, name)
+    try: 
+        if copy != None: shutil.copyfile(file, copy); result = copy
+        else:
+            with open(file, 'r') as f: result = f.readlines()
+    except (IOError, OSError): 
+        if copy != None: delete (copy)
+        return None
+    try: os.utime(file, None) # mark as recently used
+    except: pass #silent
+    return result
+def cache_store (name, file):
+    target = os.path.join(cache_dir, name)
+    temp = temp_name (target) # other runs might share the cache
+    try: shutil.copyfile(file, temp); replace_file (temp, target)
+    except: delete (temp); logwrite ('Warning: unable to store '+name+' in cache')
+def cache_evict (max_bytes): # delete least recently used entries (fits and basis sets) beyond max_bytes
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.tmp'): continue # written by a running process
+        try: stat = os.stat(os.path.join(cache_dir, name))
+        except: continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum([entry[1] for entry in entries])
+    for mtime, size, name in sorted(entries):
+        if total <= max_bytes: break
+        delete (os.path.join(cache_dir, name)); total -= size
+def init_tk (): # hidden tkinter root window for the file dialog, None if impossible
+    try: import Tkinter as tk # Python2
+    except: 
+        try: import tkinter as tk # Python3
+        except: return None
+    try: 
+        TKwindows = tk.Tk(); TKwindows.withdraw() #hiding tkinter window
+        TKwindows.update()
+    except: return None
+    # the following tries to disable showing hidden files/folders under linux
+    try: TKwindows.tk.call('tk_getOpenFile', '-foobarz')
+    except: pass
+    try: TKwindows.tk.call('namespace', 'import', '::tk::dialog::file::')
+    except: pass
+    try: TKwindows.tk.call('set', '::tk::dialog::file::showHiddenBtn', '1')
+    except: pass
+    try: TKwindows.tk.call('set', '::tk::dialog::file::showHiddenVar', '0')
+    except: pass
+    TKwindows.update()
+    return TKwindows
+def choose_file (title): # interactive file dialog, None if tkinter is not available
+    TKwindows = init_tk ()
+    if TKwindows == None: return None
+    try: from tkFileDialog import askopenfilename # Python 2
+    except: from tkinter.filedialog import askopenfilename # Python3
+    filename = askopenfilename(title=title)
+    TKwindows.update()
+    try: 
+        import win32gui, win32console
+        win32gui.SetForegroundWindow(win32console.GetConsoleWindow())
+    except: pass #silent
+    return filename
+def _dicom_samples (Dset): # SpectroscopyData as float32 array, a view of the bytes read
+    value = Dset[0x5600,0x0020].value
+    if isinstance(value, bytes): 
+        if Dset.is_little_endian: return numpy.frombuffer(value, dtype='<f4')
+        return numpy.frombuffer(value, dtype='>f4')
+    return numpy.asarray(value, dtype=numpy.float32) # older pydicom, list of floats
+class InputError (Exception): pass # problem reading an input dataset, see message
+class RunError (Exception): pass # the run can not go on (e.g. a fit failed with --on_fail=abort), see message
+def read_dataset (filename): 
+    # reads the parameters (with preaverage also the FIDs) of a SPAR/SDAT
+    # or DICOM spectro file into a dict, problems raise InputError
+    dataset = {'filename': filename, 'SPAR_Input': True}
+    if isDICOM (filename):  # read DICOM  
+        dataset['SPAR_Input']=False
+        dicom = import_dicom ()
+        if dicom == None: raise InputError ('reading DICOM requires the "pydicom" library')
+        read = getattr(dicom, 'dcmread', None) or dicom.read_file
+        try: Dset = read(filename, defer_size=1024) # the samples are only read when used
+        except: raise InputError ('reading DICOM file')
+        # do some checks
+        try: Modality=str(Dset.Modality) # must be MR           
+        except: raise InputError ('Unable to determine DICOM Modality')
+        if Modality!='MR': raise InputError ('DICOM Modality not MR')
+        try: Manufacturer=str(Dset.Manufacturer) # currently Philips only
+        except: raise InputError ('Unable to determine Manufacturer')
+        if not Manufacturer.find("Philips")>=0: 
+            raise InputError ('Currently only Philips DICOM implemented')
+        try: ImageType=str(Dset.ImageType) # sanity check: spectroscopy   
+        except: raise InputError ('Unable to determine if DICOM containes spectroscopy data')
+        if not ImageType.find("SPECTROSCOPY")>=0: 
+            raise InputError ('DICOM file does not contain spectroscopy data')
+        # start reading data from DICOM
+        ReIm=2 # real and imagininary parts
+        try: samples=Dset.SpectroscopyAcquisitionDataColumns # n_points in time/frequency domain
+        except: raise InputError ('reading number of samples from DICOM file')
+        try: rows=Dset[0x2001,0x1081].value #NumberOfDynamicScans
+        except: raise InputError ('reading number of dynamics from DICOM file')
+        if rows<=1: raise InputError ('not a multi TE aquisition')
+        # check if number of points is correct, from the length of the (deferred) element
+        try: ndata_points = Dset.get_item((0x5600,0x0020)).length//4 # 32 bit floats
+        except: 
+            try: ndata_points = len(_dicom_samples (Dset))
+            except: raise InputError ('reading spectroscopy data from DICOM file')
+        if ndata_points==2*rows*samples*ReIm: 
+            ActRef=2 # two spectra, actual and water, this is the normal case
+        elif ndata_points==rows*samples*ReIm: 
+            ActRef=1 # only one spectrum
+        else: 
+            raise InputError ('Unexpected number of total datapoints')
+        # parameters needed to write the averages as SPAR/SDAT 
+        try: SPAR_lines = ['samples : '+str(samples)+'\n', 'rows : '+str(rows)+'\n',
+               'synthesizer_frequency : '+str(int(round(float(Dset.TransmitterFrequency)*1e6)))+'\n',
+               'sample_frequency : '+str(int(round(float(Dset.SpectralWidth))))+'\n', 'mix_number : 1\n']
+        except: SPAR_lines = []
+        try: SPAR_lines += ['echo_time : '+str(float(Dset.SharedFunctionalGroupsSequence[0].
+                            MREchoSequence[0].EffectiveEchoTime))+'\n']
+        except: pass # TARQUIN falls back to its default
+        dataset['files'] = [filename]
+    else: # read SDAT
+        # find SPAR/SDAT pair
+        path=os.path.dirname(filename)
+        name=os.path.splitext(os.path.basename(filename))[0]
+        ext=os.path.splitext(os.path.basename(filename))[1]
+        if ext.lower() == ".spar": 
+            SPARfile=filename 
+            SDATfile=[f for f in os.listdir(path) if f.lower().endswith('.sdat') and f.startswith(name)]
+            if len(SDATfile)==0: raise InputError ('SDAT file for "'+filename+'" not found')
+            SDATfile=os.path.join(path, SDATfile[0])
+        elif ext.lower() == ".sdat":
+            SDATfile=filename 
+            SPARfile=[f for f in os.listdir(path) if f.lower().endswith('.spar') and f.startswith(name)]
+            if len(SPARfile)==0: raise InputError ('SPAR file for "'+filename+'" not found')
+            SPARfile=os.path.join(path, SPARfile[0])
+        else: raise InputError ('file extension should be SDAT/SPAR')
+        # open SPAR and map SDAT
+        sdat = PhilipsSDAT (SPARfile, SDATfile); SPAR_lines = sdat.SPAR_lines
+        samples = sdat.samples; rows = sdat.rows; ActRef = sdat.header['mix_number']
+        if ActRef != 1: 
+            raise InputError ('SPAR/SDAT file seems to be a reference spectrum, choose an actual spectrum')
+        # guess missing data not contained in the SPAR file
+        ReIm=2   # real and imagininary parts
+        dataset['files'] = [SPARfile, SDATfile]
+    dataset.update ({'rows': rows, 'samples': samples, 'SPAR_lines': SPAR_lines})
+    logwrite ('Reading File '+filename)   
+    if averaged_in_python (): # the windows are averaged here
+        if dataset['SPAR_Input']: fids = sdat # decoded when averaged
+        else:
+            if len(SPAR_lines)==0: raise InputError ('reading spectral parameters from DICOM file')
+            try: floats = _dicom_samples (Dset) # read data
+            except: raise InputError ('reading spectroscopy data from DICOM file')
+            # (real, imaginary) float pairs as complex, still the buffer read from the file
+            fids = floats.view(floats.dtype.byteorder+'c8').reshape(ActRef, rows, samples)
+            fids = fids[0] # actual spectrum, skip water reference
+        if register or preprocessing () != '':
+            header = parse_SPAR (SPAR_lines)
+            try: bandwidth = float(header['sample_frequency']); frequency = float(header['synthesizer_frequency'])*1e-6
+            except: raise InputError ('reading spectral parameters for preprocessing')
+        if preprocessing () != '': # once for every dynamic, not in every window
+            timer = stage_start ()
+            fids = numpy.array(fids[:], dtype=complex)
+            if hsvd: 
+                try: fids, water = remove_water (fids, bandwidth, frequency, n_jobs)
+                except numpy.linalg.LinAlgError as e: raise InputError ('HSVD water removal failed ('+str(e)+')')
+                logwrite ('Removed water from '+str(rows)+' dynamics, amplitude '+str(round(numpy.amin(water),2))+
+                          ' to '+str(round(numpy.amax(water),2)))
+                dataset['preprocessing'] = {'water_amplitudes': water}
+            if apodize>0: fids *= numpy.exp(-numpy.pi*apodize*numpy.arange(samples)/bandwidth)
+            if truncate>0 and truncate<samples: 
+                fids = fids[:,:truncate]; samples = truncate; SPAR_lines = changed_SPAR (SPAR_lines, ['samples', 'spec_num_col', 'dim1_pnts'], samples)
+                dataset.update ({'samples': samples, 'SPAR_lines': SPAR_lines})
+            stage_end ('preprocess', timer)
+        if register: # all dynamics are aligned before averaging
+            timer = stage_start ()
+            fids, shifts, phases = register_fids (fids[:], bandwidth, frequency)
+            stage_end ('register', timer)
+            logwrite ('Registered '+str(rows)+' dynamics, frequency shifts '+str(round(numpy.amin(shifts),2))+
+                      ' to '+str(round(numpy.amax(shifts),2))+' Hz')
+            dataset['registration'] = {'frequency_shifts': shifts, 'phase_shifts': phases}
+        dataset['fids'] = fids
+    return dataset
+def find_inputs (path):
+    # spectro files for batch mode, either all SPAR and DICOM (XX*) files in a directory
+    # tree or the files listed in a manifest. Returns (file, output name) tuples, the
+    # output name is the path relative to the tree/manifest with "_" as separator
+    inputs = []
+    if os.path.isdir(path): 
+        root = path
+        for dirpath, dirnames, files in os.walk(path):
+            dirnames.sort()
+            for name in sorted(files):
+                file = os.path.join(dirpath, name)
+                if name.lower().endswith('.spar'): inputs.append(file)
+                elif name.upper().startswith('XX') and isDICOM(file): inputs.append(file)
+    else: 
+        root = os.path.dirname(path)
+        for line in open(path, 'r'):
+            line = line.strip()
+            if line == '' or line.startswith('#'): continue # comment
+            inputs.append(os.path.abspath(os.path.join(root, line)))
+    names = []
+    for file in inputs:
+        parts = os.path.splitext(os.path.relpath(file, root))[0].split(os.sep)
+        names.append('_'.join([part for part in parts if part not in ['', '.', '..']]))
+    return list(zip(inputs, names))
+def open_checkpoint (dataset, input_hash):
+    # journal of the finished fits of a dataset in outdir, one line per fit with the
+    # dynamics, TARQUIN header, result row, CRLB header and CRLB row. Returns {dynamics: fit}
+    # of the fits an earlier run of the same input and options has journaled (--resume)
+    file = basedir+dataset['name']+'.checkpoint'; dataset['checkpoint'] = file
+    key = '# '+Program_name+' checkpoint '+cache_key (input_hash, [], fit_options)+'\n'
+    done = {}
+    if resume and os.path.isfile(file):
+        lines = open(file, 'r').readlines()
+        if len(lines)>0 and lines[0] == key:
+            for line in lines[1:]:
+                fields = line.split('\t')
+                if len(fields)!=5 or not line.endswith('\n'): continue # cut off by an abort
+                fit = [field.rstrip('\n')+'\n' for field in fields[1:5]]
+                if fit[2] == '\n': fit[2:4] = ['', ''] # no CRLBs
+                done[tuple([int(number) for number in fields[0].split()])] = tuple(fit)
+        else: lprint (dataset['name']+': checkpoint is from a different input or options, ignored')
+    if len(done)>0: dataset['journal'] = open(file, 'a')
+    else: dataset['journal'] = open(file, 'w'); dataset['journal'].write(key)
+    return done
+def init_fits (dataset): 
+    # the bookkeeping of the fits of a dataset that collect, store and finish rely on
+    dataset.update ({'results': dict([(sliding_window, [None]*dataset['rows']) for sliding_window in windows]), 
+                     'pending': 0, 'fits': 0, 'cached': 0, 'resumed': 0, 'scheduled': False, 'failures': []})
+    dataset.setdefault('started', time.time()); dataset.setdefault('outputs', [])
+def schedule_fits (dataset):
+    # generator of the TARQUIN jobs for all windows of a dataset. Every distinct set 
+    # of dynamics is fitted only once, windows truncated at the edges of the series
+    # are often identical for several window sizes. Cached and checkpointed fits 
+    # are collected directly
+    rows = dataset['rows']; fits = {}
+    init_fits (dataset)
+    timer = stage_start ()
+    input_hash = file_hash (dataset['files'])
+    stage_end ('hash', timer)
+    done = open_checkpoint (dataset, input_hash)
+    for sliding_window in windows:
+        if averaged_in_python (): averages = window_averages (dataset['fids'], sliding_window)
+        for n_spectra in range(rows):
+            if dataset['status'] != 'ok': break # after a failed fit, skip the rest
+            if averaged_in_python (): 
+                timer = stage_start (); average = next(averages); stage_end ('average', timer)
+            members = tuple(window_members (n_spectra, rows, sliding_window))
+            if members in fits: 
+                job = fits[members]; job['targets'].append((sliding_window, n_spectra))
+                if 'fit' in job: assign (job, sliding_window, n_spectra)
+                continue
+            job = {'dataset': dataset, 'members': members, 'targets': [(sliding_window, n_spectra)]}
+            fits[members] = job; dataset['fits'] += 1
+            if members in done: 
+                store (job, done[members]); dataset['resumed'] += 1; continue
+            if cache_dir != '' and backend != 'native':
+                key = cache_key (input_hash, members, fit_basis (dataset), tarquin_hash ())
+                cached = cache_lookup (key+'.csv')
+                if cached != None: 
+                    timer = stage_start (); fit = parse_tarquin_csv (cached); stage_end ('parse', timer)
+                    store (job, fit); dataset['cached'] += 1; continue
+                job['key'] = key
+            number = str(dataset['fits']); space=''
+            if n_spectra<9: space=' '
+            if backend == 'native': job['fid'] = average # fitted in this process, see run_native
+            else:
+                timer = stage_start ()
+                if averaged_in_python (): # TARQUIN gets a single spectrum
+                    inputfile = write_SPAR_SDAT (dataset['scratch']+'window_'+number, average, 
+                                                 dataset['SPAR_lines'])
+                    avlist = None
+                else: # TARQUIN averages the dynamics listed in avlist
+                    inputfile = dataset.get('queue_input', dataset['filename'])
+                    avlist = dataset['scratch']+'avlist_'+number+'.csv'
+                    avfile = open(avlist, 'w')
+                    for dynamic in members: avfile.write(str(dynamic)+"\n")  
+                    avfile.close()
+                stage_end ('prepare', timer)
+                job['csvfile'] = dataset['scratch']+'tarquin_fMRS_fit_'+number+'.csv'
+                job['logfile'] = dataset['scratch']+'tarquin_'+number+'.log'
+                if not 'basis' in dataset: # simulated when the first fit is needed
+                    dataset['basis'] = None
+                    if reuse_basis: dataset['basis'] = basis_file (dataset)
+                if 'key' in job: job['key'] = cache_key (input_hash, members, fit_basis (dataset), tarquin_hash ())
+                job['parameters'] = tarquin_arguments(inputfile, avlist, job['csvfile'], dataset['basis'])
+            job['new'] = True
+            job['message'] = 'Processing spectrum '+space+str(n_spectra+1)+' of '+str(rows)
+            if len(windows)>1: job['message'] += ' (window '+str(sliding_window)+')'
+            if batch != '': job['message'] = dataset['name']+': '+job['message']
+            dataset['pending'] += 1
+            yield job
+    if averaged_in_python (): del dataset['fids']
+    if dataset['resumed']>0: 
+        lprint (dataset['name']+': resumed '+str(dataset['resumed'])+' of '+str(dataset['fits'])+' fits from checkpoint')
+    dataset['scheduled'] = True
+    if dataset['pending'] == 0: finish (dataset)
+def parse_tarquin_csv (lines):
+    # TARQUIN --output_csv has a title, header and result row for the signal amplitudes,
+    # followed by the same for the CRLBs. Returns (header, row, crlb_header, crlb_row),
+    # the CRLB lines are '' when not present
+    crlb_header = ''; crlb_row = ''
+    for i in range(3, len(lines)-2):
+        if lines[i].upper().startswith('CRLB'): crlb_header = lines[i+1]; crlb_row = lines[i+2]; break
+    return (lines[1], lines[2], crlb_header, crlb_row)
+def _to_floats (row, n): # CSV row to n floats, NaN where missing or not a number
+    values = numpy.zeros(n); values[:] = numpy.nan
+    for i, text in enumerate(row.split(',')[:n]):
+        try: values[i] = float(text)
+        except: pass
+    return values
+def collect (job): # read back TARQUIN results
+    timer = stage_start ()
+    if 'key' in job: cache_store (job['key']+'.csv', job['csvfile'])
+    with open(job['csvfile'], 'r') as csvfile:
+        data = csvfile.readlines()   
+    fit = parse_tarquin_csv (data)
+    stage_end ('parse', timer)
+    store (job, fit)
+def store (job, fit): # results are stored in dynamic order
+    dataset = job['dataset']
+    header, row, crlb_header, crlb_row = fit
+    if not 'header' in dataset: # preallocate the numeric results
+        dataset['header'] = header; dataset['crlb_header'] = crlb_header
+        fields = row.rstrip('\r\n').split(',') # row of failed fits, see failed_fit
+        dataset['nan_row'] = ','.join(fields[:3]+['nan']*(len(fields)-3))+row[len(row.rstrip('\r\n')):]
+        for name, line in [('values', header), ('crlbs', crlb_header)]:
+            dataset[name] = {}
+            for sliding_window in windows:
+                dataset[name][sliding_window] = numpy.zeros((dataset['rows'], len(line.split(','))))
+                dataset[name][sliding_window][:] = numpy.nan
+    job['fit'] = fit
+    job['values'] = _to_floats (row, len(dataset['header'].split(',')))
+    job['crlbs'] = _to_floats (crlb_row, len(dataset['crlb_header'].split(',')))
+    for sliding_window, n_spectra in job['targets']: assign (job, sliding_window, n_spectra)
+    if 'new' in job: # a new fit, make it durable right away
+        timer = stage_start ()
+        dataset['journal'].write('\t'.join([' '.join([str(number) for number in job['members']]),
+             header, row, crlb_header, crlb_row]).replace('\r','').replace('\n','')+'\n')
+        dataset['journal'].flush(); os.fsync(dataset['journal'].fileno())
+        stage_end ('journal', timer)
+        dataset['pending'] -= 1
+        if dataset['pending'] == 0 and dataset['scheduled']: finish (dataset)
+def assign (job, sliding_window, n_spectra):
+    dataset = job['dataset']
+    dataset['results'][sliding_window][n_spectra] = job['fit'][1]
+    dataset['values'][sliding_window][n_spectra] = job['values']
+    dataset['crlbs'][sliding_window][n_spectra] = job['crlbs']
+def failed (job): # batch mode, the dataset is given up but the batch goes on
+    dataset = job['dataset']
+    dataset['status'] = 'failed'; dataset['message'] = 'TARQUIN error ('+job['error']+')'
+    dataset['failures'].append(job)
+    dataset['pending'] -= 1
+    if dataset['pending'] == 0 and dataset['scheduled']: finish (dataset)
+def failed_fit (job): # --on_fail=nan, the spectra of the fit get a row of NaN
+    dataset = job['dataset']
+    dataset['failures'].append(job)
+    dataset['pending'] -= 1
+    if dataset['pending'] == 0 and dataset['scheduled']: finish (dataset)
+def finish (dataset): # all fits of a dataset are done, write results
+    timer = stage_start ()
+    dataset['journal'].close()
+    if dataset['status'] == 'ok' and not 'header' in dataset: 
+        dataset['status'] = 'failed'; dataset['message'] = 'all fits failed'
+    if dataset['status'] == 'ok': 
+        for sliding_window in windows:
+            stp=''; space = ' ' # for name collision detection
+            name = basedir+dataset['name']
+            if len(windows)>1: name += '_window'+str(sliding_window)
+            if os.path.isfile(name+stp+'.csv'): stp='_'+timestamp+ID
+            f = open(name+stp+'.csv', 'w')
+            f.write(Program_name+space+Program_version+' Results:\n')
+            f.write(dataset['header'])
+            for line in dataset['results'][sliding_window]: 
+                if line == None: line = dataset['nan_row'] # failed fit
+                f.write(line)
+            f.close()
+            dataset['outputs'].append(name+stp+'.csv')
+            # the same numerically, e.g. for fMRS_statistics
+            extras = dict(dataset.get('registration', {})); extras.update(dataset.get('preprocessing', {}))
+            numpy.savez (name+stp+'.npz', amplitudes=dataset['values'][sliding_window], 
+                names=numpy.array(dataset['header'].rstrip('\r\n').split(',')),
+                crlbs=dataset['crlbs'][sliding_window], 
+                crlb_names=numpy.array(dataset['crlb_header'].rstrip('\r\n').split(',')),
+                window=sliding_window, input=dataset['filename'], fit_options=fit_options,
+                dynamics=numpy.array([[min(members), max(members)] for members in 
+                         [window_members (n_spectra, dataset['rows'], sliding_window) 
+                          for n_spectra in range(dataset['rows'])]]),
+                program=Program_name+' '+Program_version, timestamp=timestamp, 
+                **extras)
+        if len(dataset['failures'])>0: # the checkpoint is kept, --resume fits only the failed again
+            lprint (dataset['name']+': '+str(len(dataset['failures']))+' of '+str(dataset['fits'])+
+                    ' fits failed, written as NaN')
+        else: delete (dataset['checkpoint']) # results are complete
+        if batch != '': lprint (dataset['name']+': done')
+    else: lprint (dataset['name']+': '+dataset['status']+' ('+dataset['message']+')')
+    try: shutil.rmtree(dataset['scratch'])
+    except: pass # silent
+    for name in ['results', 'values', 'crlbs']: 
+        if name in dataset: del dataset[name]
+    stage_end ('write', timer)
+    profile['datasets'].append({'name': dataset['name'], 'status': dataset['status'], 'rows': dataset['rows'],
+                                'fits': dataset['fits'], 'cached': dataset['cached'], 
+                                'wall': time.time()-dataset['started'], 
+                                'failures': [{'dynamics': [min(job['members']), max(job['members'])], 
+                                              'targets': job['targets'], 'error': job['error']} 
+                                             for job in dataset['failures']]})
+def schedule_all (inputs, datasets):
+    # generator of the TARQUIN jobs of all inputs, the datasets are read 
+    # when the previous ones are scheduled, so the workers stay busy
+    for filename, name in inputs:
+        dataset = {'filename': filename, 'name': name, 'status': 'ok', 'message': '', 
+                   'rows': 0, 'fits': 0, 'cached': 0, 'outputs': []}
+        datasets.append(dataset)
+        dataset['started'] = time.time(); timer = stage_start ()
+        try: dataset.update (read_dataset (filename))
+        except InputError as e:
+            if batch == '': raise # single input, the run is over
+            dataset['status'] = 'skipped'; dataset['message'] = str(e)
+            lprint (name+': skipped ('+str(e)+')')
+            continue
+        finally: stage_end ('read', timer)
+        dataset['scratch'] = tempdir+str(len(datasets))+slash
+        os.mkdir (dataset['scratch'])
+        if queue_dir != '' and not averaged_in_python (): # the workers read the input from the queue
+            for file in dataset['files']: shutil.copy(file, dataset['scratch'])
+            dataset['queue_input'] = dataset['scratch']+os.path.basename(filename)
+        for job in schedule_fits (dataset): yield job
+def write_summary (datasets): # batch mode, one line per input file
+    file = basedir+Program_name+'_summary_'+timestamp+ID+'.csv'
+    with open(file, 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['input', 'status', 'spectra', 'fits', 'cached', 'outputs', 'message', 'failed'])
+        for dataset in datasets:
+            failures = ['dynamics '+str(min(job['members']))+'-'+str(max(job['members']))+' '+job['error'] 
+                        for job in dataset.get('failures', [])]
+            writer.writerow([dataset['filename'], dataset['status'], dataset['rows'], dataset['fits'], 
+                             dataset['cached'], ';'.join(dataset['outputs']), dataset['message'], ';'.join(failures)])
+    return file
 def usage():
     lprint ('')
     lprint ('Usage: '+Program_name+' [options] --spec=<spectrofile>')
@@ -188,6 +1370,60 @@ def usage():
     lprint ('       --window=<integer> : number of spectra to average in sliding window')
     lprint ('                            should be within 1-50, if not specified ')
     lprint ('                            the user will be prompted to input interactively')
+    lprint ('                            several window sizes can be given as list and/or')
+    lprint ('                            range (e.g. 1,3,5 or 1-15), all are fitted in one')
+    lprint ('                            run and written to one result file per window')
+    lprint ('       --jobs=<integer>   : number of TARQUIN fits to run in parallel')
+    lprint ('                            (default 1)')
+    lprint ('       --preaverage       : average the sliding windows in python and pass')
+    lprint ('                            TARQUIN a single averaged spectrum per fit. The')
+    lprint ('                            dynamics are not aligned (TARQUIN --dyn_freq_corr')
+    lprint ('                            has no effect on one spectrum) unless --register')
+    lprint ('       --register         : align frequency and phase of all dynamics once before')
+    lprint ('                            averaging in python (as --preaverage), instead of')
+    lprint ('                            TARQUIN --dyn_freq_corr and --auto_phase in every fit')
+    lprint ('       --hsvd             : remove residual water (HSVD) from every dynamic once')
+    lprint ('                            before averaging in python (as --preaverage), uses')
+    lprint ('                            --jobs threads')
+    lprint ('       --apodize=<Hz>     : exponential line broadening of every dynamic')
+    lprint ('       --truncate=<n>     : use only the first n points of every dynamic')
+    lprint ('       --cache=<path>     : directory to keep fit results in, fits of the')
+    lprint ('                            same dynamics with the same options are reused')
+    lprint ('       --cache_size=<MB>  : maximum size of the cache (default 100MB)')
+    lprint ('       --resume           : continue an interrupted run, fits that are already')
+    lprint ('                            done are read from the <name>.checkpoint file that')
+    lprint ('                            every run keeps in outdir until it is complete')
+    lprint ('       --batch=<path>     : process all spectro files (SPAR and DICOM XX*) in a')
+    lprint ('                            directory tree, or listed in a textfile (one per')
+    lprint ('                            line), without any user interaction. Output goes')
+    lprint ('                            to outdir, together with a summary of the run')
+    lprint ('       --tarquin=<path>   : TARQUIN executable to use instead of the one')
+    lprint ('                            next to this program')
+    lprint ('       --reuse_basis      : simulate the TARQUIN basis set once per sequence')
+    lprint ('                            parameters (kept in the cache dir if given) and')
+    lprint ('                            give it to all fits, instead of simulating it in')
+    lprint ('                            every fit (experimental, see README)')
+    lprint ('       --backend=<tarquin|native> : fit with TARQUIN (default) or in python with')
+    lprint ('                            a simplified 1h_brain basis, much faster, the')
+    lprint ('                            windows are averaged in python (as --preaverage)')
+    lprint ('       --timeout=<seconds>: TARQUIN fits running longer are stopped and count')
+    lprint ('                            as failed (default 0, no limit)')
+    lprint ('       --retries=<n>      : number of times a failed fit is repeated (default 0)')
+    lprint ('       --on_fail=<abort|nan> : what happens when a fit fails: abort the run')
+    lprint ('                            (in batch mode: skip the spectro file), or write')
+    lprint ('                            NaN for the spectra of the fit and continue')
+    lprint ('       --queue=<path>     : put the TARQUIN fits in a work queue, a directory')
+    lprint ('                            on a shared filesystem, instead of running them.')
+    lprint ('                            Workers on any number of nodes fit them, the')
+    lprint ('                            results are written when all fits are delivered')
+    lprint ('       --worker=<path>    : run as worker of the queue, --jobs fits at a time,')
+    lprint ('                            until no run is waiting for fits any more')
+    lprint ('       --lease=<seconds>  : with --queue, fits of a worker that stopped renewing')
+    lprint ('                            its lease for this long are queued again (default 60)')
+    lprint ('       --profile=<file>   : write time, CPU time and memory per stage and the')
+    lprint ('                            TARQUIN run times as JSON report')
+    lprint ('       --prometheus=<file>: the same in Prometheus text format (e.g. for the')
+    lprint ('                            node exporter textfile collector)')
     lprint ('       --help (or -h)     : usage and help')
     lprint ('       --version          : version information')
     lprint ('')
@@ -206,287 +1442,300 @@ def help():
     lprint ('   for installation instructions see http://wiki.python.org/moin/TkInter')    
     lprint ('')
 
-# general initialization stuff   
+def configure (**settings):
+    # sets the module settings that correspond to commandline options, for use as
+    # library, e.g. configure (windows=[1,5], n_jobs=4, basedir='/data/fMRS')
+    for name in settings:
+        if not name in ['debug', 'windows', 'n_jobs', 'preaverage', 'cache_dir', 'cache_size', 
+                        'batch', 'resume', 'basedir', 'resourcedir', 'tarquin', 
+                        'timeout', 'retries', 'on_fail', 'backend', 'reuse_basis', 'register',
+                        'queue_dir', 'lease', 'hsvd', 'apodize', 'truncate']: 
+            raise ValueError ('unknown setting "'+name+'"')
+        value = settings[name]
+        if name in ['basedir', 'resourcedir', 'cache_dir', 'tarquin', 'queue_dir'] and value != '': 
+            value = os.path.abspath(value)
+            if name in ['basedir', 'resourcedir']: value += slash
+        globals()[name] = value
+def process (inputs):
+    # fits all windows of the inputs, a list of (spectro file, output name), writes the 
+    # results to basedir and returns the datasets (dicts with 'status', 'outputs' etc.).
+    # Problems that end the run raise InputError (single input) or RunError
+    global timestamp, tempdir, fit_options
+    timestamp=datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    # the full TARQUIN options, with the scratch file names that change every run left out
+    basis = None
+    if reuse_basis: basis = '<basis>'
+    if backend == 'native': fit_options = 'native '+' '.join(tarquin_arguments('<input>', None, '<output>'))
+    elif averaged_in_python (): fit_options = ' '.join(tarquin_arguments('<input>', None, '<output>', basis))
+    else: fit_options = ' '.join(tarquin_arguments('<input>', '<avlist>', '<output>', basis))
+    fit_options += preprocessing ()
+    if averaged_in_python () and not register: 
+        lprint ('Warning: dynamics are averaged without frequency and phase alignment, use --register to align them')
+    basis_files.clear() # the basis files of an earlier run might be gone with its tempdir
+    if cache_dir != '' and not os.path.isdir(cache_dir):
+        try: os.makedirs(cache_dir)
+        except: raise RunError ('Problem creating cache dir: '+cache_dir)
+    # make tempdir, with --queue in the queue (created if new) where the workers find the inputs
+    if queue_dir != '': open_queue ()
+    try: tempdir = tempfile.mkdtemp(prefix='.'+Program_name+'_temp'+timestamp, dir=queue_dir or basedir)+slash
+    except: raise RunError ('Problem creating temp dir in '+(queue_dir or basedir))
+    # start processing with TARQUIN
+    datasets = []
+    command = tarquin_command ()
+    if n_jobs>1 and backend != 'native': logwrite ('Running '+str(n_jobs)+' TARQUIN processes in parallel')
+    if on_fail == 'nan': failure = failed_fit # NaN rows, the rest goes on
+    elif batch != '': failure = failed # the dataset is given up
+    else: failure = None # abort
+    try:
+        if sys.platform=="win32": run('attrib', ' +H "'+tempdir[:len(tempdir)-1]+'"') # hide tempdir
+        if backend == 'native': run_native (schedule_all (inputs, datasets), failure)
+        elif queue_dir != '': run_queue (schedule_all (inputs, datasets), collect, failure)
+        else: run_parallel (command, schedule_all (inputs, datasets), n_jobs, collect, failure, timeout, retries)
+    finally: # also when the run is aborted, no processes, queued jobs or temp files are left
+        stop_all ()
+        if queue_registration != '': close_queue ()
+        for dataset in datasets:
+            if 'journal' in dataset: dataset['journal'].close()
+        try: shutil.rmtree(tempdir)
+        except: pass # silent
+        tempdir = ''
+    if cache_dir != '': cache_evict (cache_size*1048576)
+    return datasets
+
+# default settings, see configure() and main()
 debug=False; NIFTI_Input=False; SPAR_Input=True
-filename=''; workfile=''
-slash='/'; 
-if sys.platform=="win32": slash='\\' # not really needed, but looks nicer ;)
-Program_name = os.path.basename(sys.argv[0]); 
-if Program_name.find('.')>0: Program_name = Program_name[:Program_name.find('.')]
+processes=[]; n_jobs=1; preaverage=False; windows=[1]
+cache_dir=''; cache_size=100; batch=''; resume=False; tarquin=''
+timeout=0; retries=0; on_fail='abort'; backend='tarquin'; reuse_basis=False
+basis_files={}; native_bases={}; register=False
+queue_dir=''; lease=60.; queue_jobs={}; queue_registration=''
+hsvd=False; apodize=0.; truncate=0
+Program_name = os.path.splitext(os.path.basename(__file__))[0]
 basedir = os.getcwd()+slash # current working directory is the default output directory 
-for arg in sys.argv[1:]: # look in command line arguments if the output directory specified
-    if "--outdir" in arg: basedir = os.path.abspath(arg[arg.find('=')+1:])+slash #
+resourcedir = os.path.abspath(os.path.dirname(__file__))+slash # where TARQUIN is 
 ID = str(random.randrange(1000, 2000));ID=ID[:3] # create 3 digit random ID for logfile 
-try: sys.stderr = open(basedir+Program_name+'.log', 'a'); # open logfile to append
-except: print('Problem opening logfile: '+basedir+Program_name+'.log'); exit(2)
 my_env = os.environ.copy()
-FNULL = open(os.devnull, 'w')
-# catch signals to be able to cleanup temp files before exit
-signal.signal(signal.SIGINT, signal_handler)  # keyboard interrupt
-signal.signal(signal.SIGTERM, signal_handler) # kill/shutdown
-if  'SIGHUP' in dir(signal): signal.signal(signal.SIGHUP, signal_handler)  # shell exit (linux)
-# make tempdir
 timestamp=datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-tempname='.'+Program_name+'_temp'+timestamp
-tempdir=basedir+tempname+slash
-if os.path.isdir(tempdir): # this should never happen
-    lprint ('ERROR:  Problem creating temp dir (already exists)'); exit(1) 
-try: os.mkdir (tempdir)
-except: lprint ('ERROR:  Problem creating temp dir: '+tempdir); exit(1) 
+tempdir=''; fit_options=''
+reset_profile ()
 
-# configuration specific initializations
-# compare python versions with e.g. if LooseVersion(python_version)>LooseVersion("2.7.6"):
-python_version = str(sys.version_info[0])+'.'+str(sys.version_info[1])+'.'+str(sys.version_info[2])
-# sys.platform = [linux2, win32, cygwin, darwin, os2, os2emx, riscos, atheos, freebsd7, freebsd8]
-if sys.platform=="win32":
-    os.system("title "+Program_name)
-    try: resourcedir = sys._MEIPASS+slash # when on PyInstaller 
-    except: # in plain python this is where the script was run from
-        resourcedir = os.path.abspath(os.path.dirname(sys.argv[0]))+slash; 
-    command='attrib'; parameters=' +H "'+tempdir[:len(tempdir)-1]+'"'; 
-    run(command, parameters) # hide tempdir
-    if pywin32_installed:
-        try: # disable console windows close button (substitutes catch shell exit under linux)
-            hwnd = win32console.GetConsoleWindow()
-            hMenu = win32gui.GetSystemMenu(hwnd, 0)
-            win32gui.DeleteMenu(hMenu, win32con.SC_CLOSE, win32con.MF_BYCOMMAND)
-        except: pass #silent        
-else:
-    resourcedir = os.path.abspath(os.path.dirname(sys.argv[0]))+slash;
-if TK_installed:        
-    TKwindows = tk.Tk(); TKwindows.withdraw() #hiding tkinter window
-    TKwindows.update()
-    # the following tries to disable showing hidden files/folders under linux
-    try: TKwindows.tk.call('tk_getOpenFile', '-foobarz')
-    except: pass
-    try: TKwindows.tk.call('namespace', 'import', '::tk::dialog::file::')
-    except: pass
-    try: TKwindows.tk.call('set', '::tk::dialog::file::showHiddenBtn', '1')
-    except: pass
-    try: TKwindows.tk.call('set', '::tk::dialog::file::showHiddenVar', '0')
-    except: pass
-    TKwindows.update()
+def main ():
+    global debug, windows, n_jobs, preaverage, cache_dir, cache_size, batch, resume, tarquin
+    global timeout, retries, on_fail, backend, reuse_basis, register, queue_dir, lease
+    global hsvd, apodize, truncate
+    global Program_name, basedir, resourcedir
+    # general initialization stuff   
+    filename=''
+    Program_name = os.path.basename(sys.argv[0]); 
+    if Program_name.find('.')>0: Program_name = Program_name[:Program_name.find('.')]
+    for arg in sys.argv[1:]: # look in command line arguments if the output directory specified
+        if "--outdir" in arg: basedir = os.path.abspath(arg[arg.find('=')+1:])+slash #
+    try: sys.stderr = open(basedir+Program_name+'.log', 'a'); # open logfile to append
+    except: print('Problem opening logfile: '+basedir+Program_name+'.log'); exit(2)
+    # catch signals to be able to cleanup temp files before exit
+    signal.signal(signal.SIGINT, signal_handler)  # keyboard interrupt
+    signal.signal(signal.SIGTERM, signal_handler) # kill/shutdown
+    if  'SIGHUP' in dir(signal): signal.signal(signal.SIGHUP, signal_handler)  # shell exit (linux)
+
+    # configuration specific initializations
+    python_version = str(sys.version_info[0])+'.'+str(sys.version_info[1])+'.'+str(sys.version_info[2])
+    # sys.platform = [linux2, win32, cygwin, darwin, os2, os2emx, riscos, atheos, freebsd7, freebsd8]
+    if sys.platform=="win32":
+        os.system("title "+Program_name)
+        try: resourcedir = sys._MEIPASS+slash # when on PyInstaller 
+        except: # in plain python this is where the script was run from
+            resourcedir = os.path.abspath(os.path.dirname(sys.argv[0]))+slash; 
+        console_close_button (False) # substitutes catch shell exit under linux
+    else:
+        resourcedir = os.path.abspath(os.path.dirname(sys.argv[0]))+slash;
 
-# parse commandline parameters (if present)
-try: opts, args =  getopt( sys.argv[1:],'h',['help','version','spec=','outdir=', 'window='])
-except:
-    error=str(sys.argv[1:]).replace("[","").replace("]","")
-    if "-" in str(error) and not "--" in str(error): 
-          lprint ('ERROR: Commandline '+str(error)+',   maybe you mean "--"')
-    else: lprint ('ERROR: Commandline '+str(error))
-    usage(); exit(2)
-if len(args)>0: 
-    lprint ('ERROR: Commandline option "'+args[0]+'" not recognized')
-    lprint ('       (see logfile for details)')
-    logwrite ('       Calling parameters: '+str(sys.argv[1:]).replace("[","").replace("]",""))
-    usage(); exit(2)  
-argDict = dict(opts)
-if "--outdir" in argDict and not [True for arg in sys.argv[1:] if "--outdir" in arg]:
-    # "--outdir" must be spelled out, getopt also excepts substrings (e.g. "--outd"), but
-    # my simple pre-initialization code to get basedir early doesn't
-    lprint ('ERROR: Commandline option "--outdir" must be spelled out')
-    usage(); exit(2)
-if '-h' in argDict: usage(); help(); exit(0)   
-if '--help' in argDict: usage(); help(); exit(0)  
-if '--version' in argDict: lprint (Program_name+' '+Program_version); exit(0)
-if '--spec' in argDict: filename=argDict['--spec']; checkfile(filename)
-window_by_arg = False
-if '--window' in argDict: 
-    window_str = argDict['--window']
-    try: sliding_window=int(window_str)
-    except: lprint ('ERROR: problem converting --window argument to number'); exit(2)
-    if sliding_window<1:  lprint ('ERROR: sliding window must be >=1');  exit(2)
-    if sliding_window>50: lprint ('ERROR: sliding window must be <=50'); exit(2)
-    window_by_arg = True
-    
-#choose file with tkinter
-try:
-   TKwindows = tk.Tk(); TKwindows.withdraw() #hiding tkinter window
-   TKwindows.update()
-except: pass
-# the following tries to disablle showing hidden files/folders under linux
-try: TKwindows.tk.call('tk_getOpenFile', '-foobarz')
-except: pass
-try: TKwindows.tk.call('namespace', 'import', '::tk::dialog::file::')
-except: pass
-try: TKwindows.tk.call('set', '::tk::dialog::file::showHiddenBtn', '1')
-except: pass
-try: TKwindows.tk.call('set', '::tk::dialog::file::showHiddenVar', '0')
-except: pass
-try: TKwindows.update()
-except: pass
-# this is the actual file open dialogue
-Interactive = False
-if TK_installed:
-   # Choose Spectro file
-    if filename == "": # use interactive input if not specified in commandline
-        filename = askopenfilename(title="Choose Spectro file")
+    # parse commandline parameters (if present)
+    timer = stage_start ()
+    try: opts, args =  getopt( sys.argv[1:],'h',['help','version','spec=','outdir=', 'window=', 'jobs=', 'preaverage',
+                                                    'cache=', 'cache_size=', 'batch=', 'resume', 'tarquin=',
+                                                    'profile=', 'prometheus=', 'timeout=', 'retries=', 'on_fail=',
+                                                    'backend=', 'reuse_basis', 'register', 'queue=', 'worker=',
+                                                    'lease=', 'hsvd', 'apodize=', 'truncate='])
+    except:
+        error=str(sys.argv[1:]).replace("[","").replace("]","")
+        if "-" in str(error) and not "--" in str(error): 
+              lprint ('ERROR: Commandline '+str(error)+',   maybe you mean "--"')
+        else: lprint ('ERROR: Commandline '+str(error))
+        usage(); exit(2)
+    if len(args)>0: 
+        lprint ('ERROR: Commandline option "'+args[0]+'" not recognized')
+        lprint ('       (see logfile for details)')
+        logwrite ('       Calling parameters: '+str(sys.argv[1:]).replace("[","").replace("]",""))
+        usage(); exit(2)  
+    argDict = dict(opts)
+    if "--outdir" in argDict and not [True for arg in sys.argv[1:] if "--outdir" in arg]:
+        # "--outdir" must be spelled out, getopt also excepts substrings (e.g. "--outd"), but
+        # my simple pre-initialization code to get basedir early doesn't
+        lprint ('ERROR: Commandline option "--outdir" must be spelled out')
+        usage(); exit(2)
+    if '-h' in argDict: usage(); help(); exit(0)   
+    if '--help' in argDict: usage(); help(); exit(0)  
+    if '--version' in argDict: lprint (Program_name+' '+Program_version); exit(0)
+    if '--spec' in argDict: filename=argDict['--spec']; checkfile(filename)
+    window_by_arg = False
+    if '--window' in argDict: 
+        window_str = argDict['--window']
+        try: windows=parse_windows(window_str)
+        except: lprint ('ERROR: problem converting --window argument to number(s)'); exit(2)
+        if len(windows)==0: lprint ('ERROR: problem converting --window argument to number(s)'); exit(2)
+        if windows[0]<1:  lprint ('ERROR: sliding window must be >=1');  exit(2)
+        if windows[-1]>50: lprint ('ERROR: sliding window must be <=50'); exit(2)
+        window_by_arg = True
+    if '--jobs' in argDict: 
+        try: n_jobs=int(argDict['--jobs'])
+        except: lprint ('ERROR: problem converting --jobs argument to number'); exit(2)
+        if n_jobs<1:  lprint ('ERROR: number of jobs must be >=1');  exit(2)
+    if '--preaverage' in argDict: preaverage=True
+    if '--resume' in argDict: resume=True
+    if '--reuse_basis' in argDict: reuse_basis=True
+    if '--register' in argDict: register=True
+    if '--hsvd' in argDict: hsvd=True
+    if '--apodize' in argDict: 
+        try: apodize=float(argDict['--apodize'])
+        except: lprint ('ERROR: problem converting --apodize argument to number'); exit(2)
+        if apodize<0: lprint ('ERROR: apodization must be >=0'); exit(2)
+    if '--truncate' in argDict: 
+        try: truncate=int(argDict['--truncate'])
+        except: lprint ('ERROR: problem converting --truncate argument to number'); exit(2)
+        if truncate<=native_start: lprint ('ERROR: truncate must be >'+str(native_start)); exit(2)
+    if '--batch' in argDict: 
+        batch=os.path.abspath(argDict['--batch'])
+        if not os.path.exists(batch): lprint ('ERROR:  "'+batch+'" not found'); exit(2)
+    if '--cache' in argDict: cache_dir = os.path.abspath(argDict['--cache'])
+    if '--tarquin' in argDict: tarquin = os.path.abspath(argDict['--tarquin']); checkfile(tarquin)
+    if '--cache_size' in argDict: 
+        try: cache_size=float(argDict['--cache_size'])
+        except: lprint ('ERROR: problem converting --cache_size argument to number'); exit(2)
+    if '--timeout' in argDict: 
+        try: timeout=float(argDict['--timeout'])
+        except: lprint ('ERROR: problem converting --timeout argument to number'); exit(2)
+        if timeout<0: lprint ('ERROR: timeout must be >=0'); exit(2)
+    if '--retries' in argDict: 
+        try: retries=int(argDict['--retries'])
+        except: lprint ('ERROR: problem converting --retries argument to number'); exit(2)
+        if retries<0: lprint ('ERROR: number of retries must be >=0'); exit(2)
+    if '--on_fail' in argDict: 
+        on_fail=argDict['--on_fail']
+        if on_fail not in ['abort','nan']: lprint ('ERROR: on_fail must be "abort" or "nan"'); exit(2)
+    if '--backend' in argDict: 
+        backend=argDict['--backend']
+        if backend not in ['tarquin','native']: lprint ('ERROR: backend must be "tarquin" or "native"'); exit(2)
+    worker = False
+    if '--queue' in argDict: queue_dir = os.path.abspath(argDict['--queue'])
+    if '--worker' in argDict: 
+        if queue_dir != '': lprint ('ERROR: --queue and --worker can not be combined'); exit(2)
+        queue_dir = os.path.abspath(argDict['--worker']); worker = True
+        if not os.path.isdir(queue_dir): lprint ('ERROR:  "'+queue_dir+'" not found'); exit(2)
+    if queue_dir != '' and backend == 'native': 
+        lprint ('ERROR: --queue and --worker require the TARQUIN backend'); exit(2)
+    if '--lease' in argDict: 
+        try: lease=float(argDict['--lease'])
+        except: lprint ('ERROR: problem converting --lease argument to number'); exit(2)
+        if lease<=0: lprint ('ERROR: lease must be >0'); exit(2)
+    profile_file = ''; prometheus_file = ''
+    if '--profile' in argDict: profile_file = os.path.abspath(argDict['--profile'])
+    if '--prometheus' in argDict: prometheus_file = os.path.abspath(argDict['--prometheus'])
+    stage_end ('arguments', timer)
+
+    if worker: # fits the jobs of the queue, no input of its own
+        logwrite ('Calling sequence    '+' '.join(sys.argv))
+        try: lprint (str(run_worker ())+' fits done')
+        except RunError as e: lprint ('ERROR:  '+str(e)); exit(1)
+        if latency_summary () != '': lprint (latency_summary ())
+        if profile_file != '' or prometheus_file != '':
+            try: write_profile (profile_file, prometheus_file)
+            except: lprint ('ERROR:  Problem writing profile')
+        lprint ('done\n')
+        sys.stderr.close() # close logfile
+        console_close_button (True)
+        return
+        
+    #choose file with tkinter
+    Interactive = False
+    if batch == '' and filename == '': # use interactive input if not specified in commandline
+        filename = choose_file ("Choose Spectro file")
+        if filename == None:
+            lprint ('ERROR:  No Spectro input file specified')
+            lprint ('        to interactively choose input files you need tkinter')
+            lprint ('        on Linux try "yum install tkinter"')
+            lprint ('        on MacOS install ActiveTcl from:')
+            lprint ('        http://www.activestate.com/activetcl/downloads')  
+            usage()
+            exit(2)
         if filename == "": lprint ('ERROR:  No Spectro input file specified'); exit(2)
         Interactive = True
-    TKwindows.update()
-else:
-    if filename == "": 
-        lprint ('ERROR:  No Spectro input file specified')
-        lprint ('        to interactively choose input files you need tkinter')
-        lprint ('        on Linux try "yum install tkinter"')
-        lprint ('        on MacOS install ActiveTcl from:')
-        lprint ('        http://www.activestate.com/activetcl/downloads')  
-        usage()
-        exit(2)
-filename = os.path.abspath(filename)
-TKwindows.update()
-try: win32gui.SetForegroundWindow(win32console.GetConsoleWindow())
-except: pass #silent
+    if filename != '': filename = os.path.abspath(filename)
 
-# read input from keyboard
-if not window_by_arg:
-    sliding_window=0; OK=False
-    while not OK:
-        dummy = raw_input("Enter sliding window [1..50]: ")
-        if dummy == '': print ("Input Error")
-        try: sliding_window = int(dummy);
-        except: print ("Input Error")
-        if sliding_window>=1 and sliding_window<=50: OK=True 
+    # read input from keyboard
+    if not window_by_arg and batch != '': 
+        lprint ('ERROR: --window must be specified in batch mode'); exit(2)
+    if not window_by_arg:
+        sliding_window=0; OK=False
+        while not OK:
+            dummy = input("Enter sliding window [1..50]: ")
+            if dummy == '': print ("Input Error")
+            try: sliding_window = int(dummy);
+            except: print ("Input Error")
+            if sliding_window>=1 and sliding_window<=50: OK=True 
+        windows = [sliding_window]
 
+    # ----- start to really do something -----
+    lprint ('Starting '+Program_name+' '+Program_version)
+    if len(windows)==1: lprint ('Sliding window is set to '+str(windows[0]))
+    else: lprint ('Sliding windows are set to '+', '.join([str(window) for window in windows]))
+    logwrite ('Calling sequence    '+' '.join(sys.argv))
+    logwrite ('OS & Python version '+sys.platform+' '+python_version)
 
-# ----- start to really do something -----
-lprint ('Starting '+Program_name+' '+Program_version)
-lprint ('Sliding window is set to '+str(sliding_window))
-logwrite ('Calling sequence    '+' '.join(sys.argv))
-logwrite ('OS & Python version '+sys.platform+' '+python_version)
-logwrite ('tkinter & pydicom   '+str(TK_installed)+' '+str(pydicom_installed))
-
-# read data
-if isDICOM (filename):  # read DICOM  
-    try: Dset = dicom.read_file(filename)
-    except: lprint ('ERROR: reading DICOM file'); exit(1)
-    # do some checks
-    try: Modality=str(Dset.Modality) # must be MR           
-    except: lprint ('ERROR: Unable to determine DICOM Modality'); exit(1)
-    if Modality!='MR': lprint ('DICOM Modality not MR'); exit(1)
-    try: Manufacturer=str(Dset.Manufacturer) # currently Philips only
-    except: lprint ('ERROR: Unable to determine Manufacturer'); exit(1)
-    if not Manufacturer.find("Philips")>=0: 
-        lprint ('ERROR: Currently only Philips DICOM implemented'); exit(1)
-    try: ImageType=str(Dset.ImageType) # sanity check: spectroscopy   
-    except: 
-        lprint ('ERROR: Unable to determine if DICOM containes spectroscopy data'); exit(1)
-    if not ImageType.find("SPECTROSCOPY")>=0: 
-        lprint ('ERROR: DICOM file does not contain spectroscopy data'); exit(1)
-    # start reading data from DICOM
-    ReIm=2 # real and imagininary parts
-    try: samples=Dset.SpectroscopyAcquisitionDataColumns # n_points in time/frequency domain
-    except: lprint ('ERROR: reading number of samples from DICOM file'); exit(1)
-    try: rows=Dset[0x2001,0x1081].value #NumberOfDynamicScans
-    except: lprint ('ERROR: reading number of dynamics from DICOM file'); exit(1)
-    if rows<=1: lprint ('ERROR: not a multi TE aquisition'); exit(1)
-    if rows<=min_nTE: lprint ('ERROR: minimum number of'+str(min_nTE)+'TEs required'); exit(1)
-    # check if number of points is correct
-    ndata_points=len (numpy.asarray(Dset[0x5600,0x0020].value))
-    if ndata_points==2*rows*samples*ReIm: 
-        ActRef=2 # two spectra, actual and water, this is the normal case
-    elif ndata_points==rows*samples*ReIm: 
-        ActRef=1 # only one spectrum
-    else: 
-        lprint ('ERROR: Unexpected number of total datapoints'); exit(1)  
-    #read data
-    spectro_rawdata = numpy.asarray(Dset[0x5600,0x0020].value)
-else: # read SDAT
-    # find SPAR/SDAT pair
-    path=os.path.dirname(filename)
-    name=os.path.splitext(os.path.basename(filename))[0]
-    ext=os.path.splitext(os.path.basename(filename))[1]
-    if ext.lower() == ".spar": 
-      SPARfile=filename 
-      SDATfile=[f for f in os.listdir(path) if f.lower().endswith('.sdat') and f.startswith(name)]
-      SDATfile=SDATfile[0] # may want to raise an exception here ...
-    elif ext.lower() == ".sdat":
-      SDATfile=filename 
-      SPARfile=[f for f in os.listdir(path) if f.lower().endswith('.spar') and f.startswith(name)]
-      SPARfile=SPARfile[0] # may want to raise an exception here ...
-    else: lprint ('ERROR: file extension should be SDAT/SPAR'); exit(1)
-    # open SPAR
-    try: input = open(SPARfile, "r").readlines()
-    except: lprint ('ERROR: reading SPAR file'); exit(1)
-    samples = int(_get_from_SPAR (input, 'samples'))
-    rows = int(_get_from_SPAR (input, 'rows'))
-    ActRef = int(_get_from_SPAR (input, 'mix_number'))
-    if ActRef != 1: 
-       lprint ('ERROR: SPAR/SDAT file seems to be a reference spectrum, choose an actual spectrum'); 
-       exit(1)
-    # guess missing data not contained in the SPAR file
-    ReIm=2   # real and imagininary parts
-logwrite ('Reading File '+filename)   
-lprint ('') # spacer
-    
-       
-# start processing with TARQUIN
-##delete (tempdir+'tarquin_T2fit.csv') # cleanup
-##delete (tempdir+'tarquin_T2fit.txt') # cleanup
-##delete (tempdir+'avlist.csv')        # cleanup
-##delete (tempdir+workfile)            # cleanup
-results = []
-for n_spectra in range(rows):
-   space=''
-   if n_spectra<9: space=' '
-   lprint ('Processing spectrum '+space+str(n_spectra+1)+' of '+str(rows))
-   avfile = open(tempdir+'avlist.csv', 'w')
-   for i in range (sliding_window):
-      number = n_spectra+1+i-int(sliding_window/2)
-      if (number>0) and (number<=rows):
-         avfile.write(str(number)+"\n")  
-   avfile.close()
-   arguments=' --input "'+filename+'"'
-   arguments+=' --format philips'
-   arguments+=' --av_list "'+tempdir+'avlist.csv"' 
-   arguments+=' --output_csv  "'+tempdir+'tarquin_fMRS_fit.csv"'
-   arguments+=' --ref 4.66 --max_metab_shift 0.015'
-   arguments+=' --auto_phase true --dyn_freq_corr true'
-   arguments+=' --start_pnt 20 --ref_signals 1h_naa --dref_signals 1h_naa --pul_seq press --int_basis 1h_brain'
-   run (resourcedir+'tarquin', arguments)
-   with open(tempdir+'tarquin_fMRS_fit.csv', 'r') as csvfile:
-      data = csvfile.readlines()   
-      header  = data[1]
-      results = numpy.append (results, data[2])
- 
-#fit & write results
-lprint ('') # spacer
-stp=''; space = ' ' # for name collision detection
-if os.path.isfile(os.path.splitext(os.path.basename(filename))[0]+stp+'.csv'): stp='_'+timestamp+ID
-f = open(os.path.splitext(os.path.basename(filename))[0]+stp+'.csv', 'w')
-f.write(Program_name+space+Program_version+' Results:\n')
-f.write(header)
-f.write(results)
-f.close()
+    if batch != '': 
+        inputs = find_inputs (batch)
+        lprint (str(len(inputs))+' spectro files found in '+batch)
+    else: inputs = [(filename, os.path.splitext(os.path.basename(filename))[0])]
+    lprint ('') # spacer
+        
+    try: datasets = process (inputs)
+    except (InputError, RunError) as e: lprint ('ERROR:  '+str(e)); exit(1)
+    n_fits = sum([dataset['fits'] for dataset in datasets])
+    n_cached = sum([dataset['cached'] for dataset in datasets])
+    if len(windows)>1: 
+        lprint (str(n_fits)+' distinct fits for '+str(len(windows)*sum([dataset['rows'] for dataset in datasets]))+' spectra')
+    if n_cached>0: lprint ('Reused '+str(n_cached)+' of '+str(n_fits)+' fits from cache')
+    if latency_summary () != '': lprint (latency_summary ())
+    if batch == '' and datasets[0]['status'] != 'ok': exit(1)
+    lprint ('') # spacer
+    if batch != '':
+        lprint (str(len([dataset for dataset in datasets if dataset['status']=='ok']))+' of '+
+                str(len(datasets))+' spectro files processed successfully')
+        lprint ('Summary written to '+write_summary (datasets))
+    if profile_file != '' or prometheus_file != '':
+        try: write_profile (profile_file, prometheus_file)
+        except: lprint ('ERROR:  Problem writing profile') # the results are written anyway
 
-#delete tempdir
-try: shutil.rmtree(tempdir)
-except: pass # silent
-lprint ('done\n')
-sys.stderr.close() # close logfile
+    lprint ('done\n')
+    sys.stderr.close() # close logfile
 
-#reenable console windows close button
-if pywin32_installed:
-    try:
-        hwnd = win32console.GetConsoleWindow()
-        hMenu = win32gui.GetSystemMenu(hwnd, 1)
-        win32gui.DeleteMenu(hMenu, win32con.SC_CLOSE, win32con.MF_BYCOMMAND)
-    except: pass #silent
-
-#pause
-if Interactive:
-    if sys.platform=="win32": os.system("pause") # windows
-    else: 
-        #os.system('read -s -n 1 -p "Press any key to continue...\n"')
-        import termios
-        print("Press any key to continue...")
-        fd = sys.stdin.fileno()
-        oldterm = termios.tcgetattr(fd)
-        newattr = termios.tcgetattr(fd)
-        newattr[3] = newattr[3] & ~termios.ICANON & ~termios.ECHO
-        termios.tcsetattr(fd, termios.TCSANOW, newattr)
-        try: result = sys.stdin.read(1)
-        except IOError: pass
-        finally: termios.tcsetattr(fd, termios.TCSAFLUSH, oldterm)   
+    #reenable console windows close button
+    console_close_button (True)
 
+    #pause
+    if Interactive:
+        if sys.platform=="win32": os.system("pause") # windows
+        else: 
+            #os.system('read -s -n 1 -p "Press any key to continue...\n"')
+            import termios
+            print("Press any key to continue...")
+            fd = sys.stdin.fileno()
+            oldterm = termios.tcgetattr(fd)
+            newattr = termios.tcgetattr(fd)
+            newattr[3] = newattr[3] & ~termios.ICANON & ~termios.ECHO
+            termios.tcsetattr(fd, termios.TCSANOW, newattr)
+            try: result = sys.stdin.read(1)
+            except IOError: pass
+            finally: termios.tcsetattr(fd, termios.TCSAFLUSH, oldterm)
 
+if __name__ == '__main__':
+    main ()
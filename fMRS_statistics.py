@@ -55,50 +55,70 @@ import shutil
 import subprocess
 import time
 import datetime
+import threading
+import json
+import socket
 from getopt import getopt
 from getopt import GetoptError
-from distutils.version import LooseVersion
 
 import csv
 import numpy
-from scipy import stats
-try: 
-    from scipy.sparse.csgraph import _validation    # needed for pyinstaller
-    from scipy.special import _ufuncs_cxx           # needed for pyinstaller
-except: pass
 
+# scipy, tkinter and pywin32 are only imported when needed (import_scipy, choose_file,
+# console_close_button), importing this module has no side effects, 
+# main() is the commandline program
 
-TK_installed=True
-try: from tkFileDialog import askopenfilename # Python 2
-except: 
-  try: from tkinter.filedialog import askopenfilename; # Python3
-  except: TK_installed=False
-try: import Tkinter as tk; # Python2
-except: 
-  try: import tkinter as tk; # Python3
-  except: TK_installed=False
-try: import win32gui, win32console
-except: pass #silent  
-
-pywin32_installed=True
-try: import win32console, win32gui, win32con
-except: pywin32_installed=True
-
+try: input = raw_input # python 2, input() would evaluate the answer there
+except NameError: pass
 
 if sys.platform=="win32": slash='\\'
 else: slash='/'
 
 def exit (code):
     # cleanup 
-    try: shutil.rmtree(tempdir)
-    except: pass # silent
-    if pywin32_installed:
-        try: # reenable console windows close button (useful if called command line or batch file)
-            hwnd = win32console.GetConsoleWindow()
-            hMenu = win32gui.GetSystemMenu(hwnd, 1)
-            win32gui.DeleteMenu(hMenu, win32con.SC_CLOSE, win32con.MF_BYCOMMAND)
-        except: pass #silent
+    console_close_button (True) # useful if called command line or batch file
     sys.exit(code)
+def console_close_button (enable): # windows console, requires pywin32
+    if sys.platform!="win32": return
+    try: 
+        import win32console, win32gui, win32con
+        hwnd = win32console.GetConsoleWindow()
+        if enable: hMenu = win32gui.GetSystemMenu(hwnd, 1)
+        else:      hMenu = win32gui.GetSystemMenu(hwnd, 0)
+        win32gui.DeleteMenu(hMenu, win32con.SC_CLOSE, win32con.MF_BYCOMMAND)
+    except: pass #silent
+def import_scipy (): # the scipy modules used, (stats, special)
+    from scipy import stats
+    from scipy import special
+    try: 
+        from scipy.sparse.csgraph import _validation    # needed for pyinstaller
+        from scipy.special import _ufuncs_cxx           # needed for pyinstaller
+    except: pass
+    return stats, special
+def choose_file (title): # interactive file dialog, None if tkinter is not available
+    try: 
+        try: import Tkinter as tk; from tkFileDialog import askopenfilename # Python2
+        except: import tkinter as tk; from tkinter.filedialog import askopenfilename # Python3
+        TKwindows = tk.Tk(); TKwindows.withdraw() #hiding tkinter window
+        TKwindows.update()
+    except: return None
+    # the following tries to disable showing hidden files/folders under linux
+    try: TKwindows.tk.call('tk_getOpenFile', '-foobarz')
+    except: pass
+    try: TKwindows.tk.call('namespace', 'import', '::tk::dialog::file::')
+    except: pass
+    try: TKwindows.tk.call('set', '::tk::dialog::file::showHiddenBtn', '1')
+    except: pass
+    try: TKwindows.tk.call('set', '::tk::dialog::file::showHiddenVar', '0')
+    except: pass
+    TKwindows.update()
+    filename = askopenfilename(title=title)
+    TKwindows.update()
+    try: 
+        import win32gui, win32console
+        win32gui.SetForegroundWindow(win32console.GetConsoleWindow())
+    except: pass #silent
+    return filename
 def signal_handler(signal, frame):
     lprint ('User abort')
     exit(1)
@@ -112,12 +132,250 @@ def lprint (message):
 def checkfile(file): # generic check if file exists
     if not os.path.isfile(file): 
         lprint ('ERROR:  File "'+file+'" not found '); exit(1)    
+def temp_name (file): # next to file, unique for every process on every node sharing the directory
+    return file+'.'+socket.gethostname()+'-'+str(os.getpid())+'.tmp'
+def replace_file (temp, file): # atomic, readers (other runs, scrapers) never see a partial file
+    if sys.platform=="win32": delete (file) # rename does not overwrite on windows
+    os.rename(temp, file)
+def write_file (file, text): # atomic, see replace_file
+    temp = temp_name (file)
+    with open(temp, 'w') as f: f.write(text)
+    replace_file (temp, file)
 def delete (file):
     try: os.remove(file)
     except: pass #silent      
+def reset_profile (): # start of the instrumentation, see stage_start/stage_end
+    global profile
+    profile = {'start': time.time(), 'times': os.times(), 'stages': {}}
+def stage_start (): # returns the start (wall, CPU) for stage_end
+    times = os.times()
+    return (time.time(), times[0]+times[1])
+def stage_end (name, timer): # adds wall and CPU time since stage_start to the stage name
+    times = os.times()
+    entry = profile['stages'].setdefault(name, {'calls': 0, 'wall': 0., 'cpu': 0.})
+    entry['calls'] += 1
+    entry['wall'] += time.time()-timer[0]
+    entry['cpu'] += times[0]+times[1]-timer[1]
+def peak_memory (): # peak resident memory in bytes
+    try: import resource # not on windows
+    except ImportError: return None
+    if sys.platform == 'darwin': scale = 1 # bytes
+    else: scale = 1024 # kB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale
+def profile_report (): # the instrumentation as dict (JSON)
+    times = os.times(); memory = peak_memory ()
+    report = {'program': Program_name, 'version': Program_version, 'timestamp': timestamp,
+              'wall': time.time()-profile['start'], 
+              'cpu': times[0]+times[1]-profile['times'][0]-profile['times'][1],
+              'peak_memory': memory,
+              'stages': profile['stages']}
+    return report
+def write_profile (jsonfile, promfile): # JSON and/or Prometheus text format
+    report = profile_report ()
+    if jsonfile != '':
+        write_file (jsonfile, json.dumps(report, indent=1, sort_keys=True, default=float))
+    if promfile == '': return
+    labels = 'program="'+Program_name+'"'
+    lines = ['# HELP fmrs_run_seconds Wall time of the run', '# TYPE fmrs_run_seconds gauge',
+             'fmrs_run_seconds{'+labels+'} '+repr(report['wall']),
+             '# HELP fmrs_cpu_seconds CPU time of the run', '# TYPE fmrs_cpu_seconds gauge',
+             'fmrs_cpu_seconds{'+labels+'} '+repr(report['cpu'])]
+    if report['peak_memory'] != None:
+        lines += ['# HELP fmrs_peak_memory_bytes Peak resident memory', '# TYPE fmrs_peak_memory_bytes gauge',
+                  'fmrs_peak_memory_bytes{'+labels+'} '+str(report['peak_memory'])]
+    lines += ['# HELP fmrs_stage_seconds Wall time per stage', '# TYPE fmrs_stage_seconds gauge']
+    lines += ['fmrs_stage_seconds{'+labels+',stage="'+name+'"} '+repr(report['stages'][name]['wall']) for name in sorted(report['stages'])]
+    lines += ['# HELP fmrs_stage_cpu_seconds CPU time per stage', '# TYPE fmrs_stage_cpu_seconds gauge']
+    lines += ['fmrs_stage_cpu_seconds{'+labels+',stage="'+name+'"} '+repr(report['stages'][name]['cpu']) for name in sorted(report['stages'])]
+    write_file (promfile, '\n'.join(lines)+'\n') # the file might be scraped any time
+def read_paradigm (filename, n_dynamics, tr, paradigm_tr, events=False):
+    # paradigm value per dynamic from a textfile with either
+    #   values: one per line (or the first column of a CSV), one per dynamic or, 
+    #           with paradigm_tr, one every paradigm_tr seconds
+    #   events: columns named "onset" and "duration" in a header line (BIDS events), or
+    #           with events=True onset, duration [,amplitude] in seconds per line (FSL 3 column format)
+    # resampled values and events are averaged over every dynamic (of tr seconds)
+    with open(filename) as f: 
+        rows = [line.replace(',',' ').replace(';',' ').split() for line in f]
+    rows = [row for row in rows if len(row)>0 and not row[0].startswith('#')]
+    if len(rows) == 0: raise ValueError('no paradigm values in '+filename)
+    header = []
+    try: float(rows[0][0])
+    except ValueError: header = [name.lower() for name in rows[0]]; rows = rows[1:]
+    if 'onset' in header and 'duration' in header: 
+        columns = [header.index('onset'), header.index('duration')]
+        if 'amplitude' in header: columns.append(header.index('amplitude'))
+    elif events: 
+        if len(header) > 0 or not len(rows[0]) in [2,3]: raise ValueError('events need 2 or 3 columns and no header')
+        columns = list(range(len(rows[0])))
+    else: columns = [0]
+    values = numpy.asarray([[float(row[i]) for i in columns] for row in rows])
+    if len(columns) == 1 and paradigm_tr == 0: return values[:,0] # one per dynamic
+    if tr == 0: raise ValueError('--tr is required for events or resampling the paradigm')
+    boundaries = numpy.arange(n_dynamics+1)*tr # integral of the paradigm up to every dynamic
+    if len(columns) == 1:
+        times = numpy.arange(values.shape[0]+1)*paradigm_tr
+        integral = numpy.interp(boundaries, times, numpy.concatenate(([0.], numpy.cumsum(values[:,0])*paradigm_tr)))
+    else:
+        amplitude = values[:,2] if len(columns) == 3 else numpy.ones(values.shape[0])
+        integral = numpy.dot(numpy.clip(boundaries[:,numpy.newaxis]-values[:,0], 0., values[:,1]), amplitude)
+    return numpy.diff(integral)/tr
+def smooth (values, window):
+    # sliding window mean in one cumulative sum, element i is averaged over the same 
+    # members as spectrum i in fMRS_sliding_window (i-window//2 ... i-window//2+window-1,
+    # clipped to the series)
+    return smooth_windows (values, [window])[0]
+def smooth_windows (values, windows): # smooth for all windows from one cumulative sum, (windows, n)
+    n = values.shape[0]; windows = numpy.asarray(windows, dtype=int)[:,numpy.newaxis]
+    cumulative = numpy.concatenate(([0.], numpy.cumsum(values)))
+    start = numpy.clip(numpy.arange(n)-windows//2, 0, n)
+    end = numpy.clip(numpy.arange(n)-windows//2+windows, 0, n)
+    return (cumulative[end]-cumulative[start])/(end-start)
+def parse_windows (string): # e.g. "5", "1,3,5,9" or "1-15", returns sorted list
+    windows = []
+    for part in string.split(','):
+        if '-' in part.strip()[1:]: 
+            first, last = part.split('-',1)
+            windows += range(int(first), int(last)+1)
+        else: windows.append(int(part))
+    return sorted(set(windows))
+def lag_correlations (paradigm, data, n_shifts):
+    # Pearson correlation coefficient and two sided p-value (as stats.pearsonr) of 
+    # paradigm (length L) against every column of data at the shifts 0..n_shifts-1,
+    # shift j correlates with data[j:j+L]. The cross terms for all shifts come from one 
+    # FFT cross-correlation and the window sums from cumulative sums, so the cost barely
+    # grows with n_shifts. Returns r and p of shape (columns, n_shifts), 
+    # NaN where the data window is constant or contains NaNs. With several paradigms
+    # (paradigms, L) they share the FFT of the data, r and p are (paradigms, columns, n_shifts)
+    stats, special = import_scipy ()
+    single = paradigm.ndim == 1; paradigm = numpy.atleast_2d(paradigm)
+    L = paradigm.shape[1]; N = data.shape[0]
+    paradigm = paradigm - numpy.mean(paradigm, axis=1)[:,numpy.newaxis]
+    bad = ~numpy.isfinite(data)
+    x = numpy.where(bad, 0., data)
+    x = x - numpy.sum(x, axis=0)/numpy.maximum(numpy.sum(~bad, axis=0), 1) # r is shift invariant,
+    x[bad] = 0.                                                             # this reduces roundoff
+    nfft = 1
+    while nfft < N+L: nfft *= 2
+    cross = numpy.fft.irfft(numpy.conj(numpy.fft.rfft(paradigm, nfft, axis=1))[:,:,numpy.newaxis]*
+                            numpy.fft.rfft(x, nfft, axis=0), nfft, axis=1)[:,:n_shifts]
+    def window_sums (values): # sum over values[j:j+L] for all shifts j
+        cumulative = numpy.zeros((N+1, values.shape[1]))
+        numpy.cumsum(values, axis=0, out=cumulative[1:])
+        return cumulative[L:L+n_shifts] - cumulative[:n_shifts]
+    sum1 = window_sums (x); sum2 = window_sums (x*x)
+    variance = sum2 - sum1*sum1/L # times L
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        r = cross / (numpy.sqrt(numpy.sum(paradigm*paradigm, axis=1))[:,numpy.newaxis,numpy.newaxis] * numpy.sqrt(variance))
+        r[:,(variance <= 1e-13*sum2) | (window_sums (bad.astype(float)) > 0)] = numpy.nan
+        r = numpy.clip(r, -1., 1.)
+        df = L-2 # p-value from the t-distribution, written as incomplete beta function,
+                 # undefined r gives p=1 as pearsonr did in the scipy we ship with
+        p = special.betainc(0.5*df, 0.5, numpy.where(numpy.isnan(r), 1., numpy.clip(1.-r*r, 0., 1.)))
+    if single: return r[0].T, p[0].T
+    return r.transpose(0,2,1), p.transpose(0,2,1)
+def surrogates (x, n, method, block, random_state):
+    # n surrogate time courses of every column of x (dynamics, columns), 
+    # returned as (dynamics, n*columns) with surrogate k of column m at k*columns+m
+    #   phase: Fourier phases randomized, keeps the power spectrum (autocorrelation)
+    #   block: (circular) blocks of <block> dynamics randomly permuted
+    N = x.shape[0]; M = x.shape[1]
+    if method == 'phase':
+        spectrum = numpy.fft.rfft(x, axis=0)
+        phases = numpy.exp(2j*numpy.pi*random_state.uniform(size=(spectrum.shape[0], n, M)))
+        phases[0] = 1. # keep the mean
+        if N%2 == 0: phases[-1] = 1. # and the (real) nyquist component
+        return numpy.fft.irfft(spectrum[:,numpy.newaxis,:]*phases, N, axis=0).reshape(N, n*M)
+    n_blocks = -(-N//block)
+    order = numpy.argsort(random_state.uniform(size=(n, n_blocks)), axis=1)
+    index = ((order[:,:,numpy.newaxis]*block + numpy.arange(block)) % N).reshape(n, -1)[:, :N]
+    return x[index.T].reshape(N, n*M)
+def surrogate_test (paradigm, data, r, n_surrogates, method, block, seed, n_jobs, chunk=100):
+    # p-values of the correlations r (columns, shifts) of lag_correlations, from the
+    # null distribution of n_surrogates surrogates of each column of data. Surrogates 
+    # are evaluated in chunks (each with its own seed+chunk random generator, so the
+    # result does not depend on n_jobs) on n_jobs threads. Returns the p-values per
+    # shift and the family wise ones against the maximum over all shifts 
+    M = data.shape[1]; n_shifts = r.shape[1]
+    valid = numpy.all(numpy.isfinite(data), axis=0)
+    x = numpy.where(numpy.isfinite(data), data, 0.)
+    observed = numpy.where(numpy.isnan(r), numpy.inf, numpy.abs(r))
+    chunks = [(i, min(chunk, n_surrogates-i*chunk)) for i in range(-(-n_surrogates//chunk))]
+    results = []; lock = threading.Lock()
+    def evaluate (item): 
+        i, n = item
+        random_state = numpy.random.RandomState((seed+i) % 2**32)
+        null = lag_correlations (paradigm, surrogates (x, n, method, block, random_state), n_shifts)[0]
+        null = numpy.abs(null.reshape(n, M, n_shifts))
+        null[numpy.isnan(null)] = 0.
+        exceed = numpy.sum(null >= observed, axis=0)
+        exceed_max = numpy.sum(numpy.amax(null, axis=2)[:,:,numpy.newaxis] >= observed, axis=0)
+        with lock: results.append((exceed, exceed_max))
+    try: run_threads (evaluate, chunks, n_jobs)
+    except Exception as e: raise RuntimeError ('surrogate calculation failed, '+str(e))
+    p = (1. + sum(result[0] for result in results)) / (1. + n_surrogates)
+    p_max = (1. + sum(result[1] for result in results)) / (1. + n_surrogates)
+    p[numpy.isnan(r) | ~valid[:,numpy.newaxis]] = numpy.nan
+    p_max[numpy.isnan(r) | ~valid[:,numpy.newaxis]] = numpy.nan
+    return p, p_max
+def run_threads (function, items, n_jobs): 
+    # calls function(item) for all items on n_jobs threads, the first exception
+    # of a thread is raised again here
+    items = list(items); errors = []; lock = threading.Lock()
+    def worker ():
+        while True:
+            with lock:
+                if not items or errors: return
+                item = items.pop(0)
+            try: function (item)
+            except Exception as e: 
+                with lock: errors.append(e)
+    threads = [threading.Thread(target=worker) for i in range(n_jobs)]
+    for thread in threads: thread.daemon = True; thread.start()
+    for thread in threads: thread.join()
+    if errors: raise errors[0]
+def canonical_hrf (tr, length=32.):
+    # double gamma response function (peak ~5s, undershoot ~15s) sampled at tr,
+    # normalized to unit sum so the regressor keeps the paradigm scale
+    stats, special = import_scipy ()
+    t = numpy.arange(0., length, tr)
+    hrf = stats.gamma.pdf(t, 6) - stats.gamma.pdf(t, 16)/6.
+    return hrf/numpy.sum(hrf)
+def design_matrix (paradigm, tr, hrf, drift, nuisance):
+    # GLM design (dynamics, regressors): paradigm (convolved with the response 
+    # function), Legendre polynomials up to order <drift> (the constant included) 
+    # and nuisance regressors (dynamics, n), the paradigm is regressor 0
+    L = paradigm.shape[0]
+    regressor = paradigm
+    if hrf == 'canonical': regressor = numpy.convolve(paradigm, canonical_hrf (tr))[:L]
+    columns = [regressor[:,numpy.newaxis], numpy.polynomial.legendre.legvander(numpy.linspace(-1.,1.,L), drift)]
+    if nuisance is not None: columns.append(nuisance[:L])
+    return numpy.concatenate(columns, axis=1)
+def glm (design, data, n_shifts, contrast):
+    # fits the design (L, regressors) to data[j:j+L] of every column for all shifts j 
+    # in one least squares solve, the pseudo-inverse is shared by all columns and 
+    # shifts. Returns contrast estimate, t- and p-values of shape (columns, n_shifts)
+    stats, special = import_scipy ()
+    L = design.shape[0]; M = data.shape[1]
+    windows = numpy.lib.stride_tricks.as_strided(data, shape=(L, n_shifts, M),
+              strides=(data.strides[0], data.strides[0], data.strides[1]))
+    Y = windows.reshape(L, n_shifts*M) # copy, column j*M+m is shift j of column m
+    pinv = numpy.linalg.pinv(design)
+    beta = numpy.dot(pinv, Y)
+    residuals = Y - numpy.dot(design, beta)
+    df = L - numpy.linalg.matrix_rank(design)
+    variance = numpy.sum(residuals*residuals, axis=0)/df
+    effect = numpy.dot(contrast, beta)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        t = effect / numpy.sqrt(variance*numpy.dot(contrast, numpy.dot(numpy.dot(pinv, pinv.T), contrast)))
+    constant = numpy.sum((Y-numpy.mean(Y, axis=0))**2, axis=0) <= 1e-13*numpy.sum(Y*Y, axis=0)
+    t[constant] = numpy.nan # nothing to explain, as lag_correlations
+    p = 2.*stats.t.sf(numpy.abs(t), df)
+    return effect.reshape(n_shifts, M).T, t.reshape(n_shifts, M).T, p.reshape(n_shifts, M).T
 def usage():
     lprint ('')
     lprint ('Usage: '+Program_name+' [options] --csv=<csvfile> --paradigm=<paradigmfile>')
+    lprint ('       '+Program_name+' [options] --group=<path> --paradigm=<paradigmfile>')
     lprint ('')
     lprint ('   Available options are:')
     lprint ('       --outdir=<path>    : output directory, if not specified')
@@ -125,16 +383,79 @@ def usage():
     lprint ('       --window=<integer> : number of spectra to average in sliding window')
     lprint ('                            should be within 1-50, if not specified ')
     lprint ('                            the user will be prompted to input interactively')    
+    lprint ('                            a list and/or range (e.g. 1,3,5 or 1-15) sweeps')
+    lprint ('                            the correlation over all of these windows')
+    lprint ('       --sweep            : the same as --window=1-50')
+    lprint ('       --max_shift=<n>    : number of shifts (in dynamics) between paradigm and')
+    lprint ('                            data to correlate, default 60')
+    lprint ('       --surrogates=<n>   : calculate p-values from n surrogates of each')
+    lprint ('                            metabolite time course (e.g. 10000)')
+    lprint ('       --surrogate_method=<phase|block> : phase randomized (default) or')
+    lprint ('                            block permuted surrogates')
+    lprint ('       --block=<n>        : block length for block permutation,')
+    lprint ('                            default twice the sliding window (min 10)')
+    lprint ('       --seed=<n>         : random seed, for reproducible surrogates')
+    lprint ('       --jobs=<n>         : number of threads for surrogates and group mode,')
+    lprint ('                            default 1')
+    lprint ('       --group=<path>     : group statistics of all fMRS_sliding_window result')
+    lprint ('                            CSVs in a directory tree, or listed in a textfile')
+    lprint ('                            (one per line), instead of --csv')
+    lprint ('       --paradigm_tr=<seconds> : sampling interval of paradigm values')
+    lprint ('       --events           : the paradigm file has events "onset duration')
+    lprint ('                            [amplitude]" per line, without header (FSL format)')
+    lprint ('       --glm              : general linear model statistics in addition')
+    lprint ('       --tr=<seconds>     : repetition time of the dynamics (for --glm)')
+    lprint ('       --hrf=<canonical|none> : response function the paradigm is')
+    lprint ('                            convolved with, default canonical')
+    lprint ('       --drift=<n>        : order of polynomial drift regressors, default 2')
+    lprint ('       --nuisance=<file>  : textfile with additional regressors (columns)')
+    lprint ('       --profile=<file>   : write time, CPU time and memory per stage as JSON')
+    lprint ('       --prometheus=<file>: the same in Prometheus text format')
     lprint ('       --help (or -h)     : usage and help')
     lprint ('       --version          : version information')
     lprint ('')
 def help():
     lprint ('')
     lprint ('the <csvfile> is the output from fMRS_sliding_window') 
+    lprint ('              (.csv, or the binary .npz written alongside)') 
     lprint ('')
     lprint ('the <paradigmfile> is a textfile specifying the paradigm')
-    lprint ('              in form of 0 and 1 values separated by lines') 
-    lprint ('              if unspecified, the default "paradigm.txt"wil be used') 
+    lprint ('              in form of 0 and 1 values separated by lines (or the')
+    lprint ('              first column of a CSV file), one per dynamic or one every')
+    lprint ('              --paradigm_tr seconds, or in form of events in seconds')
+    lprint ('              with --tr: a BIDS events file with "onset" and "duration"')
+    lprint ('              columns, or with --events "onset duration [amplitude]"') 
+    lprint ('              per line.') 
+    lprint ('              if unspecified, a fixed 360 dynamics paradigm is used') 
+    lprint ('              (blocks at 60-120, 180-240 and 300-360)') 
+    lprint ('')
+    lprint ('the p-values assume independent samples, which the sliding window')
+    lprint ('              averaged data are not, using --surrogates is recommended.')
+    lprint ('              This writes two more files, *_pvalues_surrogate.csv with the') 
+    lprint ('              p-values per shift and *_pvalues_fwe.csv corrected for') 
+    lprint ('              testing all shifts (against the maximum over all shifts)') 
+    lprint ('')
+    lprint ('--group correlates (and with --glm fits) every subject and tests the') 
+    lprint ('              Fisher z transformed correlations (and the GLM beta) of all') 
+    lprint ('              subjects with a one sample t-test per metabolite and shift.') 
+    lprint ('              All subjects need the same number of dynamics and paradigm.') 
+    lprint ('              Writes <name>_group.csv with mean r, t- and p-values and') 
+    lprint ('              <name>_group.npz with these and the correlations per subject') 
+    lprint ('              The report shows every metabolite at the shift of its largest') 
+    lprint ('              group mean effect, with p-values Bonferroni corrected for all') 
+    lprint ('              metabolites and shifts tested') 
+    lprint ('')
+    lprint ('a window sweep correlates the paradigm smoothed with every window and')
+    lprint ('              writes <name>_sweep.csv with the best window and shift per')
+    lprint ('              metabolite and <name>_sweep.npz with correlations and p-values')
+    lprint ('              of shape (windows, shifts, metabolites). The p-values of the')
+    lprint ('              best window and shift are not corrected for the selection')
+    lprint ('')
+    lprint ('--glm fits paradigm, drift and nuisance regressors to the metabolites') 
+    lprint ('              at all shifts and writes *_glm_beta.csv, *_glm_tvalues.csv') 
+    lprint ('              and *_glm_pvalues.csv for the paradigm regressor.') 
+    lprint ('              Like the paradigm, nuisance regressors (one value per') 
+    lprint ('              dynamic and column) are not shifted') 
     lprint ('')
     lprint ('Limitations:')   
     lprint (' - to be able to interactively choose the input files')
@@ -142,275 +463,573 @@ def help():
     lprint ('   for installation instructions see http://wiki.python.org/moin/TkInter')    
     lprint ('')
 
-# general initialization stuff   
-debug=False; NIFTI_Input=False; SPAR_Input=True
-csvfilename=''; paradigmfile=''
-slash='/'; 
-if sys.platform=="win32": slash='\\' # not really needed, but looks nicer ;)
-Program_name = os.path.basename(sys.argv[0]); 
-if Program_name.find('.')>0: Program_name = Program_name[:Program_name.find('.')]
-basedir = os.getcwd()+slash # current working directory is the default output directory 
-for arg in sys.argv[1:]: # look in command line arguments if the output directory specified
-    if "--outdir" in arg: basedir = os.path.abspath(arg[arg.find('=')+1:])+slash #
+def read_results (csvfilename): 
+    # fMRS_sliding_window results, returns (metabolites, header line), fMRS_sliding_window 
+    # writes a binary copy next to the CSV (.npz) which is used instead of parsing the 
+    # text if it is up to date
+    npzfilename = os.path.splitext(csvfilename)[0]+'.npz'
+    if not os.path.isfile(npzfilename) or (csvfilename != npzfilename and 
+           os.path.getmtime(npzfilename) < os.path.getmtime(csvfilename)): npzfilename = ''
+    if npzfilename != '':
+        logwrite ('Reading '+npzfilename)
+        with numpy.load(npzfilename) as results:
+            metabolites = results['amplitudes']
+            names = [name.decode() if isinstance(name, bytes) else str(name) for name in results['names']]
+        return metabolites, ','.join(names)+'\n'
+    # read CSV header
+    with open(csvfilename) as f:
+        data = f.readlines()
+        CSV_header1 = data[0] 
+        CSV_header2 = data[1]  
+    # read CSV data
+    return numpy.genfromtxt(csvfilename,delimiter=",",skip_header=2), CSV_header2
+def default_paradigm (): # fixed 360 dynamics paradigm
+    paradigm = numpy.zeros (360, dtype=float)
+    paradigm[60:120]=1.; paradigm[180:240]=1.; paradigm[300:360]=1.
+    return paradigm
+def statistics (metabolites, paradigm, sliding_window, max_shift=60, n_surrogates=0, 
+                surrogate_method='phase', block=0, seed=None, n_jobs=1, 
+                GLM=False, TR=0., hrf='canonical', drift=2, nuisance=None):
+    # all statistics of the metabolites (dynamics, columns) against the paradigm 
+    # (one value per dynamic) at max_shift shifts. Returns a list of (name, values) with
+    # values of shape (columns, max_shift), the first 3 columns (Row,Col,Slice) are 0.
+    # Errors raise ValueError
+    # consistency check CSV-Paradigm
+    if paradigm.shape[0] != metabolites.shape[0]:
+        raise ValueError ('dimension mismatch of CSV data ('+str(metabolites.shape[0])+') and Paradigm ('+str(paradigm.shape[0])+')')
+    # calc Paradigm data with sliding window (same averaging as the spectra)
+    timer = stage_start ()
+    paradigm_sl_win = smooth (paradigm, sliding_window)
+    # cut off last paradigm block
+    if paradigm.shape[0]-max_shift < 3:
+        raise ValueError ('max_shift ('+str(max_shift)+') too large for '+str(paradigm.shape[0])+' dynamics')
+    paradigm_sl_win = paradigm_sl_win [0:paradigm.shape[0]-max_shift]   
+
+    # correlate all metabolites (first 3 columns are Row,Col,Slice) at all shifts
+    pvalue = numpy.zeros ([metabolites.shape[1],max_shift], dtype=float)
+    correlation = numpy.zeros ([metabolites.shape[1],max_shift], dtype=float) 
+    correlation[3:,:], pvalue[3:,:] = lag_correlations (paradigm_sl_win, metabolites[:,3:], max_shift)
+    stage_end ('correlation', timer)
+    outputs = [('_correlations', correlation), ('_pvalues', pvalue)]
+
+    # significance from surrogate data (null distribution of autocorrelated time courses)
+    if n_surrogates>0:
+        if block==0: block = max(2*sliding_window, 10)
+        if seed==None: seed = random.randrange(2**31) # logged to be able to reproduce
+        lprint ('Calculating '+str(n_surrogates)+' '+surrogate_method+' surrogates (seed='+str(seed)+')')
+        if surrogate_method == 'block': logwrite ('Surrogate block length '+str(block))
+        start_time = time.time(); timer = stage_start ()
+        pvalue_surrogate = numpy.zeros ([metabolites.shape[1],max_shift], dtype=float)
+        pvalue_fwe = numpy.zeros ([metabolites.shape[1],max_shift], dtype=float)
+        pvalue_surrogate[3:,:], pvalue_fwe[3:,:] = surrogate_test (paradigm_sl_win, metabolites[:,3:], 
+           correlation[3:,:], n_surrogates, surrogate_method, block, seed, n_jobs)
+        stage_end ('surrogates', timer)
+        logwrite ('Surrogates calculated in '+str(round(time.time()-start_time,2))+'s')
+        outputs += [('_pvalues_surrogate', pvalue_surrogate), ('_pvalues_fwe', pvalue_fwe)]
+
+    # general linear model, paradigm regressor at all shifts
+    if GLM:
+        if nuisance is not None and nuisance.shape[0] < paradigm_sl_win.shape[0]:
+            raise ValueError (str(nuisance.shape[0])+' nuisance values, at least '+str(paradigm_sl_win.shape[0])+' needed')
+        timer = stage_start ()
+        design = design_matrix (paradigm_sl_win, TR, hrf, drift, nuisance)
+        logwrite ('GLM design with '+str(design.shape[1])+' regressors, hrf '+hrf+', drift order '+str(drift))
+        if numpy.linalg.matrix_rank(design) >= design.shape[0]:
+            raise ValueError ('too many GLM regressors for '+str(design.shape[0])+' dynamics')
+        contrast = numpy.zeros(design.shape[1]); contrast[0] = 1.
+        glm_beta = numpy.zeros ([metabolites.shape[1],max_shift], dtype=float)
+        glm_t = numpy.zeros ([metabolites.shape[1],max_shift], dtype=float)
+        glm_p = numpy.zeros ([metabolites.shape[1],max_shift], dtype=float)
+        glm_beta[3:,:], glm_t[3:,:], glm_p[3:,:] = glm (design, metabolites[:,3:], max_shift, contrast)
+        stage_end ('glm', timer)
+        outputs += [('_glm_beta', glm_beta), ('_glm_tvalues', glm_t), ('_glm_pvalues', glm_p)]
+    return outputs
+def sweep (metabolites, paradigm, windows, max_shift=60):
+    # correlations of the metabolites (dynamics, columns) with the paradigm smoothed with
+    # every sliding window in windows at all shifts, all paradigms from one cumulative sum
+    # and correlated in one batched lag_correlations. Returns a dict with the cubes r and p
+    # (windows, max_shift, columns) and per column the window and shift of the largest |r|
+    # (the p-value of that maximum is not corrected for the selection). The first 3
+    # columns (Row,Col,Slice) are NaN. Errors raise ValueError
+    if paradigm.shape[0] != metabolites.shape[0]:
+        raise ValueError ('dimension mismatch of CSV data ('+str(metabolites.shape[0])+') and Paradigm ('+str(paradigm.shape[0])+')')
+    if paradigm.shape[0]-max_shift < 3:
+        raise ValueError ('max_shift ('+str(max_shift)+') too large for '+str(paradigm.shape[0])+' dynamics')
+    timer = stage_start ()
+    paradigms = smooth_windows (paradigm, windows)[:,0:paradigm.shape[0]-max_shift]
+    W = len(windows); M = metabolites.shape[1]
+    r = numpy.full((W, max_shift, M), numpy.nan); p = numpy.full((W, max_shift, M), numpy.nan)
+    correlation, pvalue = lag_correlations (paradigms, metabolites[:,3:], max_shift)
+    r[:,:,3:] = correlation.transpose(0,2,1); p[:,:,3:] = pvalue.transpose(0,2,1)
+    best = numpy.argmax(numpy.where(numpy.isnan(r), -1., numpy.abs(r)).reshape(W*max_shift, M), axis=0)
+    columns = numpy.arange(M)
+    result = {'windows': numpy.asarray(windows), 'r': r, 'p': p,
+              'best_window': numpy.asarray(windows)[best//max_shift], 'best_shift': best%max_shift,
+              'best_r': r[best//max_shift, best%max_shift, columns], 'best_p': p[best//max_shift, best%max_shift, columns]}
+    stage_end ('sweep', timer)
+    return result
+def write_sweep (result, basename, header):
+    # best window and shift per metabolite as CSV, the cubes as .npz. Returns the files written
+    stp=''; space = ' ' # for name collision detection
+    if os.path.isfile(basename+'_sweep'+stp+'.csv'): stp='_'+timestamp+ID
+    names = header.rstrip('\n').split(',')
+    f = open(basename+'_sweep'+stp+'.csv', 'w')
+    windows = ','.join([str(window) for window in result['windows']])
+    if list(result['windows']) == list(range(result['windows'][0], result['windows'][-1]+1)):
+        windows = str(result['windows'][0])+'-'+str(result['windows'][-1])
+    f.write(Program_name+space+Program_version+' Sweep results (windows '+windows+'):\n')
+    f.write('metabolite,window,shift,correlation,pvalue\n')
+    for i in range(3, len(names)):
+        f.write(names[i]+','+','.join([str(result[key][i]) for key in ['best_window', 'best_shift', 'best_r', 'best_p']])+'\n')
+    f.close()
+    numpy.savez (basename+'_sweep'+stp+'.npz', names=numpy.asarray(names), **result)
+    return [basename+'_sweep'+stp+'.csv', basename+'_sweep'+stp+'.npz']
+def report_sweep (result, header): # print the best window and shift of the correlations found
+    treshold = 0.5; p_tresh = 0.05
+    metabolitenames = header.rstrip('\n').split(",")
+    Found = False
+    for i in range (3, len(metabolitenames)):
+        if abs(result['best_r'][i])>treshold and result['best_p'][i]<p_tresh:
+            Found = True
+            lprint ('Best correlation = '+format(result['best_r'][i], '.2f')+' (p='+format(result['best_p'][i], '.2E')+
+                    ') in metabolite "'+metabolitenames[i]+'" with window '+str(result['best_window'][i])+' at shift '+str(result['best_shift'][i]))
+    if not Found: lprint ('No correlations found (|correlation|>'+str(treshold)+', p<'+str(p_tresh)+')') 
+def write_results (outputs, basename, header): # one CSV per output, basename+name+'.csv'
+    stp=''; space = ' ' # for name collision detection
+    if os.path.isfile(basename+outputs[0][0]+stp+'.csv'): stp='_'+timestamp+ID
+    files = []
+    for suffix, values in outputs:
+        f = open(basename+suffix+stp+'.csv', 'w')
+        f.write(Program_name+space+Program_version+' Results:\n')
+        f.write(header)
+        for j in  range (values.shape[1]): 
+            f.write(','.join([str(values[i,j]) for i in range (values.shape[0])])+'\n')
+        f.close()
+        files.append(basename+suffix+stp+'.csv')
+    return files
+def report (outputs, header): # print the correlations and GLM effects found
+    outputs = dict(outputs)
+    correlation = outputs['_correlations']
+    pvalue = outputs.get('_pvalues_surrogate', outputs['_pvalues']) # surrogates if calculated
+    Found = False
+    treshold = 0.707 #(r-squared = 0.5, means 50% chance that tis is really correlated)
+    tresh2 = 0.5
+    p_tresh = 0.05
+    mask = pvalue<p_tresh
+    results =  correlation*mask
+    NaNs = numpy.isnan(results)
+    results[NaNs]=0
+    metabolitenames = header.rstrip('\n').split(",")
+    for i in  range (correlation.shape[0]):
+        amax = round(numpy.amax (results[i,:])*100.)/100.
+        amin = round(numpy.amin (results[i,:])*100.)/100.
+        imax = numpy.argmax (results[i,:])
+        imin = numpy.argmin (results[i,:])
+        c_max = format(amax, '.2f') 
+        p_max = format(pvalue[i,imax], '.2E')
+        c_min = format(amin, '.2f') 
+        p_min = format(pvalue[i,imin], '.2E')   
+        if amax>treshold:
+            Found = True   
+            lprint ('Significant correlation = '+c_max+' (p='+p_max+') in metabolite "'+metabolitenames[i]+'" at shift '+str(imax))
+        elif amax>tresh2:
+            Found = True 
+            lprint ('Possible    correlation = '+c_max+' (p='+p_max+') in metabolite "'+metabolitenames[i]+'" at shift '+str(imax))   
+        if amin<-1.0*treshold: 
+            Found = True 
+            lprint ('Significant correlation =' +c_min+' (p='+p_min+') in metabolite "'+metabolitenames[i]+'" at shift '+str(imin))
+        elif amin<-1.0*tresh2: 
+            Found = True 
+            lprint ('Possible    correlation =' +c_min+' (p='+p_min+') in metabolite "'+metabolitenames[i]+'" at shift '+str(imin))
+    if not Found: 
+        lprint ('No correlations found (correlation>'+str(treshold)+', p<'+str(p_tresh)+')') 
+    if '_glm_tvalues' in outputs:
+        glm_t = outputs['_glm_tvalues']; glm_p = outputs['_glm_pvalues']
+        Found = False
+        for i in  range (3, glm_t.shape[0]):
+            t = numpy.where(numpy.isnan(glm_t[i,:]), 0., numpy.abs(glm_t[i,:]))
+            imax = numpy.argmax (t)
+            if glm_p[i,imax]<p_tresh:
+                Found = True
+                lprint ('GLM paradigm effect t = '+format(glm_t[i,imax], '.2f')+' (p='+format(glm_p[i,imax], '.2E')+') in metabolite "'+metabolitenames[i]+'" at shift '+str(imax))
+        if not Found: lprint ('No GLM paradigm effects found (p<'+str(p_tresh)+')') 
+def find_results (path):
+    # fMRS_sliding_window result files for group mode, either all result CSVs (recognized
+    # by their first line) in a directory tree or the files listed in a textfile
+    if not os.path.isdir(path): 
+        root = os.path.dirname(path)
+        return [os.path.abspath(os.path.join(root, line.strip())) for line in open(path, 'r')
+                if line.strip() != '' and not line.strip().startswith('#')]
+    files = []
+    for dirpath, dirnames, names in os.walk(path):
+        dirnames.sort()
+        for name in sorted(names):
+            if not name.lower().endswith('.csv'): continue
+            with open(os.path.join(dirpath, name)) as f: first = f.readline()
+            if first.startswith('fMRS_sliding_window') and first.rstrip().endswith('Results:'): 
+                files.append(os.path.join(dirpath, name))
+    return files
+def read_group (filenames, n_jobs=1):
+    # results of all subjects as one array (subjects, dynamics, columns), the columns
+    # are matched by name to the first file, missing ones are NaN. Returns (data, header)
+    # Errors raise ValueError
+    if len(filenames) < 2: raise ValueError ('at least 2 result files needed, found '+str(len(filenames)))
+    results = [None]*len(filenames)
+    def read (i):
+        try: results[i] = read_results (filenames[i])
+        except Exception as e: raise ValueError ('reading '+filenames[i]+' ('+str(e)+')')
+    run_threads (read, range(len(filenames)), n_jobs)
+    names = results[0][1].rstrip('\n').split(',')
+    data = numpy.full((len(filenames), results[0][0].shape[0], len(names)), numpy.nan)
+    for i in range(len(filenames)):
+        values, header = results[i]
+        if values.shape[0] != data.shape[1]:
+            raise ValueError (filenames[i]+' has '+str(values.shape[0])+' dynamics, '+filenames[0]+' '+str(data.shape[1]))
+        columns = header.rstrip('\n').split(',')
+        for j in range(len(names)):
+            if names[j] in columns: data[i,:,j] = values[:,columns.index(names[j])]
+        missing = [name for name in names if name not in columns]
+        if missing: logwrite ('Warning: '+', '.join(missing)+' missing in '+filenames[i])
+    return data, results[0][1]
+def one_sample_test (values): 
+    # t-test of the mean of values over the subjects (axis 0) against 0, NaNs are 
+    # left out. Returns mean, t, p and the number of subjects per element
+    stats, special = import_scipy ()
+    valid = numpy.isfinite(values)
+    n = numpy.sum(valid, axis=0)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        mean = numpy.sum(numpy.where(valid, values, 0.), axis=0)/n
+        variance = numpy.sum(numpy.where(valid, values-mean, 0.)**2, axis=0)/(n-1)
+        t = mean/numpy.sqrt(variance/n)
+        t[(n < 2) | (variance <= 0.)] = numpy.nan
+    p = 2.*stats.t.sf(numpy.abs(t), numpy.maximum(n-1, 1))
+    return mean, t, p, n
+def group_statistics (data, paradigm, sliding_window, max_shift=60, n_jobs=1, chunk=4,
+                      GLM=False, TR=0., hrf='canonical', drift=2, nuisance=None):
+    # lag correlations (and GLM) of all subjects data (subjects, dynamics, columns) against
+    # the paradigm and the group statistics of them. The subjects are evaluated in chunks,
+    # all of a chunk in one batched call, on n_jobs threads. The group mean correlation is
+    # averaged as Fisher z, tested with a one sample t-test of z (and of the GLM beta).
+    # Returns a dict of arrays, per subject (subjects, columns, max_shift), for the group
+    # (columns, max_shift), the first 3 columns (Row,Col,Slice) are NaN. Errors raise ValueError
+    S, N, M = data.shape
+    if paradigm.shape[0] != N:
+        raise ValueError ('dimension mismatch of CSV data ('+str(N)+') and Paradigm ('+str(paradigm.shape[0])+')')
+    if N-max_shift < 3:
+        raise ValueError ('max_shift ('+str(max_shift)+') too large for '+str(N)+' dynamics')
+    paradigm_sl_win = smooth (paradigm, sliding_window)[0:N-max_shift]
+    if GLM:
+        if nuisance is not None and nuisance.shape[0] < paradigm_sl_win.shape[0]:
+            raise ValueError (str(nuisance.shape[0])+' nuisance values, at least '+str(paradigm_sl_win.shape[0])+' needed')
+        design = design_matrix (paradigm_sl_win, TR, hrf, drift, nuisance)
+        logwrite ('GLM design with '+str(design.shape[1])+' regressors, hrf '+hrf+', drift order '+str(drift))
+        if numpy.linalg.matrix_rank(design) >= design.shape[0]:
+            raise ValueError ('too many GLM regressors for '+str(design.shape[0])+' dynamics')
+        contrast = numpy.zeros(design.shape[1]); contrast[0] = 1.
+    r = numpy.full((S, M, max_shift), numpy.nan)
+    beta = numpy.full((S, M, max_shift), numpy.nan)
+    timings = {'correlation': 0., 'glm': 0.}; lock = threading.Lock()
+    def evaluate (subjects): # column s*(M-3)+m is metabolite m of subject s
+        x = data[subjects.start:subjects.stop,:,3:].transpose(1,0,2).reshape(N, -1)
+        start_time = time.time()
+        r[subjects,3:,:] = lag_correlations (paradigm_sl_win, x, max_shift)[0].reshape(-1, M-3, max_shift)
+        middle_time = time.time()
+        if GLM: beta[subjects,3:,:] = glm (design, x, max_shift, contrast)[0].reshape(-1, M-3, max_shift)
+        with lock: 
+            timings['correlation'] += middle_time-start_time; timings['glm'] += time.time()-middle_time
+    timer = stage_start ()
+    run_threads (evaluate, [slice(i, min(i+chunk, S)) for i in range(0, S, chunk)], n_jobs)
+    with numpy.errstate(invalid='ignore'):
+        z = numpy.arctanh(numpy.clip(r, -0.999999, 0.999999)) # Fisher z
+    mean_z, t, p, n = one_sample_test (z)
+    group = {'r': r, 'mean_r': numpy.tanh(mean_z), 'z': mean_z, 't': t, 'p': p, 'subjects': n}
+    if GLM:
+        group['beta'] = beta
+        group['glm_beta'], group['glm_t'], group['glm_p'] = one_sample_test (beta)[:3]
+    stage_end ('group', timer)
+    logwrite ('Correlations '+str(round(timings['correlation'],2))+'s, GLM '+str(round(timings['glm'],2))+
+              's (summed over '+str(n_jobs)+' threads)')
+    return group
+def write_group (group, basename, header, filenames):
+    # group results as one CSV (one line per metabolite and shift) and all of them,
+    # the per subject maps included, as .npz. Returns the files written
+    stp=''; space = ' ' # for name collision detection
+    if os.path.isfile(basename+'_group'+stp+'.csv'): stp='_'+timestamp+ID
+    names = header.rstrip('\n').split(',')
+    columns = ['subjects', 'mean_r', 'z', 't', 'p']
+    if 'glm_t' in group: columns += ['glm_beta', 'glm_t', 'glm_p']
+    f = open(basename+'_group'+stp+'.csv', 'w')
+    f.write(Program_name+space+Program_version+' Group results ('+str(len(filenames))+' subjects):\n')
+    f.write('metabolite,shift,'+','.join(columns)+'\n')
+    for i in range(3, len(names)):
+        for j in range(group['t'].shape[1]):
+            f.write(names[i]+','+str(j)+','+','.join([str(group[column][i,j]) for column in columns])+'\n')
+    f.close()
+    numpy.savez (basename+'_group'+stp+'.npz', names=numpy.asarray(names), files=numpy.asarray(filenames), **group)
+    return [basename+'_group'+stp+'.csv', basename+'_group'+stp+'.npz']
+def group_effects (group, p_tresh=0.05):
+    # group effects per metabolite at the shift of the largest group mean effect (with few
+    # subjects the largest t is mostly a small variance), p-values Bonferroni corrected for
+    # all metabolites and shifts tested. Returns (prefix, metabolite, shift, p, corrected p)
+    # of the effects with corrected p < p_tresh, prefix '' for correlations, 'glm_' for GLM
+    effects = []
+    for prefix, value in [('', 'mean_r'), ('glm_', 'glm_beta')]:
+        if prefix+'t' not in group: continue
+        p = group[prefix+'p'][3:,:]
+        n_tests = max(numpy.sum(numpy.isfinite(p)), 1)
+        for i in range (3, group[value].shape[0]):
+            effect = numpy.where(numpy.isnan(group[prefix+'p'][i,:]), -1., numpy.abs(group[value][i,:]))
+            shift = numpy.argmax (effect)
+            if effect[shift] < 0.: continue # no subjects
+            p_corrected = min(group[prefix+'p'][i,shift]*n_tests, 1.)
+            if p_corrected<p_tresh: effects.append((prefix, i, shift, group[prefix+'p'][i,shift], p_corrected))
+    return effects
+def report_group (group, header): # print the group correlations and GLM effects found, see group_effects
+    p_tresh = 0.05
+    metabolitenames = header.rstrip('\n').split(",")
+    names = {'': ('Group correlation mean r', 'mean_r'), 'glm_': ('Group GLM paradigm effect beta', 'glm_beta')}
+    effects = group_effects (group, p_tresh)
+    for prefix, i, shift, p, p_corrected in effects:
+        lprint (names[prefix][0]+' = '+format(group[names[prefix][1]][i,shift], '.3g')+' (t='+format(group[prefix+'t'][i,shift], '.2f')+
+                ', p='+format(p, '.2E')+', corrected p='+format(p_corrected, '.2E')+') in metabolite "'+metabolitenames[i]+'" at shift '+str(shift))
+    if not effects: lprint ('No group effects found (p<'+str(p_tresh)+', corrected for all metabolites and shifts)') 
+
+# default settings, see main()
+Program_name = os.path.splitext(os.path.basename(__file__))[0]
 ID = str(random.randrange(1000, 2000));ID=ID[:3] # create 3 digit random ID for logfile 
-try: sys.stderr = open(basedir+Program_name+'.log', 'a'); # open logfile to append
-except: print('Problem opening logfile: '+basedir+Program_name+'.log'); exit(2)
-my_env = os.environ.copy()
-FNULL = open(os.devnull, 'w')
-# catch signals to be able to cleanup temp files before exit
-signal.signal(signal.SIGINT, signal_handler)  # keyboard interrupt
-signal.signal(signal.SIGTERM, signal_handler) # kill/shutdown
-if  'SIGHUP' in dir(signal): signal.signal(signal.SIGHUP, signal_handler)  # shell exit (linux)
-# calc timestamp
 timestamp=datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+reset_profile ()
 
-# configuration specific initializations
-# compare python versions with e.g. if LooseVersion(python_version)>LooseVersion("2.7.6"):
-python_version = str(sys.version_info[0])+'.'+str(sys.version_info[1])+'.'+str(sys.version_info[2])
-# sys.platform = [linux2, win32, cygwin, darwin, os2, os2emx, riscos, atheos, freebsd7, freebsd8]
-if sys.platform=="win32":
-    os.system("title "+Program_name)
-    try: resourcedir = sys._MEIPASS+slash # when on PyInstaller 
-    except: # in plain python this is where the script was run from
-        resourcedir = os.path.abspath(os.path.dirname(sys.argv[0]))+slash; 
-    if pywin32_installed:
-        try: # disable console windows close button (substitutes catch shell exit under linux)
-            hwnd = win32console.GetConsoleWindow()
-            hMenu = win32gui.GetSystemMenu(hwnd, 0)
-            win32gui.DeleteMenu(hMenu, win32con.SC_CLOSE, win32con.MF_BYCOMMAND)
-        except: pass #silent        
-else:
-    resourcedir = os.path.abspath(os.path.dirname(sys.argv[0]))+slash;
-if TK_installed:        
-    TKwindows = tk.Tk(); TKwindows.withdraw() #hiding tkinter window
-    TKwindows.update()
-    # the following tries to disable showing hidden files/folders under linux
-    try: TKwindows.tk.call('tk_getOpenFile', '-foobarz')
-    except: pass
-    try: TKwindows.tk.call('namespace', 'import', '::tk::dialog::file::')
-    except: pass
-    try: TKwindows.tk.call('set', '::tk::dialog::file::showHiddenBtn', '1')
-    except: pass
-    try: TKwindows.tk.call('set', '::tk::dialog::file::showHiddenVar', '0')
-    except: pass
-    TKwindows.update()
+def main ():
+    global Program_name
+    # general initialization stuff   
+    debug=False; NIFTI_Input=False; SPAR_Input=True
+    csvfilename=''; paradigmfile=''; max_shift=60
+    n_surrogates=0; surrogate_method='phase'; block=0; seed=None; n_jobs=1
+    paradigm_tr=0.; events=False; GLM=False; TR=0.; hrf='canonical'; drift=2; nuisancefile=''
+    profile_file=''; prometheus_file=''; group=''
+    Program_name = os.path.basename(sys.argv[0]); 
+    if Program_name.find('.')>0: Program_name = Program_name[:Program_name.find('.')]
+    basedir = os.getcwd()+slash # current working directory is the default output directory 
+    for arg in sys.argv[1:]: # look in command line arguments if the output directory specified
+        if "--outdir" in arg: basedir = os.path.abspath(arg[arg.find('=')+1:])+slash #
+    try: sys.stderr = open(basedir+Program_name+'.log', 'a'); # open logfile to append
+    except: print('Problem opening logfile: '+basedir+Program_name+'.log'); exit(2)
+    # catch signals to be able to cleanup temp files before exit
+    signal.signal(signal.SIGINT, signal_handler)  # keyboard interrupt
+    signal.signal(signal.SIGTERM, signal_handler) # kill/shutdown
+    if  'SIGHUP' in dir(signal): signal.signal(signal.SIGHUP, signal_handler)  # shell exit (linux)
 
-# parse commandline parameters (if present)
-try: opts, args =  getopt( sys.argv[1:],'h',['help','version','spec=','outdir=', 'window='])
-except:
-    error=str(sys.argv[1:]).replace("[","").replace("]","")
-    if "-" in str(error) and not "--" in str(error): 
-          lprint ('ERROR: Commandline '+str(error)+',   maybe you mean "--"')
-    else: lprint ('ERROR: Commandline '+str(error))
-    usage(); exit(2)
-if len(args)>0: 
-    lprint ('ERROR: Commandline option "'+args[0]+'" not recognized')
-    lprint ('       (see logfile for details)')
-    logwrite ('       Calling parameters: '+str(sys.argv[1:]).replace("[","").replace("]",""))
-    usage(); exit(2)  
-argDict = dict(opts)
-if "--outdir" in argDict and not [True for arg in sys.argv[1:] if "--outdir" in arg]:
-    # "--outdir" must be spelled out, getopt also excepts substrings (e.g. "--outd"), but
-    # my simple pre-initialization code to get basedir early doesn't
-    lprint ('ERROR: Commandline option "--outdir" must be spelled out')
-    usage(); exit(2)
-if '-h' in argDict: usage(); help(); exit(0)   
-if '--help' in argDict: usage(); help(); exit(0)  
-if '--version' in argDict: lprint (Program_name+' '+Program_version); exit(0)
-if '--csv' in argDict: csvfilename=argDict['--csv']; checkfile(csvfilename)
-if '--paradigm' in argDict: paradigmfile=argDict['--paradigm']; checkfile(paradigmfile)
-window_by_arg = False
-if '--window' in argDict: 
-    window_str = argDict['--window']
-    try: sliding_window=int(window_str)
-    except: lprint ('ERROR: problem converting --window argument to number'); exit(2)
-    if sliding_window<1:  lprint ('ERROR: sliding window must be >=1');  exit(2)
-    if sliding_window>50: lprint ('ERROR: sliding window must be <=50'); exit(2)
-    window_by_arg = True
-    
-#choose file with tkinter
-try:
-   TKwindows = tk.Tk(); TKwindows.withdraw() #hiding tkinter window
-   TKwindows.update()
-except: pass
-# the following tries to disablle showing hidden files/folders under linux
-try: TKwindows.tk.call('tk_getOpenFile', '-foobarz')
-except: pass
-try: TKwindows.tk.call('namespace', 'import', '::tk::dialog::file::')
-except: pass
-try: TKwindows.tk.call('set', '::tk::dialog::file::showHiddenBtn', '1')
-except: pass
-try: TKwindows.tk.call('set', '::tk::dialog::file::showHiddenVar', '0')
-except: pass
-try: TKwindows.update()
-except: pass
-# this is the actual file open dialogue
-Interactive = False
-if TK_installed:
-   # Choose CSV file
-    if csvfilename == "": # use interactive input if not specified in commandline
-        csvfilename = askopenfilename(title="Choose CSV file")
+    # configuration specific initializations
+    python_version = str(sys.version_info[0])+'.'+str(sys.version_info[1])+'.'+str(sys.version_info[2])
+    # sys.platform = [linux2, win32, cygwin, darwin, os2, os2emx, riscos, atheos, freebsd7, freebsd8]
+    if sys.platform=="win32":
+        os.system("title "+Program_name)
+        console_close_button (False) # substitutes catch shell exit under linux
+
+    # parse commandline parameters (if present)
+    timer = stage_start ()
+    try: opts, args =  getopt( sys.argv[1:],'h',['help','version','csv=','paradigm=','paradigm_tr=','events','outdir=', 'window=', 'max_shift=',
+                                                    'surrogates=','surrogate_method=','block=','seed=','jobs=',
+                                                    'glm','tr=','hrf=','drift=','nuisance=','profile=','prometheus=','group=','sweep'])
+    except:
+        error=str(sys.argv[1:]).replace("[","").replace("]","")
+        if "-" in str(error) and not "--" in str(error): 
+              lprint ('ERROR: Commandline '+str(error)+',   maybe you mean "--"')
+        else: lprint ('ERROR: Commandline '+str(error))
+        usage(); exit(2)
+    if len(args)>0: 
+        lprint ('ERROR: Commandline option "'+args[0]+'" not recognized')
+        lprint ('       (see logfile for details)')
+        logwrite ('       Calling parameters: '+str(sys.argv[1:]).replace("[","").replace("]",""))
+        usage(); exit(2)  
+    argDict = dict(opts)
+    if "--outdir" in argDict and not [True for arg in sys.argv[1:] if "--outdir" in arg]:
+        # "--outdir" must be spelled out, getopt also excepts substrings (e.g. "--outd"), but
+        # my simple pre-initialization code to get basedir early doesn't
+        lprint ('ERROR: Commandline option "--outdir" must be spelled out')
+        usage(); exit(2)
+    if '-h' in argDict: usage(); help(); exit(0)   
+    if '--help' in argDict: usage(); help(); exit(0)  
+    if '--version' in argDict: lprint (Program_name+' '+Program_version); exit(0)
+    if '--csv' in argDict: csvfilename=argDict['--csv']; checkfile(csvfilename)
+    if '--paradigm' in argDict: paradigmfile=argDict['--paradigm']; checkfile(paradigmfile)
+    window_by_arg = False; windows = []
+    if '--window' in argDict: 
+        window_str = argDict['--window']
+        try: windows=parse_windows(window_str)
+        except: lprint ('ERROR: problem converting --window argument to number'); exit(2)
+        if windows[0]<1:  lprint ('ERROR: sliding window must be >=1');  exit(2)
+        if windows[-1]>50: lprint ('ERROR: sliding window must be <=50'); exit(2)
+        sliding_window = windows[0]; window_by_arg = True
+    if '--sweep' in argDict: 
+        if window_by_arg: lprint ('ERROR: --sweep and --window can not be combined'); exit(2)
+        windows = list(range(1, 51)); sliding_window = 1; window_by_arg = True
+    if '--max_shift' in argDict: 
+        try: max_shift=int(argDict['--max_shift'])
+        except: lprint ('ERROR: problem converting --max_shift argument to number'); exit(2)
+        if max_shift<1: lprint ('ERROR: max_shift must be >=1'); exit(2)
+    if '--surrogates' in argDict: 
+        try: n_surrogates=int(argDict['--surrogates'])
+        except: lprint ('ERROR: problem converting --surrogates argument to number'); exit(2)
+        if n_surrogates<0: lprint ('ERROR: number of surrogates must be >=0'); exit(2)
+    if '--surrogate_method' in argDict: 
+        surrogate_method=argDict['--surrogate_method']
+        if surrogate_method not in ['phase','block']: 
+            lprint ('ERROR: surrogate_method must be "phase" or "block"'); exit(2)
+    if '--block' in argDict: 
+        try: block=int(argDict['--block'])
+        except: lprint ('ERROR: problem converting --block argument to number'); exit(2)
+        if block<1: lprint ('ERROR: block length must be >=1'); exit(2)
+    if '--seed' in argDict: 
+        try: seed=int(argDict['--seed'])
+        except: lprint ('ERROR: problem converting --seed argument to number'); exit(2)
+    if '--jobs' in argDict: 
+        try: n_jobs=int(argDict['--jobs'])
+        except: lprint ('ERROR: problem converting --jobs argument to number'); exit(2)
+        if n_jobs<1:  lprint ('ERROR: number of jobs must be >=1');  exit(2)
+    if '--paradigm_tr' in argDict: 
+        try: paradigm_tr=float(argDict['--paradigm_tr'])
+        except: lprint ('ERROR: problem converting --paradigm_tr argument to number'); exit(2)
+        if paradigm_tr<=0: lprint ('ERROR: paradigm_tr must be >0'); exit(2)
+    if '--events' in argDict: events=True
+    if '--glm' in argDict: GLM=True
+    if '--tr' in argDict: 
+        try: TR=float(argDict['--tr'])
+        except: lprint ('ERROR: problem converting --tr argument to number'); exit(2)
+        if TR<=0: lprint ('ERROR: TR must be >0'); exit(2)
+    if '--hrf' in argDict: 
+        hrf=argDict['--hrf']
+        if hrf not in ['canonical','none']: lprint ('ERROR: hrf must be "canonical" or "none"'); exit(2)
+    if '--drift' in argDict: 
+        try: drift=int(argDict['--drift'])
+        except: lprint ('ERROR: problem converting --drift argument to number'); exit(2)
+        if drift<0: lprint ('ERROR: drift order must be >=0'); exit(2)
+    if '--nuisance' in argDict: nuisancefile=argDict['--nuisance']; checkfile(nuisancefile)
+    if '--group' in argDict: 
+        group=os.path.abspath(argDict['--group'])
+        if not os.path.exists(group): lprint ('ERROR:  "'+group+'" not found'); exit(2)
+        if csvfilename != '': lprint ('ERROR: --csv and --group can not be combined'); exit(2)
+        if n_surrogates>0: lprint ('Warning: --surrogates is not used in group mode'); n_surrogates=0
+        if len(windows)>1: lprint ('ERROR: a window sweep is not possible in group mode'); exit(2)
+    if len(windows)>1:
+        if n_surrogates>0: lprint ('Warning: --surrogates is not used in a window sweep'); n_surrogates=0
+        if '--glm' in argDict: lprint ('Warning: --glm is not used in a window sweep')
+    if GLM and hrf=='canonical' and TR==0:
+        lprint ('ERROR: --glm with canonical hrf requires --tr (or use --hrf=none)'); exit(2)
+    if '--profile' in argDict: profile_file = os.path.abspath(argDict['--profile'])
+    if '--prometheus' in argDict: prometheus_file = os.path.abspath(argDict['--prometheus'])
+    stage_end ('arguments', timer)
+        
+    #choose file with tkinter
+    Interactive = False
+    if csvfilename == "" and group == "": # use interactive input if not specified in commandline
+        csvfilename = choose_file ("Choose CSV file")
+        if csvfilename == None:
+            lprint ('ERROR:  No CSV input file specified')
+            lprint ('        to interactively choose input files you need tkinter')
+            lprint ('        on Linux try "yum install tkinter"')
+            lprint ('        on MacOS install ActiveTcl from:')
+            lprint ('        http://www.activestate.com/activetcl/downloads')  
+            usage()
+            exit(2)
         if csvfilename == "": lprint ('ERROR:  No CSV input file specified'); exit(2)
         Interactive = True
-    TKwindows.update()
-else:
-    if csvfilename == "": 
-        lprint ('ERROR:  No CSV input file specified')
-        lprint ('        to interactively choose input files you need tkinter')
-        lprint ('        on Linux try "yum install tkinter"')
-        lprint ('        on MacOS install ActiveTcl from:')
-        lprint ('        http://www.activestate.com/activetcl/downloads')  
-        usage()
-        exit(2)
-csvfilename = os.path.abspath(csvfilename)
-#if TK_installed:
-   # Choose Paradigm file
-#    if paradigmfile == "": # use interactive input if not specified in commandline
-#        paradigmfile = askopenfilename(title="Choose Paradigm file")
-#    TKwindows.update()
-#if paradigmfile == "": paradigmfile = "Paradigm.txt"
-#paradigmfile = os.path.abspath(paradigmfile)
-TKwindows.update()
-try: win32gui.SetForegroundWindow(win32console.GetConsoleWindow())
-except: pass #silent
+    if group == "": csvfilename = os.path.abspath(csvfilename)
 
-# read input from keyboard
-if not window_by_arg:
-    sliding_window=0; OK=False
-    while not OK:
-        dummy = raw_input("Enter sliding window [1..50]: ")
-        if dummy == '': print ("Input Error")
-        try: sliding_window = int(dummy);
-        except: print ("Input Error")
-        if sliding_window>=1 and sliding_window<=50: OK=True 
+    # read input from keyboard
+    if not window_by_arg:
+        sliding_window=0; OK=False
+        while not OK:
+            dummy = input("Enter sliding window [1..50]: ")
+            if dummy == '': print ("Input Error")
+            try: sliding_window = int(dummy);
+            except: print ("Input Error")
+            if sliding_window>=1 and sliding_window<=50: OK=True 
 
-# ----- start to really do something -----
-lprint ('Starting '+Program_name+' '+Program_version)
-lprint ('Sliding window is set to '+str(sliding_window))
-logwrite ('Calling sequence    '+' '.join(sys.argv))
-logwrite ('OS & Python version '+sys.platform+' '+python_version)
-logwrite ('tkinter '+str(TK_installed))
+    # ----- start to really do something -----
+    lprint ('Starting '+Program_name+' '+Program_version)
+    if len(windows)>1: lprint ('Sweeping sliding windows '+window_str if '--window' in argDict else 'Sweeping sliding windows 1-50')
+    else: lprint ('Sliding window is set to '+str(sliding_window))
+    logwrite ('Calling sequence    '+' '.join(sys.argv))
+    logwrite ('OS & Python version '+sys.platform+' '+python_version)
 
-# read CSV header
-with open(csvfilename) as f:
-    data = f.readlines()
-    CSV_header1 = data[0] 
-    CSV_header2 = data[1]  
-# read CSV data
-metabolites = numpy.genfromtxt(csvfilename,delimiter=",",skip_header=2)
+    timer = stage_start ()
+    if group != '': 
+        filenames = find_results (group)
+        lprint ('Reading '+str(len(filenames))+' result files')
+        try: data, CSV_header2 = read_group (filenames, n_jobs)
+        except ValueError as e: lprint ('ERROR:  '+str(e)); exit (2)
+        metabolites = data[0]
+    else: metabolites, CSV_header2 = read_results (csvfilename)
+    stage_end ('read', timer)
 
-# read Paradigm data
-#with open(paradigmfile, 'rb') as f:
-#   paradigm_raw = csv.reader(f)
-#   paradigm_lst = []
-#   for row in paradigm_raw: 
-#      try: paradigm_lst.append(row[0])
-#      except: lprint ('ERROR:  reading Paradigm values'); exit (2)  
-#try: paradigm = numpy.asarray(paradigm_lst,int)
-#except: lprint ('ERROR:  converting Paradigm values to numbers'); exit (2)  
-#if len(paradigm_lst) !=  paradigm.shape[0]:
-#   lprint ('ERROR:  converting Paradigm values')
-#   exit (2)        
+    # read Paradigm data
+    timer = stage_start ()
+    if paradigmfile != '':
+        logwrite ('Reading paradigm '+paradigmfile)
+        try: paradigm = read_paradigm (paradigmfile, metabolites.shape[0], TR, paradigm_tr, events)
+        except ValueError as e: lprint ('ERROR:  reading Paradigm values, '+str(e)); exit (2)
+        except IndexError: lprint ('ERROR:  reading Paradigm values, missing column'); exit (2)
+    else: paradigm = default_paradigm ()
+    nuisance = None
+    if nuisancefile != '':
+        try: nuisance = numpy.loadtxt(nuisancefile, ndmin=2)
+        except: lprint ('ERROR:  reading nuisance regressors from '+nuisancefile); exit (2)
+    stage_end ('paradigm', timer)
 
-# set fixed paradigm  
-paradigm = numpy.zeros (360, dtype=float)
-for i in range (60,120): paradigm[i]=1.
-for i in range (180,240): paradigm[i]=1.
-for i in range (300,360): paradigm[i]=1.
-#print (paradigm)
+    if len(windows)>1:
+        try: outputs = sweep (metabolites, paradigm, windows, max_shift)
+        except ValueError as e: lprint ('ERROR:  '+str(e)); exit (2)
+    elif group != '':
+        try: outputs = group_statistics (data, paradigm, sliding_window, max_shift, n_jobs,
+                                         GLM=GLM, TR=TR, hrf=hrf, drift=drift, nuisance=nuisance)
+        except ValueError as e: lprint ('ERROR:  '+str(e)); exit (2)
+    else:
+        try: outputs = statistics (metabolites, paradigm, sliding_window, max_shift, n_surrogates, 
+                                   surrogate_method, block, seed, n_jobs, GLM, TR, hrf, drift, nuisance)
+        except ValueError as e: lprint ('ERROR:  '+str(e)); exit (2)
+        except RuntimeError as e: lprint ('ERROR:  '+str(e)); exit (1)
 
-# consistency check CSV-Paradigm
-if paradigm.shape[0] != metabolites.shape[0]:
-   lprint ('ERROR:  dimension mismatch of CSV data ('+str(metabolites.shape[0])+') and Paradigm ('+str(paradigm.shape[0])+')')
-   exit (2)   
-   
-# cut off last paradigm block
-max_shift=60
-paradigm = paradigm [0:paradigm.shape[0]-max_shift]   
+    #write results
+    lprint ('') # spacer
+    timer = stage_start ()
+    if len(windows)>1: write_sweep (outputs, os.path.splitext(os.path.basename(csvfilename))[0], CSV_header2)
+    elif group != '': write_group (outputs, os.path.splitext(os.path.basename(group))[0], CSV_header2, filenames)
+    else: write_results (outputs, os.path.splitext(os.path.basename(csvfilename))[0], CSV_header2)
+    stage_end ('write', timer)
 
- 
-# calc & write Paradigm data with sliding window
-paradigm_sl_win = numpy.zeros(paradigm.shape[0], dtype=float);
-for i in range (paradigm.shape[0]):
-   start = i-int(sliding_window/2)
-   if start < 0: start=0
-   end   = i+int(sliding_window/2)
-   if end > paradigm.shape[0]: end = paradigm.shape[0]
-   #print (start,end, paradigm[start:end+1],numpy.mean(paradigm[start:end+1]))
-   paradigm_sl_win[i] = numpy.mean(paradigm[start:end+1])
-#f = open(os.path.splitext(os.path.basename(paradigmfile))[0]+'_SlWin_.txt', 'w')
-#for i in range (paradigm_sl_win.shape[0]):
-#   f.write(str(paradigm_sl_win[i])+"\n")
-#f.close ()   
+    #analyse results
+    if len(windows)>1: report_sweep (outputs, CSV_header2)
+    elif group != '': report_group (outputs, CSV_header2)
+    else: report (outputs, CSV_header2)
+    if profile_file != '' or prometheus_file != '':
+        try: write_profile (profile_file, prometheus_file)
+        except: lprint ('ERROR:  Problem writing profile') # the results are written anyway
+    lprint ('\ndone\n')    
+    sys.stderr.close() # close logfile
 
-FNULL = open(os.devnull, 'w')
-old_target, sys.stderr = sys.stderr, FNULL # replace sys.stdout    
-pvalue = numpy.zeros ([metabolites.shape[1],max_shift], dtype=float)
-correlation = numpy.zeros ([metabolites.shape[1],max_shift], dtype=float) 
-for j in  range (max_shift): 
-   for i in  range (3, metabolites.shape[1]):
-      #diff = paradigm_sl_win[0:paradigm_sl_win.shape[0]-j] - metabolites[0:metabolites.shape[0]-j,i]
-      #diff = paradigm_sl_win[:] - metabolites[:,i]      
-      #t_value[i,j] = (numpy.average(diff) * numpy.sqrt(len(diff))) / (numpy.std(diff, ddof=1))
-      correlation[i,j], pvalue[i,j] = stats.stats.pearsonr (paradigm_sl_win[:], metabolites[j:j+paradigm_sl_win.shape[0],i])
-sys.stderr = old_target # re-enable            
-      
-#write results
-lprint ('') # spacer
-stp=''; space = ' ' # for name collision detection
-if os.path.isfile(os.path.splitext(os.path.basename(csvfilename))[0]+'_correlations'+stp+'.csv'): stp='_'+timestamp+ID
-f1 = open(os.path.splitext(os.path.basename(csvfilename))[0]+'_correlations'+stp+'.csv', 'w')
-f2 = open(os.path.splitext(os.path.basename(csvfilename))[0]+'_pvalues'+stp+'.csv', 'w')
-f1.write(Program_name+space+Program_version+' Results:\n')
-f2.write(Program_name+space+Program_version+' Results:\n')
-f1.write(CSV_header2)
-f2.write(CSV_header2)
-for j in  range (max_shift): 
-   for i in  range ( metabolites.shape[1]):
-      f1.write(str(correlation[i,j]))
-      f2.write(str(pvalue[i,j]))
-      if i<metabolites.shape[1]-1: f1.write (',')
-      if i<metabolites.shape[1]-1: f2.write (',')
-   f1.write ('\n')
-   f2.write ('\n')   
-f1.close()
-f2.close()  
+    #reenable console windows close button
+    console_close_button (True)
 
-#analyse results
-Found = False
-treshold = 0.707 #(r-squared = 0.5, means 50% chance that tis is really correlated)
-tresh2 = 0.5
-p_tresh = 0.05
-mask = pvalue<p_tresh
-results =  correlation*mask
-NaNs = numpy.isnan(results)
-results[NaNs]=0
-metabolitenames = CSV_header2.rstrip('\n').split(",")
-for i in  range ( metabolites.shape[1]):
-   amax = round(numpy.amax (results[i,:])*100.)/100.
-   amin = round(numpy.amin (results[i,:])*100.)/100.
-   imax = numpy.argmax (results[i,:])
-   imin = numpy.argmin (results[i,:])
-   c_max = format(amax, '.2f') 
-   p_max = format(pvalue[i,imax], '.2E')
-   c_min = format(amin, '.2f') 
-   p_min = format(pvalue[i,imin], '.2E')   
-   if amax>treshold:
-      Found = True   
-      lprint ('Significant correlation = '+c_max+' (p='+p_max+') in metabolite "'+metabolitenames[i]+'" at shift '+str(imax))
-   elif amax>tresh2:
-      Found = True 
-      lprint ('Possible    correlation = '+c_max+' (p='+p_max+') in metabolite "'+metabolitenames[i]+'" at shift '+str(imax))   
-   if amin<-1.0*treshold: 
-      Found = True 
-      lprint ('Significant correlation =' +c_min+' (p='+p_min+') in metabolite "'+metabolitenames[i]+'" at shift '+str(imin))
-   elif amin<-1.0*tresh2: 
-      Found = True 
-      lprint ('Possible    correlation =' +c_min+' (p='+p_min+') in metabolite "'+metabolitenames[i]+'" at shift '+str(imin))
-   
-if not Found: 
-   lprint ('No correlations found (correlation>'+str(treshold)+', p<'+str(p_tresh)+')') 
-lprint ('\ndone\n')    
+    #pause
+    if Interactive:
+        if sys.platform=="win32": os.system("pause") # windows
+        else: 
+            #os.system('read -s -n 1 -p "Press any key to continue...\n"')
+            import termios
+            print("Press any key to continue...")
+            fd = sys.stdin.fileno()
+            oldterm = termios.tcgetattr(fd)
+            newattr = termios.tcgetattr(fd)
+            newattr[3] = newattr[3] & ~termios.ICANON & ~termios.ECHO
+            termios.tcsetattr(fd, termios.TCSANOW, newattr)
+            try: result = sys.stdin.read(1)
+            except IOError: pass
+            finally: termios.tcsetattr(fd, termios.TCSAFLUSH, oldterm)
+
+if __name__ == '__main__':
+    main ()
     
 # paired t-test: http://iaingallagher.tumblr.com/post/50980987285/t-tests-in-python
 #baseline  = numpy.asarray([67.2, 67.4, 71.5, 77.6, 86.0, 89.1, 59.5, 81.9, 105.5])
@@ -432,31 +1051,3 @@ lprint ('\ndone\n')
 #p = numpy.sum(s<t_value) / float(len(s))
 #p_val = 2 * min(p, 1 - p)
 #print (t_value, p_val)
-
-
-#reenable console windows close button
-sys.stderr.close() # close logfile
-if pywin32_installed:
-    try:
-        hwnd = win32console.GetConsoleWindow()
-        hMenu = win32gui.GetSystemMenu(hwnd, 1)
-        win32gui.DeleteMenu(hMenu, win32con.SC_CLOSE, win32con.MF_BYCOMMAND)
-    except: pass #silent
-
-#pause
-if Interactive:
-    if sys.platform=="win32": os.system("pause") # windows
-    else: 
-        #os.system('read -s -n 1 -p "Press any key to continue...\n"')
-        import termios
-        print("Press any key to continue...")
-        fd = sys.stdin.fileno()
-        oldterm = termios.tcgetattr(fd)
-        newattr = termios.tcgetattr(fd)
-        newattr[3] = newattr[3] & ~termios.ICANON & ~termios.ECHO
-        termios.tcsetattr(fd, termios.TCSANOW, newattr)
-        try: result = sys.stdin.read(1)
-        except IOError: pass
-        finally: termios.tcsetattr(fd, termios.TCSAFLUSH, oldterm)   
-
-
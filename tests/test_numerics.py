@@ -0,0 +1,226 @@
+#
+# regression checks of the numerics of fMRS_sliding_window and fMRS_statistics,
+# small deterministic data, run with "python -m pytest tests"
+#
+
+import sys
+import os
+import numpy
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmark'))
+import fMRS_sliding_window
+import fMRS_statistics
+import synthetic
+
+def _vax_to_ieee_single_float_loop(data): # original version from the python VeSPA project
+    data = bytearray(data)
+    f = []
+    for i in range(int(len(data) / 4)):
+        byte2 = data[0 + i*4]; byte1 = data[1 + i*4]
+        byte4 = data[2 + i*4]; byte3 = data[3 + i*4]
+        sign  =  (byte1 & 0x80) >> 7
+        expon = ((byte1 & 0x7f) << 1 )  + ((byte2 & 0x80 ) >> 7 )
+        fract = ((byte2 & 0x7f) << 16 ) +  (byte3 << 8 ) + byte4
+        if 0 < expon: f.append((-1.0 if sign else 1.0) * (0.5 + (fract/16777216.0)) * pow(2.0, expon - 128.0))
+        else: f.append(0.)
+    return f
+
+def test_vax_decode_bit_exact ():
+    data = numpy.random.RandomState(0).randint(0, 256, 4*20000).astype(numpy.uint8).tobytes()
+    reference = numpy.asarray(_vax_to_ieee_single_float_loop(data), dtype=numpy.float64)
+    result = fMRS_sliding_window._vax_to_ieee_single_float(data)
+    assert numpy.array_equal(reference.view(numpy.uint64), result.view(numpy.uint64))
+
+def test_vax_round_trip ():
+    values = numpy.random.RandomState(1).normal(0., 1e3, 5000).astype(numpy.float32).astype(numpy.float64)
+    values[:3] = [0., 1., -0.5]
+    result = fMRS_sliding_window._vax_to_ieee_single_float(fMRS_sliding_window._ieee_to_vax_single_float(values))
+    assert numpy.array_equal(result, values)
+
+def test_window_averages_equal_av_list ():
+    # the python averages (--preaverage) are the means TARQUIN forms from the av_list
+    fids = synthetic.fids(23, 64)
+    for window in [1, 2, 5, 8]:
+        for n_spectra, average in enumerate(fMRS_sliding_window.window_averages (fids, window)):
+            members = numpy.asarray(fMRS_sliding_window.window_members (n_spectra, 23, window))
+            assert numpy.allclose(average, numpy.mean(fids[members-1], axis=0), rtol=1e-12, atol=1e-12)
+
+def test_preaverage_spectrum_equals_av_list (tmpdir):
+    # single averaged spectrum written for TARQUIN (SPAR with one row) against the average
+    # of the av_list members of the series, within float32 precision of the SDAT
+    basename = str(tmpdir.join('series'))
+    SPARfile = synthetic.write_SPAR_SDAT (basename, 12, 128)
+    sdat = fMRS_sliding_window.PhilipsSDAT (SPARfile, basename+'.SDAT')
+    average = list(fMRS_sliding_window.window_averages (sdat, 5))[6]
+    written = fMRS_sliding_window.write_SPAR_SDAT (str(tmpdir.join('window')), average, sdat.SPAR_lines)
+    single = fMRS_sliding_window.PhilipsSDAT (written[:-5]+'.SPAR', written)
+    assert single.rows == 1 and single.samples == 128
+    members = numpy.asarray(fMRS_sliding_window.window_members (6, 12, 5))
+    assert numpy.allclose(single[0], numpy.mean(sdat[members-1], axis=0), rtol=1e-6, atol=1e-4)
+
+def test_lag_correlations_equal_pearsonr ():
+    stats = pytest.importorskip('scipy.stats')
+    random = numpy.random.RandomState(2)
+    paradigm = fMRS_statistics.smooth (fMRS_statistics.default_paradigm ()[:120], 3)[:100]
+    data = random.normal(0., 1., (120, 4)); data[:,1] += 0.5*numpy.roll(fMRS_statistics.smooth (
+        fMRS_statistics.default_paradigm ()[:120], 3), 7)
+    r, p = fMRS_statistics.lag_correlations (paradigm, data, 20)
+    for column in range(4):
+        for shift in range(20):
+            expected = stats.pearsonr(paradigm, data[shift:shift+100, column])
+            assert abs(r[column, shift]-expected[0]) < 1e-10
+            assert abs(p[column, shift]-expected[1]) < 1e-8*max(expected[1], 1e-300)+1e-14
+
+def test_failing_surrogate_chunk_raises (monkeypatch):
+    # an error in one of the threads reaches the caller, the interpreter keeps running
+    random = numpy.random.RandomState(3)
+    paradigm = fMRS_statistics.smooth (fMRS_statistics.default_paradigm ()[:80], 3)[:70]
+    data = random.normal(0., 1., (80, 2))
+    r = fMRS_statistics.lag_correlations (paradigm, data, 10)[0]
+    surrogates = fMRS_statistics.surrogates
+    def failing (x, n, method, block, random_state):
+        if n < 10: raise MemoryError ('chunk')
+        return surrogates (x, n, method, block, random_state)
+    monkeypatch.setattr(fMRS_statistics, 'surrogates', failing)
+    for n_jobs in [1, 3]:
+        with pytest.raises(RuntimeError): 
+            fMRS_statistics.surrogate_test (paradigm, data, r, 45, 'phase', 5, 0, n_jobs, chunk=10)
+    p, p_max = fMRS_statistics.surrogate_test (paradigm, data, r, 40, 'phase', 5, 0, 2, chunk=10)
+    assert numpy.all((p > 0.) & (p <= 1.)) and numpy.all(p_max >= p)
+
+def test_group_effect_at_known_shift ():
+    # 4 subjects, paradigm effect in the first metabolite at shift 5, the others noise
+    pytest.importorskip('scipy.stats')
+    random = numpy.random.RandomState(4)
+    paradigm = fMRS_statistics.default_paradigm ()[:120]
+    data = random.normal(0., 1., (4, 120, 7)); data[:,:,:3] = 1.
+    data[:,5:,3] += 2.*paradigm[:115]
+    group = fMRS_statistics.group_statistics (data, paradigm, 1, 30)
+    effects = fMRS_statistics.group_effects (group)
+    assert [(prefix, i, shift) for prefix, i, shift, p, p_corrected in effects] == [('', 3, 5)]
+    p, p_corrected = effects[0][3:]
+    assert p_corrected == pytest.approx(p*4*30)
+    assert numpy.nanmin(group['p'][4:,:]) < 0.05 # uncorrected, the noise would have been reported
+
+def test_event_paradigm (tmpdir):
+    # BIDS events (onset and duration in seconds) averaged over dynamics of tr seconds
+    filename = str(tmpdir.join('events.tsv'))
+    with open(filename, 'w') as f: f.write('onset\tduration\ttrial_type\n4\t6\tstim\n15\t3\tstim\n')
+    paradigm = fMRS_statistics.read_paradigm (filename, 10, 2., 0.)
+    assert numpy.allclose(paradigm, [0., 0., 1., 1., 1., 0., 0., 0.5, 1., 0.])
+    values = str(tmpdir.join('values.txt'))
+    with open(values, 'w') as f: f.write('\n'.join(['0']*3+['1']*4+['0']*3)+'\n')
+    assert numpy.allclose(fMRS_statistics.read_paradigm (values, 10, 0., 0.), [0]*3+[1]*4+[0]*3)
+
+def test_finish_writes_failed_fits_as_nan (tmpdir):
+    # a dataset set up with init_fits (as by schedule_fits) goes through collect, failed_fit and finish
+    fMRS_sliding_window.configure (windows=[3], basedir=str(tmpdir))
+    try:
+        dataset = {'filename': 'series.SPAR', 'name': 'series', 'status': 'ok', 'rows': 3,
+                   'journal': open(os.devnull, 'w'), 'checkpoint': str(tmpdir.join('none')), 
+                   'scratch': str(tmpdir.join('none'))}
+        fMRS_sliding_window.init_fits (dataset)
+        csvfile = str(tmpdir.join('fit.csv'))
+        with open(csvfile, 'w') as f: 
+            f.write('Signal amplitudes\nRow,Col,Slice,NAA,Cr\n1,1,1,2.5,1.5\n\nCRLBs\nRow,Col,Slice,NAA,Cr\n1,1,1,0.1,0.2\n')
+        for n in range(2):
+            fMRS_sliding_window.collect ({'dataset': dataset, 'members': (n+1,), 'targets': [(3, n)], 'csvfile': csvfile})
+        dataset['pending'] += 1
+        fMRS_sliding_window.failed_fit ({'dataset': dataset, 'members': (3,), 'targets': [(3, 2)], 'error': 'test'})
+        fMRS_sliding_window.finish (dataset)
+    finally: fMRS_sliding_window.configure (windows=[1], basedir=os.getcwd())
+    assert dataset['outputs'] == [str(tmpdir.join('series.csv'))]
+    lines = open(dataset['outputs'][0]).readlines()
+    assert lines[2:] == ['1,1,1,2.5,1.5\n', '1,1,1,2.5,1.5\n', '1,1,1,nan,nan\n']
+    results = numpy.load(str(tmpdir.join('series.npz')))
+    assert numpy.isnan(results['amplitudes'][2,3:]).all() and results['amplitudes'][0,3] == 2.5
+
+def test_library_errors_raise (tmpdir):
+    # process() reports problems as exceptions, the interpreter keeps running
+    basename = str(tmpdir.join('series'))
+    synthetic.write_SPAR_SDAT (basename, 6, 64)
+    fMRS_sliding_window.configure (windows=[1], basedir=str(tmpdir), 
+                                   tarquin=os.path.join(os.path.dirname(synthetic.__file__), 'tarquin'))
+    fMRS_sliding_window.my_env['FAKE_TARQUIN_FAIL'] = '3'
+    try:
+        with pytest.raises(fMRS_sliding_window.InputError): 
+            fMRS_sliding_window.process ([(str(tmpdir.join('missing.SPAR')), 'missing')])
+        with pytest.raises(fMRS_sliding_window.RunError): 
+            fMRS_sliding_window.process ([(basename+'.SPAR', 'series')])
+    finally: 
+        del fMRS_sliding_window.my_env['FAKE_TARQUIN_FAIL']
+        fMRS_sliding_window.configure (basedir=os.getcwd(), tarquin='')
+    assert fMRS_sliding_window.tempdir == '' and fMRS_sliding_window.processes == []
+    assert not [name for name in os.listdir(str(tmpdir)) if name.startswith('.')]
+
+def test_single_spectrum_SPAR (tmpdir):
+    # the SPAR written for an averaged spectrum has one row, whatever the spacing of the original
+    lines = ['! rows : 40\n', 'rows:40\n', 'dim2_pnts\t: 40\n', 'spec_num_row :  40\n', 'samples : 8\n', 'mix_number : 1\n']
+    fMRS_sliding_window.write_SPAR_SDAT (str(tmpdir.join('single')), numpy.zeros(8, dtype=complex), lines)
+    header = fMRS_sliding_window.parse_SPAR (open(str(tmpdir.join('single.SPAR'))).readlines())
+    assert header['rows'] == 1 and header['dim2_pnts'] == 1 and header['spec_num_row'] == 1 and header['samples'] == 8
+    assert open(str(tmpdir.join('single.SPAR'))).readline() == '! rows : 40\n'
+
+def test_cache_key_depends_on_tarquin (tmpdir):
+    keys = []
+    for version in ['1', '2']:
+        program = str(tmpdir.join('tarquin'+version))
+        with open(program, 'w') as f: f.write('TARQUIN version '+version+'\n')
+        fMRS_sliding_window.configure (tarquin=program); fMRS_sliding_window.basis_files.clear()
+        keys.append(fMRS_sliding_window.cache_key ('input', (1, 2, 3), 'options', fMRS_sliding_window.tarquin_hash ()))
+    fMRS_sliding_window.configure (tarquin=''); fMRS_sliding_window.basis_files.clear()
+    assert keys[0] != keys[1]
+    assert keys[0] != fMRS_sliding_window.cache_key ('input', (1, 2, 3), 'options')
+
+def test_cache_key_depends_on_basis (tmpdir):
+    # fits with the simulated basis and with TARQUIN's internal one (simulation failed) do not share cache entries
+    program = str(tmpdir.join('tarquin'))
+    with open(program, 'w') as f: f.write('TARQUIN\n')
+    fMRS_sliding_window.configure (tarquin=program); fMRS_sliding_window.basis_files.clear()
+    options = fMRS_sliding_window.fit_options
+    try:
+        fMRS_sliding_window.fit_options = ' '.join(fMRS_sliding_window.tarquin_arguments('<input>', None, '<output>', '<basis>'))
+        lines = ['synthesizer_frequency : 127760000\n', 'sample_frequency : 2000\n', 'samples : 2048\n']
+        simulated = fMRS_sliding_window.fit_basis ({'SPAR_lines': lines})
+        internal = fMRS_sliding_window.fit_basis ({'SPAR_lines': lines, 'basis': None})
+        other = fMRS_sliding_window.fit_basis ({'SPAR_lines': lines[:2]+['samples : 1024\n']})
+    finally: 
+        fMRS_sliding_window.fit_options = options
+        fMRS_sliding_window.configure (tarquin=''); fMRS_sliding_window.basis_files.clear()
+    assert len(set([simulated, internal, other])) == 3 and not '<basis>' in simulated
+    assert internal == ' '.join(fMRS_sliding_window.tarquin_arguments('<input>', None, '<output>'))
+
+def test_cache_evict_and_vanished_entries (tmpdir):
+    # fits and basis sets count for --cache_size, least recently used first, an entry
+    # evicted by another run is a cache miss
+    fMRS_sliding_window.configure (cache_dir=str(tmpdir))
+    try:
+        for age, name in enumerate(['new.csv', 'basis_new.basis', 'old.csv', 'basis_old.basis']):
+            tmpdir.join(name).write('x'*1000); os.utime(str(tmpdir.join(name)), (1e9-age, 1e9-age))
+        tmpdir.join('other.csv.host-1.tmp').write('x'*1000)
+        fMRS_sliding_window.cache_evict (2500)
+        assert sorted(os.listdir(str(tmpdir))) == ['basis_new.basis', 'new.csv', 'other.csv.host-1.tmp']
+        assert fMRS_sliding_window.cache_lookup ('new.csv') == ['x'*1000]
+        assert fMRS_sliding_window.cache_lookup ('old.csv') is None
+        assert fMRS_sliding_window.cache_lookup ('basis_old.basis', str(tmpdir.join('copy'))) is None
+        assert not tmpdir.join('copy').check()
+    finally: fMRS_sliding_window.configure (cache_dir='')
+
+def test_headerless_paradigm_columns (tmpdir):
+    # without header a two column file is a per dynamic regressor (first column), events only with events=True
+    filename = str(tmpdir.join('paradigm.csv'))
+    with open(filename, 'w') as f: f.write('4,6\n15,3\n0,1\n1,1\n')
+    assert numpy.allclose(fMRS_statistics.read_paradigm (filename, 4, 2., 0.), [4., 15., 0., 1.])
+    paradigm = fMRS_statistics.read_paradigm (filename, 10, 2., 0., events=True)
+    assert numpy.allclose(paradigm, [1., 0., 1., 1., 1., 0., 0., 0.5, 1., 0.])
+
+def test_dicom_parameters (tmpdir):
+    # 127.76 MHz stored in MHz reads back as 127760000 Hz, not truncated to 127759999
+    if fMRS_sliding_window.import_dicom () == None: pytest.skip('pydicom not installed')
+    filename = synthetic.write_DICOM (str(tmpdir.join('XX_0001')), 6, 64)
+    dataset = fMRS_sliding_window.read_dataset (filename)
+    header = fMRS_sliding_window.parse_SPAR (dataset['SPAR_lines'])
+    assert header['synthesizer_frequency'] == 127760000 and header['sample_frequency'] == 2000
+    assert header['rows'] == 6 and header['samples'] == 64